@@ -28,18 +28,43 @@ description:
 from __future__ import print_function
 from argparse import ArgumentParser, RawTextHelpFormatter
 import os
+import asyncore
+from BaseHTTPServer import BaseHTTPRequestHandler
+from collections import deque
+from copy import deepcopy
+import ctypes
+import ctypes.util
+from datetime import datetime
+import errno
 import fnmatch
+import gzip
+import hashlib
+import heapq
+import httplib
+import importlib
+import itertools
 import logging
 import string
 import re
 import random
-from threading import BoundedSemaphore, Thread, _Verbose
-from Queue import Queue
-from time import time
-from json import dumps
-from yaml import safe_load
+import select
+import shutil
+import socket
+import struct
+import subprocess
+from SocketServer import ThreadingMixIn, UnixStreamServer
+import sys
+import tarfile
+import tempfile
+from threading import Condition, Lock, Thread, _Verbose, current_thread, \
+    local
+from Queue import Empty, PriorityQueue, Queue
+from time import sleep, time
+from json import dump, dumps, load, loads
+from urllib import urlencode
+from urlparse import urlparse
+from xml.etree import ElementTree
 import colorlog
-import docker
 
 
 __author__ = "Timo Runge"
@@ -52,11 +77,32 @@ __version__ = "0.0.5"
 
 
 LOG = colorlog.getLogger(__name__)
+LOG_FORMAT = ("%(log_color)s[%(levelname)s] "
+              "%(threadName)s:%(reset)s %(message)s")
 
 
 # Generic classes
 
 
+class _LazyModule(object):  # pylint: disable=R0903
+    """
+    A module which is imported on its first use. The thin client of the
+    daemon (`--connect`) doesn't import the Docker SDK and YAML.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+docker = _LazyModule("docker")  # pylint: disable=C0103
+requests = _LazyModule("requests")  # pylint: disable=C0103
+urllib3 = _LazyModule("urllib3")  # pylint: disable=C0103
+yaml = _LazyModule("yaml")  # pylint: disable=C0103
+
+
 class Color(object):
     """ Generate color codes, print them directly or get the message string """
 
@@ -103,6 +149,85 @@ class Color(object):
             self.end)
 
 
+class Checksum(object):
+    """ Calculate a SHA256 checksum of objects, files and directories """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+
+    def add(self, obj):
+        """ Add a JSON serializable object """
+        self.sha256.update(dumps(obj, sort_keys=True))
+        return self
+
+    def add_directory(self, path):
+        """ Add the relative file names and the content of a directory """
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                _file = os.path.join(root, filename)
+                self.add(os.path.relpath(_file, path))
+                self.add_file(_file)
+        return self
+
+    def add_file(self, path):
+        """ Add the content of a file """
+        with open(path, "rb") as _file:
+            for chunk in iter(lambda: _file.read(1024 * 1024), b""):
+                self.sha256.update(chunk)
+        return self
+
+    def hexdigest(self):
+        """ Get the checksum as hex string """
+        return self.sha256.hexdigest()
+
+
+class JsonIndex(object):
+    """ A thread safe dictionary which is stored as JSON file """
+
+    def __init__(self, path):
+        self.index = dict({})
+        self.lock = Lock()
+        self.path = path
+        self._load()
+
+    def get(self, key, default=None):
+        """ Get the value of a key """
+        with self.lock:
+            return self.index.get(key, default)
+
+    def items(self):
+        """ Get a list of all key value pairs """
+        with self.lock:
+            return self.index.items()
+
+    def save(self):
+        """ Write the index file """
+        with self.lock:
+            self._save()
+
+    def set(self, key, value, save=True):
+        """ Set the value of a key and write the index file """
+        with self.lock:
+            self.index[key] = value
+            if save:
+                self._save()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as index_file:
+                self.index = load(index_file)
+        except (IOError, ValueError):
+            self.index = dict({})
+
+    def _save(self):
+        _makedirs(os.path.dirname(os.path.abspath(self.path)))
+        _tmp_file = "%s.%s" % (self.path, os.getpid())
+        with open(_tmp_file, "w") as index_file:
+            dump(self.index, index_file, indent=4, sort_keys=True)
+        os.rename(_tmp_file, self.path)
+
+
 class SearchAndReplace(object):
     """ Class to mange search and replace operations """
 
@@ -134,8 +259,183 @@ class SearchAndReplace(object):
         return re.sub(self.search, self.replace, obj)
 
 
+class PrioritySemaphore(object):
+    """
+    A bounded semaphore which hands out free slots to the waiting thread
+    with the highest priority first. Threads with the same priority are
+    served in the order of arrival.
+    """
+
+    def __init__(self, value=1):
+        self.condition = Condition(Lock())
+        self.counter = itertools.count()
+        self.initial_value = value
+        self.value = value
+        self.waiters = list([])
+
+    def acquire(self, priority=0):
+        """ Acquire a slot """
+        with self.condition:
+            ticket = (-priority, next(self.counter))
+            heapq.heappush(self.waiters, ticket)
+            while self.value == 0 or self.waiters[0] != ticket:
+                self.condition.wait()
+            heapq.heappop(self.waiters)
+            self.value -= 1
+            self.condition.notify_all()
+        return True
+
+    def release(self):
+        """ Release a slot """
+        with self.condition:
+            if self.value >= self.initial_value:
+                raise ValueError("Semaphore released too many times.")
+            self.value += 1
+            self.condition.notify_all()
+
+
+class Admission(object):
+    """
+    Admit container runs by their CPU and memory requests. The capacity is
+    the amount of CPUs and memory of the Docker daemon(s) and a run waits
+    until its requests are free (the run with the highest priority first).
+    If `max_load` is set, new runs are delayed (with an exponential backoff)
+    while the host is saturated: the load average per CPU is above
+    `max_load` or less than 10% of the memory is available. The host load is
+    only checked for a local Docker daemon.
+    """
+
+    max_delay = 8.0
+    min_delay = 0.5
+
+    def __init__(self, config, infos):
+        self.capacity = {
+            "cpus": float(sum(_info["NCPU"] for _info in infos)),
+            "memory": sum(_info["MemTotal"] for _info in infos)}
+        self.condition = Condition(Lock())
+        self.counter = itertools.count()
+        self.delay = self.min_delay
+        self.delayed_until = 0.0
+        self.free = dict(self.capacity)
+        self.max_load = config["max_load"]
+        self.running = 0
+        self.waiters = list([])
+        if self.max_load is not None and bool(config["docker_hosts"]):
+            LOG.warning("The host load (max_load) is only checked for a "
+                        "local Docker daemon.")
+            self.max_load = None
+        LOG.debug("Admission capacity: %s CPU(s), %s bytes of memory.",
+                  self.capacity["cpus"], self.capacity["memory"])
+
+    @staticmethod
+    def enabled(config):
+        """ Check if CPU or memory requests or a `max_load` are set """
+        return config["max_load"] is not None or \
+            bool(config["docker_image_resources"]) or \
+            any("resources" in (_settings or dict({})) for _settings in
+                (config["docker_container_environments"] or
+                 dict({})).itervalues())
+
+    def acquire(self, resources, priority=0):
+        """
+        Wait until the resources of a container run are free and take them.
+        Returns the taken resources.
+        """
+        resources = self._request(resources)
+        with self.condition:
+            ticket = (-priority, next(self.counter))
+            heapq.heappush(self.waiters, ticket)
+            while True:
+                if self.waiters[0] != ticket or not self._fits(resources):
+                    self.condition.wait()
+                    continue
+                delay = self._backoff()
+                if not delay:
+                    break
+                self.condition.wait(delay)
+            heapq.heappop(self.waiters)
+            self._take(resources)
+            self.condition.notify_all()
+        return resources
+
+    def admit(self, resources):
+        """
+        Take the resources of a container run if they are free (without
+        waiting). Returns the taken resources or None.
+        """
+        resources = self._request(resources)
+        with self.condition:
+            if not self._fits(resources) or time() < self.delayed_until:
+                return None
+            delay = self._backoff()
+            if delay:
+                self.delayed_until = time() + delay
+                return None
+            self._take(resources)
+        return resources
+
+    def release(self, resources):
+        """ Give the resources of a finished container run back """
+        with self.condition:
+            for key, value in resources.iteritems():
+                self.free[key] += value
+            self.running -= 1
+            self.condition.notify_all()
+
+    def _backoff(self):
+        """
+        Get the delay of the next run if the host is saturated (and at
+        least one run is running), otherwise 0.
+        """
+        if self.running == 0 or not self._saturated():
+            self.delay = self.min_delay
+            return 0
+        delay = self.delay
+        self.delay = min(self.delay * 2, self.max_delay)
+        LOG.debug("Host is saturated, delaying the next container run "
+                  "for %ss.", delay)
+        return delay
+
+    def _fits(self, resources):
+        return all(_value <= self.free[_key]
+                   for _key, _value in resources.iteritems())
+
+    @staticmethod
+    def _meminfo():
+        """ Read the total and the available memory (kB) from /proc """
+        meminfo = dict({})
+        try:
+            with open("/proc/meminfo") as meminfo_file:
+                for line in meminfo_file:
+                    key, _, value = line.partition(":")
+                    meminfo[key] = int(value.split()[0])
+        except (IOError, IndexError, ValueError):
+            return None
+        return meminfo
+
+    def _request(self, resources):
+        """ Limit the requests to the capacity (a run must fit once) """
+        return dict((_key, min(_value, self.capacity[_key]))
+                    for _key, _value in resources.iteritems())
+
+    def _saturated(self):
+        if self.max_load is None:
+            return False
+        if os.getloadavg()[0] / (self.capacity["cpus"] or 1.0) > \
+                float(self.max_load):
+            return True
+        meminfo = self._meminfo()
+        return bool(meminfo) and "MemAvailable" in meminfo and \
+            meminfo["MemAvailable"] < meminfo["MemTotal"] * 0.1
+
+    def _take(self, resources):
+        for key, value in resources.iteritems():
+            self.free[key] -= value
+        self.running += 1
+
+
 class Semaphore(object):
-    """ A factory function that returns a new BoundedSemaphore. """
+    """ A factory function that returns a new PrioritySemaphore. """
 
     def __init__(self, threads):
         self._set(threads)
@@ -146,11 +446,11 @@ class Semaphore(object):
 
     def get(self):
         """
-        Get BoundedSemaphore factory.
-        Returns a tuple. The first object is BoundedSemaphore, the second
+        Get PrioritySemaphore factory.
+        Returns a tuple. The first object is PrioritySemaphore, the second
         item is the thread limit as int.
         """
-        return BoundedSemaphore(self.threads), self.threads
+        return PrioritySemaphore(self.threads), self.threads
 
     def _set(self, threads):
         try:
@@ -159,6 +459,306 @@ class Semaphore(object):
             raise error
 
 
+class Watchdog(Thread, _Verbose):
+    """
+    Expire running jobs which are exceeding their timeout. The thread is
+    started with the first job and runs until it is stopped.
+    """
+
+    def __init__(self, name="Watchdog"):
+        _Verbose.__init__(self)
+        Thread.__init__(self, name=name)
+        self.condition = Condition(Lock())
+        self.counter = itertools.count()
+        self.daemon = True
+        self.deadlines = list([])
+        self.stopped = False
+
+    def add(self, job):
+        """
+        Watch a job. Returns the deadline which is needed to remove the job.
+        """
+        deadline = [time() + job.timeout, next(self.counter), job]
+        with self.condition:
+            heapq.heappush(self.deadlines, deadline)
+            if self.ident is None:
+                self.start()
+            self.condition.notify()
+        return deadline
+
+    def remove(self, deadline):
+        """ Stop watching a job """
+        with self.condition:
+            deadline[2] = None
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                while self.deadlines and self.deadlines[0][2] is None:
+                    heapq.heappop(self.deadlines)
+                if not bool(self.deadlines):
+                    self.condition.wait()
+                    continue
+                delay = self.deadlines[0][0] - time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                job = heapq.heappop(self.deadlines)[2]
+                self.condition.release()
+                try:
+                    LOG.error(
+                        "%s %s exceeded the timeout of %ss.",
+                        job.kind,
+                        job.name,
+                        job.timeout)
+                    job.expire()
+                except Exception:  # pylint: disable=W0703
+                    LOG.exception(
+                        "Expiring %s %s failed with an unexpected error.",
+                        job.kind,
+                        job.name)
+                finally:
+                    self.condition.acquire()
+
+    def stop(self):
+        """ Stop watching all jobs and wait for the thread """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.ident is not None:
+            self.join()
+
+
+class WorkerPool(object):
+    """
+    A fixed size pool of worker threads which are taking jobs from a
+    priority queue. The job with the highest priority is started first.
+    The worker threads are started on demand and stopped on join. Jobs
+    are starting their timeout with the watchdog of the pool (which is
+    replaced on join).
+    """
+
+    def __init__(self, size, name="Worker"):
+        self.cancelled = False
+        self.counter = itertools.count()
+        self.lock = Lock()
+        self.name = name
+        self.queue = PriorityQueue()
+        self.running = set([])
+        self.size = int(size)
+        self.watchdog = Watchdog("%s-Watchdog" % name)
+        self.workers = list([])
+
+    def cancel(self):
+        """ Skip all queued jobs and cancel the running jobs """
+        with self.lock:
+            self.cancelled = True
+            running = list(self.running)
+        for job in running:
+            job.cancel()
+
+    def join(self):
+        """ Wait until all jobs are done and stop the worker threads """
+        self.queue.join()
+        with self.lock:
+            workers = self.workers
+            self.workers = list([])
+        for _ in workers:
+            self.queue.put((float("inf"), next(self.counter), None))
+        for worker in workers:
+            worker.join()
+        with self.lock:
+            self.cancelled = False
+            watchdog = self.watchdog
+            self.watchdog = Watchdog(watchdog.name)
+        watchdog.stop()
+
+    def submit(self, job):
+        """ Add a job to the queue """
+        with self.lock:
+            if len(self.workers) < self.size:
+                worker = Thread(
+                    target=self._worker,
+                    name="%s-%s" % (self.name, len(self.workers) + 1))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        self.queue.put((-job.priority, next(self.counter), job))
+
+    def _run(self, job):
+        with self.lock:
+            cancelled = self.cancelled
+            if not cancelled:
+                self.running.add(job)
+        if cancelled:
+            job.skip()
+            return
+        job.watchdog = self.watchdog
+        try:
+            with TRACER.span(job.name, job.kind.lower()):
+                job.run()
+        except Exception:  # pylint: disable=W0703
+            LOG.exception(
+                "%s %s failed with an unexpected error.",
+                job.kind,
+                job.name)
+        finally:
+            if job.deadline is not None:
+                self.watchdog.remove(job.deadline)
+            with self.lock:
+                self.running.discard(job)
+
+    def _worker(self):
+        thread = current_thread()
+        name = thread.name
+        TRACER.thread_name(name)
+        while True:
+            job = self.queue.get()[2]
+            if job is None:
+                self.queue.task_done()
+                return
+            thread.name = job.name
+            try:
+                self._run(job)
+            finally:
+                thread.name = name
+                self.queue.task_done()
+
+
+class NullTracer(object):
+    """ A tracer which doesn't record anything (tracing disabled) """
+
+    def __init__(self):
+        self._span = _NullSpan()
+
+    def complete(self, *args, **kwargs):
+        """ Record nothing """
+
+    def save(self, path):
+        """ Write nothing """
+
+    def span(self, *args, **kwargs):
+        """ Get a span which doesn't record anything """
+        return self._span
+
+    def thread_name(self, name):
+        """ Record nothing """
+
+
+class Tracer(object):
+    """
+    Record spans of the run in the Chrome trace event format (which can be
+    displayed with chrome://tracing or Perfetto). Every thread has its own
+    track.
+    """
+
+    def __init__(self):
+        self.events = list([])
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.start = time()
+        self.threads = dict({})
+        self.tracks = itertools.count(1)
+        self.thread_name("MainThread")
+
+    def complete(  # pylint: disable=R0913
+            self,
+            name,
+            category,
+            start,
+            end,
+            track=None,
+            **args):
+        """
+        Record a span with a known start and end. Without a track the span
+        is recorded on the track of the current thread.
+        """
+        if track is None:
+            tid = current_thread().ident
+        else:
+            with self.lock:
+                if track not in self.threads:
+                    self.threads[track] = (next(self.tracks), track)
+                tid = self.threads[track][0]
+        event = {
+            "args": args,
+            "cat": category,
+            "dur": int((end - start) * 1000000),
+            "name": name,
+            "ph": "X",
+            "pid": self.pid,
+            "tid": tid,
+            "ts": int((start - self.start) * 1000000)}
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, path):
+        """ Write the trace file """
+        with self.lock:
+            events = list(self.events)
+            for tid, name in self.threads.itervalues():
+                events.append({
+                    "args": {"name": name},
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid})
+        with open(path, "w") as trace_file:
+            dump(
+                {"displayTimeUnit": "ms", "traceEvents": events},
+                trace_file)
+        LOG.info("Trace written to %s", path)
+
+    def span(self, name, category, **args):
+        """ Get a span (context manager) of the current thread """
+        return _Span(self, name, category, args)
+
+    def thread_name(self, name):
+        """ Set the track name of the current thread """
+        thread = current_thread()
+        with self.lock:
+            self.threads[thread.ident] = (thread.ident, name)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, category, args):
+        self.args = args
+        self.category = category
+        self.name = name
+        self.start = None
+        self.tracer = tracer
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.complete(
+            self.name,
+            self.category,
+            self.start,
+            time(),
+            **self.args)
+        return False
+
+
+TRACER = NullTracer()
+
+# The response of the last image build request of a thread (recorded by the
+# response hook of the Docker API clients)
+_BUILD_RESPONSE = local()
+
+
 class Time(object):
     """ Basic time operations """
 
@@ -168,9 +768,14 @@ class Time(object):
 
     def delta_in_hms(self):
         """ Get time detla in a human readable format """
-        hours = int(self.delta / (60 * 60))
-        minutes = int((self.delta % (60 * 60)) / 60)
-        seconds = self.delta % 60
+        return self.in_hms(self.delta)
+
+    @staticmethod
+    def in_hms(delta):
+        """ Get a time delta (in seconds) in a human readable format """
+        hours = int(delta / (60 * 60))
+        minutes = int((delta % (60 * 60)) / 60)
+        seconds = delta % 60
         return "{}h {:>02}m {:>05.2f}s".format(hours, minutes, seconds)
 
     def delta_in_s(self):
@@ -191,6 +796,7 @@ class Configuration(object):
         self.path = os.getcwd()
         self._from_file()
         self._validate()
+        self._images()
 
     def add(self, key, value, section=None):
         """ Add a key value pair (to a section) """
@@ -227,23 +833,70 @@ class Configuration(object):
                         self.config_filename))
                 _first_file = next(iter(_files))
                 _config_file = _first_file
+                self.config_file = _config_file
             with open("%s" % (_config_file), "r") as config_file:
-                _yaml = safe_load(config_file)
+                _yaml = yaml.safe_load(config_file)
                 self.config = SearchAndReplace(
                     "__PATH__",
                     self.path).in_dict(_yaml)
         except IOError as error:
             raise error
 
+    def _images(self):
+        """
+        Get the image names and the declared parents of the `docker_images`
+        entries (`- image` or `- image: {parent: other_image}`).
+        """
+        images = list([])
+        parents = dict({})
+        resources = dict({})
+        for image in self.config["docker_images"]:
+            if not isinstance(image, dict):
+                images.append(image)
+                continue
+            for name, settings in image.iteritems():
+                images.append(name)
+                parent = (settings or dict({})).get("parent")
+                if parent is not None:
+                    parents[name] = parent if isinstance(parent, list) \
+                        else [parent]
+                if (settings or dict({})).get("resources") is not None:
+                    resources[name] = settings["resources"]
+        self.add("docker_images", images)
+        self.add("docker_image_parents", parents)
+        self.add("docker_image_resources", resources)
+
     def _validate(self):
         optional_config_keys = {
+            "build_timeout": None,
+            "cache_dir": ".docker_test_runner",
             "disable_logging": False,
+            "docker_build_cache": False,
             "docker_container_environments": dict({}),
+            "docker_container_exclude": list([]),
+            "docker_container_include": list([]),
+            "docker_container_reuse": 0,
             "docker_container_volumes": dict({}),
+            "docker_container_workspace": None,
+            "docker_hosts": list([]),
+            "docker_layer_cache": None,
             "docker_remove_images": True,
+            "docker_result_cache": False,
+            "engine": "thread",
+            "fail_fast": False,
+            "history": True,
+            "live_output": False,
+            "log_dir": None,
             "log_level": "INFO",
+            "log_tail": 20,
+            "max_load": None,
+            "max_pool_size": None,
             "project_name": None,
-            "threads": 2}
+            "run_timeout": None,
+            "build_threads": None,
+            "prefetch_threads": 4,
+            "run_threads": None,
+            "threads": None}
         required_config_keys = [
             "docker_image_build_args",
             "docker_image_path",
@@ -257,234 +910,2299 @@ class Configuration(object):
                 raise KeyError(
                     "Required configuration key \"%s\" is missing." %
                     required_config_key)
+        for threads_key in ["threads", "build_threads", "run_threads"]:
+            try:
+                valid = self.config[threads_key] is None or \
+                    int(self.config[threads_key]) >= 1
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                raise ValueError(
+                    "Configuration key \"%s\" has to be at least 1." %
+                    threads_key)
+        for timeout_key in ["build_timeout", "run_timeout"]:
+            try:
+                valid = self.config[timeout_key] is None or \
+                    float(self.config[timeout_key]) > 0
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                raise ValueError(
+                    "Configuration key \"%s\" has to be greater than 0." %
+                    timeout_key)
 
 
-class _DockerThreadedObject(object):
+class ImageGraph(object):
+    """
+    The dependencies between the images. A parent image is declared in
+    `docker_images` (`- image: {parent: other_image}`) or found in a `FROM`
+    line of the Dockerfile which references the tag of another image. An
+    image is built after all of its parents. All other `FROM` images are
+    base images (which are pulled by the Docker daemon).
+    """
 
-    def __init__(self, docker_client, semaphore, config, class_instance):
-        self.class_instance = class_instance
+    def __init__(self, config):
         self.config = config
-        self.docker_client = docker_client
-        self.objects = dict({})
-        self.queue = Queue()
-        self.semaphore = semaphore
+        self.images = list(config["docker_images"])
+        self.parents = dict((_image, set([])) for _image in self.images)
+        for image, parents in \
+                config.get("docker_image_parents", dict({})).iteritems():
+            self.parents[image].update(parents)
+        self.bases = dict((_image, set([])) for _image in self.images)
+        tags = dict((_image_tag(config, _image), _image)
+                    for _image in self.images)
+        for image in self.images:
+            for reference in self._references(image):
+                tag = reference.lower()
+                if tag.endswith(":latest"):
+                    tag = tag[:-len(":latest")]
+                if tag in tags:
+                    if tags[tag] != image:
+                        self.parents[image].add(tags[tag])
+                elif tag != "scratch" and "$" not in tag:
+                    self.bases[image].add(reference)
+        self.children = dict((_image, set([])) for _image in self.images)
+        for image, parents in self.parents.iteritems():
+            for parent in parents:
+                if parent not in self.children:
+                    raise KeyError(
+                        "Parent image \"%s\" of \"%s\" is not in "
+                        "docker_images." % (parent, image))
+                self.children[parent].add(image)
+        self.order()
 
-    def get(self, obj=None):
-        """ Get object informations (for an specific object) """
-        self._wait_for_queue()
-        if obj is not None:
-            try:
-                return self.objects[obj]
-            except KeyError as error:
-                raise error
-        return self.objects
+    def ancestors(self, image):
+        """ Get all (direct and indirect) parents of an image """
+        ancestors = set([])
+        stack = list(self.parents[image])
+        while stack:
+            parent = stack.pop()
+            if parent not in ancestors:
+                ancestors.add(parent)
+                stack.extend(self.parents[parent])
+        return ancestors
 
-    def info(self):
-        """ Display complete object information """
-        print(dumps(self.get(), indent=4, sort_keys=True))
+    def base_images(self, images):
+        """ Get the distinct base images of some images """
+        return sorted(set(_base for _image in images
+                          for _base in self.bases[_image]))
 
-    def run(self):
-        """ Start to run the threaded the object class """
-        threads = list([])
-        for obj, obj_config in self.objects.iteritems():
-            run = self.class_instance(
-                self.docker_client,
-                self.semaphore,
-                self.queue,
-                obj,
-                obj_config)
-            run.start()
-            threads.append(run)
-        for thread in threads:
-            thread.join()
+    def closure(self, images):
+        """
+        Get the images including all of their ancestors (in the order of
+        `docker_images`).
+        """
+        required = set(images)
+        for image in images:
+            required.update(self.ancestors(image))
+        return [_image for _image in self.images if _image in required]
 
-    def _wait_for_queue(self):
-        while not self.queue.empty():
-            self.objects.update(self.queue.get())
-        self._validate()
+    def descendants(self, image):
+        """ Get all (direct and indirect) children of an image """
+        descendants = set([])
+        stack = list(self.children[image])
+        while stack:
+            child = stack.pop()
+            if child not in descendants:
+                descendants.add(child)
+                stack.extend(self.children[child])
+        return descendants
 
-    def _validate(self):
-        if not bool(self.objects):
-            raise KeyError(
-                "%s: Object dictionary is empty." %
-                self.__class__.__name__)
+    def order(self):
+        """ Get the images in topological order (parents first) """
+        pending = dict((_image, len(self.parents[_image]))
+                       for _image in self.images)
+        ready = [_image for _image in self.images if not pending[_image]]
+        order = list([])
+        while ready:
+            image = ready.pop(0)
+            order.append(image)
+            for child in sorted(self.children[image]):
+                pending[child] -= 1
+                if not pending[child]:
+                    ready.append(child)
+        if len(order) != len(self.images):
+            raise ValueError(
+                "Cyclic image dependencies: %s" % ", ".join(
+                    sorted(_image for _image in self.images
+                           if _image not in order)))
+        return order
 
+    def ready(self, image, built):
+        """ Get the children of an image which have all parents built """
+        return [_child for _child in sorted(self.children[image])
+                if self.parents[_child] <= built]
 
-class DockerContainers(_DockerThreadedObject):
-    """ Create container configuration and give the possibility to run them """
+    def _references(self, image):
+        """
+        Get the images of the FROM lines of a Dockerfile (without the names
+        of the build stages).
+        """
+        dockerfile = os.path.join(
+            self.config["docker_image_path"],
+            "Dockerfile_%s" % image)
+        if not os.path.isfile(dockerfile):
+            return
+        stages = set([])
+        with open(dockerfile, "r") as _dockerfile:
+            for line in _dockerfile:
+                words = [_word for _word in line.split()
+                         if not _word.startswith("--")]
+                if len(words) < 2 or words[0].upper() != "FROM":
+                    continue
+                if words[1].lower() not in stages:
+                    yield words[1]
+                if len(words) > 3 and words[2].upper() == "AS":
+                    stages.add(words[3].lower())
 
-    def __init__(self, docker_client, semaphore, config, images):
-        _DockerThreadedObject.__init__(
-            self,
-            docker_client,
-            semaphore,
-            config,
-            _RunDockerContainer)
-        self.images = images
-        self._objects()
 
-    def _objects(self):
-        """ Create the container run configuration """
-        for image in self.images.iterkeys():  # pylint: disable=R1702
-            if bool(self.config["docker_container_environments"]):
-                LOG.debug("Create environment based container information.")
-                for env, env_settings in \
-                        self.config["docker_container_environments"]. \
-                        iteritems():
-                    skip = False
-                    if "skip_images" in env_settings:
-                        for skip_image in env_settings["skip_images"]:
-                            if skip_image == image:
-                                LOG.debug(
-                                    "Skipping container run for image: %s",
-                                    image)
-                                skip = True
-                    if not skip:
-                        _rand = random.SystemRandom().randrange(100000, 999999)
-                        container = "%s_%s_%s" % (
-                            image,
-                            env,
-                            _rand)
-                        self.objects[container] = dict({})
-                        self.objects[container]["environment"] = env_settings
-                        self.objects[container]["image"] = \
-                            self.images[image]["image"]
-                        self.objects[container]["messages"] = list([])
-                        if "docker_container_volumes" in self.config:
-                            self.objects[container]["volumes"] = \
-                                self.config["docker_container_volumes"]
+class Matrix(object):
+    """
+    The container runs (image x environment) of the configuration. The
+    runs are generated lazily per image. Skips and filters are compiled
+    once: `skip_images` and `only_images` of an environment are sets (glob
+    patterns are compiled to one regular expression) and the include,
+    exclude and `--only` patterns are `image:environment` globs.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.environments = list([])
+        for env, env_settings in \
+                (config["docker_container_environments"] or
+                 dict({})).iteritems():
+            self.environments.append((
+                env,
+                env_settings,
+                self._images(env_settings.get("skip_images")),
+                self._images(env_settings.get("only_images"))))
+        self.exclude = self._patterns(config["docker_container_exclude"])
+        self.include = [
+            _patterns for _patterns in [
+                self._patterns(config["docker_container_include"]),
+                self._patterns(config.get("docker_container_only")),
+                self._patterns(config.get("docker_container_watch"))]
+            if _patterns is not None]
+
+    def count(self, images=None):
+        """ Get the amount of container runs (of some images) """
+        if images is None:
+            images = self.config["docker_images"]
+        return sum(1 for _image in images for _ in self.runs(_image))
+
+    def filtered(self):
+        """ Check if include, exclude or `--only` patterns are set """
+        return bool(self.include) or self.exclude is not None
+
+    def images(self, build_only=False):
+        """
+        Get the images which are selected by the include, exclude and
+        `--only` patterns. An image is selected if it has at least one
+        container run (or, if `build_only` is set, if it's not excluded
+        for all environments).
+        """
+        if not self.filtered():
+            return list(self.config["docker_images"])
+        if build_only:
+            return [_image for _image in self.config["docker_images"]
+                    if self._selected(_image, None, True)]
+        return [_image for _image in self.config["docker_images"]
+                if next(iter(self.runs(_image)), None) is not None]
+
+    def runs(self, image):
+        """
+        Yield the environment names and settings of all container runs of
+        an image. If there are no environments the name is None.
+        """
+        if not bool(self.environments):
+            if self._selected(image, None) and \
+                    _in_shard(self.config, image, None):
+                yield None, dict({})
+            return
+        for env, env_settings, skip_images, only_images in \
+                self.environments:
+            if self._matches(skip_images, image):
+                continue
+            if only_images is not None and \
+                    not self._matches(only_images, image):
+                continue
+            if not self._selected(image, env):
+                continue
+            if not _in_shard(self.config, image, env):
+                continue
+            yield env, env_settings
+
+    @staticmethod
+    def _images(images):
+        """ Split image names into a set and a regex of glob patterns """
+        if images is None:
+            return None
+        names = set([])
+        patterns = list([])
+        for image in images:
+            if any(_char in image for _char in "*?["):
+                patterns.append(fnmatch.translate(image))
             else:
-                LOG.debug("Create container information. No environments set.")
-                _rand = random.SystemRandom().randrange(100000, 999999)
-                container = "%s_%s" % (
-                    image,
-                    _rand)
-                self.objects[container] = dict({})
-                self.objects[container]["environment"] = dict({})
-                self.objects[container]["image"] = self.images[image]["image"]
-                self.objects[container]["messages"] = list([])
-                if "docker_container_volumes" in self.config:
-                    self.objects[container]["volumes"] = \
-                        self.config["docker_container_volumes"]
+                names.add(image)
+        return names, re.compile("|".join(patterns)) if patterns else None
 
+    @staticmethod
+    def _matches(images, image):
+        if images is None:
+            return False
+        names, pattern = images
+        return image in names or \
+            (pattern is not None and pattern.match(image) is not None)
 
-class DockerImages(_DockerThreadedObject):
-    """ Create Docker images """
+    @staticmethod
+    def _patterns(patterns):
+        """
+        Compile `image:environment` globs. The environment is optional
+        (`image` is the same as `image:*`).
+        """
+        if not patterns:
+            return None
+        compiled = list([])
+        for pattern in patterns:
+            image, _, env = pattern.partition(":")
+            compiled.append((
+                re.compile(fnmatch.translate(image or "*")),
+                re.compile(fnmatch.translate(env or "*")),
+                env in ("", "*")))
+        return compiled
 
-    def __init__(self, docker_client, semaphore, config):
-        _DockerThreadedObject.__init__(
-            self,
-            docker_client,
-            semaphore,
-            config,
-            _BuildDockerImage)
-        self._objects()
+    def _selected(self, image, env, build_only=False):
+        """
+        Check the include, exclude and `--only` patterns. Without an
+        environment (`build_only`) only the image part of the include
+        patterns is checked and only patterns of all environments exclude
+        an image.
+        """
+        env = env or ""
+        if self.exclude is not None and any(
+                _image.match(image) and
+                (_all if build_only else _env.match(env))
+                for _image, _env, _all in self.exclude):
+            return False
+        return all(
+            any(_image.match(image) and (build_only or _env.match(env))
+                for _image, _env, _ in _include)
+            for _include in self.include)
 
-    def _objects(self):
-        for image in self.config["docker_images"]:
-            self.objects[image] = self.config
 
+class BuildContext(object):
+    """
+    The build context (tar archive) of `docker_image_path` which is shared
+    by all image builds. The archive honors the `.dockerignore` file and is
+    stored in `cache_dir`. It's only created again if a file of the context
+    was added, removed or modified (size or modification time).
+    """
 
-class _RunDockerContainer(Thread, _Verbose):
+    def __init__(self, config):
+        self.archive = os.path.join(config["cache_dir"], "build_context.tar")
+        self.config = config
+        self.context = None
+        self.index = JsonIndex(
+            os.path.join(config["cache_dir"], "build_context.json"))
+        self.lock = Lock()
+        self.path = config["docker_image_path"]
 
-    def __init__(  # pylint: disable=R0913
-            self,
-            docker_client,
-            semaphore,
-            queue,
-            name,
-            config):
-        _Verbose.__init__(self)
-        Thread.__init__(self)
-        self.color = Color()
-        self.container = config
-        self.docker_client = docker_client
-        self.name = name
-        self.queue = queue
-        self.semaphore = semaphore
+    def digest(self):
+        """ Get the digest of the names and the content of all files """
+        return self._update()["digest"]
 
-    def run(self):
-        self.semaphore.acquire()
-        try:
-            self._run_container()
-        finally:
-            self.queue.put({self.name: self.container})
-            self.semaphore.release()
+    def files(self):
+        """ Get the relative names of all files and directories """
+        return self._update()["files"]
 
-    def _run_container(self):
-        start_time = time()
-        color = random.SystemRandom().choice(self.color.colors())
-        try:
-            LOG.info("Starting container %s...", self.name)
-            container = self.docker_client.containers.run(
-                self.container["image"],
-                detach=True,
-                environment=self.container["environment"],
-                name=self.name,
-                remove=True,
-                stderr=True,
-                stdout=True,
-                volumes=self.container["volumes"])
-            for line in container.logs(stream=True):
-                LOG.info(
-                    self.color.cstring(
-                        line.strip(),
-                        color))
-            self.container["exit_code"] = int(container.wait()["StatusCode"])
-            if self.container["exit_code"] == 0:
-                log_message = "Container {} run succeeded. [Duration: {}]". \
-                    format(
-                        self.name,
-                        Time(start_time).delta_in_hms())
-                LOG.info(log_message)
-                self.container["messages"].append(log_message)
+    def open(self):
+        """ Open the archive. Every build needs its own file object. """
+        self._update()
+        return open(self.archive, "rb")
+
+    def read(self):
+        """ Get the content of the archive """
+        with self.open() as archive:
+            return archive.read()
+
+    def _create(self, files):
+        LOG.debug("Creating build context of %s", self.path)
+        _makedirs(os.path.dirname(os.path.abspath(self.archive)))
+        _tmp_file = "%s.%s" % (self.archive, os.getpid())
+        with open(_tmp_file, "wb") as archive:
+            docker.utils.build.create_archive(
+                self.path,
+                files=files,
+                fileobj=archive)
+        os.rename(_tmp_file, self.archive)
+        checksum = Checksum()
+        for _file in files:
+            _path = os.path.join(self.path, _file)
+            checksum.add(_file)
+            if os.path.islink(_path):
+                checksum.add(os.readlink(_path))
+            elif os.path.isfile(_path):
+                checksum.add_file(_path)
+        return checksum.hexdigest()
+
+    def _files(self):
+        patterns = list([])
+        dockerignore = os.path.join(self.path, ".dockerignore")
+        if os.path.exists(dockerignore):
+            with open(dockerignore, "r") as dockerignore_file:
+                patterns = [_line.strip() for _line in
+                            dockerignore_file.read().splitlines()
+                            if _line.strip() and not _line.startswith("#")]
+        patterns.extend("!Dockerfile_%s" % _image
+                        for _image in self.config["docker_images"])
+        cache_dir = os.path.relpath(
+            os.path.abspath(self.config["cache_dir"]),
+            os.path.abspath(self.path))
+        if not cache_dir.startswith(os.pardir):
+            patterns.append(cache_dir)
+        return sorted(docker.utils.build.exclude_paths(self.path, patterns))
+
+    def _update(self):
+        with self.lock:
+            if self.context is not None:
+                return self.context
+            files = self._files()
+            stats = list([])
+            for _file in files:
+                _stat = os.lstat(os.path.join(self.path, _file))
+                stats.append((_file, _stat.st_size, _stat.st_mtime))
+            signature = Checksum() \
+                .add(os.path.abspath(self.path)) \
+                .add(stats) \
+                .hexdigest()
+            digest = self.index.get("digest")
+            if self.index.get("signature") != signature or \
+                    not os.path.exists(self.archive):
+                digest = self._create(files)
+                self.index.set("digest", digest, False)
+                self.index.set("signature", signature)
             else:
-                log_message = "Container {} run failed. [Duration: {}]". \
-                    format(
-                        self.name,
-                        Time(start_time).delta_in_hms())
-                LOG.error(log_message)
-                self.container["exit_code"] = 1
-                self.container["messages"].append(log_message)
-        except (
-                docker.errors.ContainerError,
-                docker.errors.ImageNotFound,
-                docker.errors.APIError) as error:
-            log_message = "Container {} run failed. [Duration: {}]". \
-                format(
-                    self.name,
-                    Time(start_time).delta_in_hms())
-            LOG.error(log_message)
-            self.container["exit_code"] = 1
-            self.container["messages"].append(log_message)
-            raise error
+                LOG.debug("Reusing build context of %s", self.path)
+            self.context = {"digest": digest, "files": files}
+            return self.context
 
 
-class _BuildDockerImage(Thread, _Verbose):
+class BuildCache(object):
+    """
+    Content addressed image build cache. The cache key is a digest of the
+    Dockerfile, the build arguments, the build context and the parent images
+    (if any). Built images are tagged with the digest and recorded in a
+    local index file.
+    """
 
-    def __init__(  # pylint: disable=R0913
-            self,
-            docker_client,
-            semaphore,
-            queue,
-            name,
-            config):
-        _Verbose.__init__(self)
-        Thread.__init__(self)
+    def __init__(self, config, build_context):
+        self.build_context = build_context
         self.config = config
-        self.docker_client = docker_client
-        self.image = dict({})
-        self.name = name
-        self.queue = queue
-        self.semaphore = semaphore
+        self.index = JsonIndex(
+            os.path.join(config["cache_dir"], "build_cache.json"))
 
-    def run(self):
-        self.semaphore.acquire()
-        try:
-            self._build()
-        finally:
-            self.queue.put({self.name: self.image})
-            self.semaphore.release()
+    def digest(self, dockerfile, parent_ids=None):
+        """
+        Get the cache key of a Dockerfile. The IDs of the parent images are
+        part of the key, so children are built again if a parent changed.
+        """
+        checksum = Checksum() \
+            .add_file(dockerfile) \
+            .add(self.config["docker_image_build_args"]) \
+            .add(self.build_context.digest())
+        if parent_ids:
+            checksum.add(parent_ids)
+        return checksum.hexdigest()
+
+    def get(self, docker_client, tag, digest):
+        """
+        Get the cached image for a digest. Returns None if the image is not
+        in the index or not present in the Docker daemon.
+        """
+        cached = self.index.get(digest)
+        if cached is None:
+            return None
+        try:
+            image = docker_client.images.get(self._tag(tag, digest))
+        except docker.errors.ImageNotFound:
+            return None
+        if image.id != cached["id"]:
+            return None
+        return image
+
+    def set(self, tag, digest, image):
+        """ Tag an image with the digest and add it to the index """
+        image.tag(tag, self._tag(None, digest))
+        self.index.set(digest, {"id": image.id, "tag": tag})
+
+    @staticmethod
+    def _tag(tag, digest):
+        _tag = "dtr-%s" % digest[:16]
+        if tag is not None:
+            return "%s:%s" % (tag, _tag)
+        return _tag
+
+
+class LayerCache(object):
+    """
+    A directory with the built images of the project (e.g. restored by the
+    CI cache on fresh runners). The files of the `docker save` archives are
+    stored once (content addressed and gzip compressed), so shared layers
+    of multiple images need the space only once. An image is loaded into
+    the Docker daemon before its build and passed as `cache_from`. The built
+    images are saved after the run.
+    """
+
+    tag = "dtr-layer-cache"
+
+    def __init__(self, config):
+        self.config = config
+        self.index = JsonIndex(
+            os.path.join(config["docker_layer_cache"], "index.json"))
+        self.lock = Lock()
+        self.locks = dict({})
+        self.path = config["docker_layer_cache"]
+
+    def load(self, docker_client, docker_host, image):
+        """
+        Load the cached image into a Docker daemon (once per daemon).
+        Returns the `cache_from` list of the build.
+        """
+        entry = self.index.get(image)
+        if entry is None:
+            return list([])
+        with self.lock:
+            lock = self.locks.setdefault((docker_host, image), Lock())
+        with lock:
+            cache_from = "%s:%s" % (entry["tag"], self.tag)
+            try:
+                docker_client.images.get(cache_from)
+                return [cache_from]
+            except docker.errors.ImageNotFound:
+                pass
+            start_time = time()
+            archive = self._archive(image)
+            try:
+                with TRACER.span("Load layer cache", "build", image=image):
+                    self._write(entry["members"], archive)
+                    with open(archive, "rb") as _archive:
+                        docker_client.images.load(_archive)
+            except (docker.errors.APIError, IOError, OSError) as error:
+                LOG.warning(
+                    "Loading image %s from the layer cache failed: %s",
+                    image,
+                    error)
+                return list([])
+            finally:
+                if os.path.exists(archive):
+                    os.remove(archive)
+            LOG.info(
+                "Image %s loaded from the layer cache. [Duration: %s]",
+                image,
+                Time(start_time).delta_in_hms())
+            return [cache_from]
+
+    def save(self, docker_clients, docker_images):
+        """
+        Save the successfully built images which are not in the cache yet
+        and remove the files which aren't used anymore.
+        """
+        for image, image_info in sorted(docker_images.iteritems()):
+            if image_info.get("exit_code") != 0 or \
+                    image_info.get("image_id") is None:
+                continue
+            entry = self.index.get(image)
+            if entry is not None and entry["id"] == image_info["image_id"]:
+                continue
+            self._save(
+                docker_clients.clients[image_info["docker_host"]],
+                image,
+                image_info["image_id"])
+        self._prune()
+
+    def _archive(self, image):
+        """
+        Create a temporary archive file. Unique per load or save (an image
+        can be loaded into multiple Docker daemons at the same time).
+        """
+        _makedirs(self.path)
+        _tmp_fd, _tmp_file = tempfile.mkstemp(
+            dir=self.path, prefix="%s." % image, suffix=".tar")
+        os.close(_tmp_fd)
+        return _tmp_file
+
+    def _blob(self, digest):
+        return os.path.join(self.path, "blobs", "%s.gz" % digest)
+
+    def _prune(self):
+        used = set(_member["digest"] for _, _entry in self.index.items()
+                   for _member in _entry["members"]
+                   if _member["digest"] is not None)
+        blobs = os.path.join(self.path, "blobs")
+        if not os.path.isdir(blobs):
+            return
+        for blob in os.listdir(blobs):
+            # Temporary files of parallel saves aren't blobs (yet)
+            if not blob.endswith(".gz"):
+                continue
+            if blob[:-len(".gz")] not in used:
+                os.remove(os.path.join(blobs, blob))
+
+    def _save(self, docker_client, image, image_id):
+        start_time = time()
+        tag = _image_tag(self.config, image)
+        archive = self._archive(image)
+        try:
+            with TRACER.span("Save layer cache", "build", image=image):
+                docker_client.images.get(image_id).tag(tag, self.tag)
+                with open(archive, "wb") as _archive:
+                    for chunk in docker_client.api.get_image(
+                            "%s:%s" % (tag, self.tag)):
+                        _archive.write(chunk)
+                members = self._store(archive)
+        except (docker.errors.APIError, IOError, OSError,
+                tarfile.TarError) as error:
+            LOG.warning(
+                "Saving image %s to the layer cache failed: %s",
+                image,
+                error)
+            return
+        finally:
+            if os.path.exists(archive):
+                os.remove(archive)
+        self.index.set(image, {"id": image_id,
+                               "members": members,
+                               "tag": tag})
+        LOG.info(
+            "Image %s saved to the layer cache. [Duration: %s]",
+            image,
+            Time(start_time).delta_in_hms())
+
+    def _store(self, archive):
+        """
+        Store the files of an archive as blobs. Returns the list of the
+        archive members.
+        """
+        members = list([])
+        _makedirs(os.path.join(self.path, "blobs"))
+        with tarfile.open(archive, "r") as _archive:
+            for member in _archive:
+                digest = None
+                if member.isfile():
+                    digest = self._store_file(_archive.extractfile(member))
+                members.append({
+                    "digest": digest,
+                    "linkname": member.linkname,
+                    "mode": member.mode,
+                    "mtime": member.mtime,
+                    "name": member.name,
+                    "size": member.size,
+                    "type": member.type})
+        return members
+
+    def _store_file(self, fileobj):
+        sha256 = hashlib.sha256()
+        # Unique in the blobs directory (which may be shared by parallel
+        # saves) and on the same file system for the rename
+        _tmp_fd, _tmp_file = tempfile.mkstemp(
+            dir=os.path.dirname(self._blob("tmp")), suffix=".tmp")
+        os.close(_tmp_fd)
+        with gzip.open(_tmp_file, "wb") as blob:
+            for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+                sha256.update(chunk)
+                blob.write(chunk)
+        digest = sha256.hexdigest()
+        if os.path.exists(self._blob(digest)):
+            os.remove(_tmp_file)
+        else:
+            os.rename(_tmp_file, self._blob(digest))
+        return digest
+
+    def _write(self, members, archive):
+        """ Write the archive of an image from its members and the blobs """
+        with tarfile.open(archive, "w") as _archive:
+            for member in members:
+                info = tarfile.TarInfo(member["name"].encode("utf-8"))
+                info.linkname = member["linkname"].encode("utf-8")
+                info.mode = member["mode"]
+                info.mtime = member["mtime"]
+                info.size = member["size"]
+                info.type = str(member["type"])
+                if member["digest"] is None:
+                    _archive.addfile(info)
+                    continue
+                with gzip.open(self._blob(member["digest"]), "rb") as blob:
+                    _archive.addfile(info, blob)
+
+
+class Prefetch(object):
+    """
+    Pull the base images (`FROM`) of the Dockerfiles before the image
+    builds, so the pulls are not part of the builds. Every base image is
+    pulled once per Docker daemon (in parallel with an own thread limit).
+    Base images which are already present are skipped.
+    """
+
+    def __init__(self, config, docker_clients):
+        self.config = config
+        self.docker_clients = docker_clients
+        self.lock = Lock()
+        self.queue = Queue()
+        self.results = {"failed": 0, "present": 0, "pulled": 0}
+
+    def run(self):
+        """ Pull the base images of all images which will be built """
+        bases = _image_graph(self.config).base_images(
+            self.config["docker_images"])
+        jobs = [(_host, _base)
+                for _host in sorted(self.docker_clients.clients.keys())
+                for _base in bases]
+        threads = min(int(self.config["prefetch_threads"]), len(jobs))
+        if threads < 1:
+            return
+        start_time = time()
+        LOG.info(
+            "Prefetch %s base image(s) with %s threads...",
+            len(bases),
+            threads)
+        for job in jobs:
+            self.queue.put(job)
+        workers = [Thread(target=self._worker, name="Prefetch-%s" % _index)
+                   for _index in range(1, threads + 1)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+        LOG.info(
+            "Base images pulled: %s, present: %s, failed: %s. "
+            "[Duration: %s]",
+            self.results["pulled"],
+            self.results["present"],
+            self.results["failed"],
+            Time(start_time).delta_in_hms())
+
+    def _pull(self, docker_host, base):
+        """ Pull a base image (if it's not present) """
+        docker_client = self.docker_clients.clients[docker_host]
+        try:
+            docker_client.images.get(base)
+            LOG.debug("Base image %s is present on %s.", base, docker_host)
+            return "present"
+        except docker.errors.ImageNotFound:
+            pass
+        start_time = time()
+        repository, tag = docker.utils.parse_repository_tag(base)
+        try:
+            with TRACER.span("Pull base image", "prefetch", image=base):
+                docker_client.images.pull(repository, tag=tag or "latest")
+        except docker.errors.APIError as error:
+            LOG.warning(
+                "Pulling base image %s on %s failed: %s",
+                base,
+                docker_host,
+                error)
+            return "failed"
+        LOG.info(
+            "Base image %s pulled on %s. [Duration: %s]",
+            base,
+            docker_host,
+            Time(start_time).delta_in_hms())
+        return "pulled"
+
+    def _worker(self):
+        TRACER.thread_name(current_thread().name)
+        while True:
+            try:
+                docker_host, base = self.queue.get_nowait()
+            except Empty:
+                return
+            result = self._pull(docker_host, base)
+            with self.lock:
+                self.results[result] += 1
+
+
+class ResultCache(object):
+    """
+    Cache of passed container runs. The cache key is a digest of the image
+    ID, the environment and the content of the mounted volumes.
+    """
+
+    def __init__(self, config):
+        self.index = JsonIndex(
+            os.path.join(config["cache_dir"], "result_cache.json"))
+        self.volumes = self._volumes(config["docker_container_volumes"])
+
+    def digest(self, container):
+        """ Get the cache key of a container run """
+        return Checksum() \
+            .add(container["image_id"]) \
+            .add(container["environment"]) \
+            .add(self.volumes) \
+            .hexdigest()
+
+    def get(self, digest):
+        """ Get the cached result for a digest (or None) """
+        return self.index.get(digest)
+
+    def set(self, digest, name):
+        """ Record a passed container run """
+        self.index.set(digest, {"exit_code": 0, "name": name})
+
+    @staticmethod
+    def _volumes(volumes):
+        """ Hash the bind mount sources (once, before any container runs) """
+        _volumes = dict({})
+        for source, volume in volumes.iteritems():
+            checksum = Checksum().add(volume)
+            if os.path.isdir(source):
+                checksum.add_directory(source)
+            elif os.path.isfile(source):
+                checksum.add_file(source)
+            _volumes[source] = checksum.hexdigest()
+        return _volumes
+
+
+class History(object):
+    """
+    Store the durations of image builds and container runs. The durations
+    are used to start the longest expected jobs first.
+    """
+
+    def __init__(self, config, path=None):
+        self.index = JsonIndex(
+            path or os.path.join(config["cache_dir"], "history.json"))
+
+    def expected(self, key):
+        """
+        Get the expected duration of a job. Jobs without history are
+        expected to take as long as the average job of the same kind.
+        """
+        history = self.index.get(key)
+        if history is not None:
+            return history["duration"]
+        kind = key.split(":")[0]
+        durations = [_history["duration"] for _key, _history in
+                     self.index.items() if _key.split(":")[0] == kind]
+        if bool(durations):
+            return sum(durations) / len(durations)
+        return 0.0
+
+    def expected_max(self, prefix):
+        """ Get the longest expected duration of all jobs with a prefix """
+        durations = [_history["duration"] for _key, _history in
+                     self.index.items() if _key.startswith(prefix)]
+        if bool(durations):
+            return max(durations)
+        return self.expected(prefix)
+
+    def known(self, key):
+        """ Check if there is a history for a job """
+        return self.index.get(key) is not None
+
+    def merge(self, history):
+        """
+        Merge the history of another run (a dictionary of history keys and
+        durations). The duration with the most runs is kept.
+        """
+        for key, value in history.iteritems():
+            current = self.index.get(key)
+            if current is None or value["runs"] > current["runs"]:
+                self.index.set(key, value, False)
+
+    def record(self, key, duration):
+        """
+        Record the duration of a job. The stored value is an exponentially
+        weighted moving average of the last durations.
+        """
+        history = self.index.get(key)
+        if history is not None:
+            duration = 0.5 * history["duration"] + 0.5 * duration
+            runs = history["runs"] + 1
+        else:
+            runs = 1
+        self.index.set(key, {"duration": duration, "runs": runs}, False)
+
+    def record_objects(self, objects, key):
+        """ Record the durations of all executed (not cached) objects """
+        for obj, obj_info in objects.iteritems():
+            if "duration" in obj_info and obj_info.get("cache") != "hit":
+                self.record(key(obj, obj_info), obj_info["duration"])
+
+    def save(self):
+        """ Write the history file """
+        self.index.save()
+
+    def select(self, keys):
+        """ Get the history of some jobs (as dictionary) """
+        return dict((_key, self.index.get(_key)) for _key in keys
+                    if self.known(_key))
+
+    @staticmethod
+    def container_key(image, env):
+        """ Get the history key of a container run """
+        return "container:%s:%s" % (image, env)
+
+    @staticmethod
+    def image_key(image):
+        """ Get the history key of an image build """
+        return "image:%s" % image
+
+
+class Plan(object):
+    """
+    Predict the schedule of a run based on the history. The prediction
+    simulates the build and run pools and the longest job first order.
+    """
+
+    def __init__(self, config, history):
+        self.config = config
+        self.history = history
+
+    def jobs(self):
+        """ Get all image builds and their container runs """
+        jobs = list([])
+        for image in self.config["docker_images"]:
+            containers = [History.container_key(image, env)
+                          for env, _ in _environments(self.config, image)]
+            jobs.append((History.image_key(image), containers))
+        return jobs
+
+    def simulate(self, build_only=False):
+        """
+        Simulate the run. Returns a list of (job, start, end) tuples and
+        the predicted makespan.
+        """
+        counter = itertools.count()
+        free = {"build": int(self.config["build_threads"]),
+                "run": int(self.config["run_threads"]),
+                "total": int(self.config["threads"])}
+        ready = {"build": list([]), "run": list([])}
+        running = list([])
+        schedule = list([])
+        containers = dict({})
+        graph = _image_graph(self.config)
+        images = dict({})
+        pending = dict({})
+        priorities = dict({})
+        now = 0.0
+        for image, _containers in self.jobs():
+            containers[image] = [] if build_only else _containers
+            priority = self.history.expected(image)
+            if bool(_containers) and not build_only:
+                priority += max(self.history.expected(_container)
+                                for _container in _containers)
+            priorities[image] = priority
+        for name in reversed(graph.order()):
+            image = History.image_key(name)
+            if image not in priorities:
+                continue
+            images[image] = name
+            pending[image] = len(graph.parents[name])
+            priorities[image] = max([priorities[image]] + [
+                self.history.expected(image) +
+                priorities[History.image_key(_child)]
+                for _child in graph.children[name]
+                if History.image_key(_child) in priorities])
+            if not pending[image]:
+                heapq.heappush(
+                    ready["build"],
+                    (-priorities[image], next(counter), image))
+        while ready["build"] or ready["run"] or running:
+            while free["total"] > 0:
+                kinds = [_kind for _kind in ("build", "run")
+                         if ready[_kind] and free[_kind] > 0]
+                if not bool(kinds):
+                    break
+                kind = min(kinds, key=lambda _kind: ready[_kind][0])
+                job = heapq.heappop(ready[kind])[2]
+                free[kind] -= 1
+                free["total"] -= 1
+                end = now + self.history.expected(job)
+                heapq.heappush(running, (end, next(counter), kind, job))
+                schedule.append((job, now, end))
+            now, _, kind, job = heapq.heappop(running)
+            free[kind] += 1
+            free["total"] += 1
+            for container in containers.get(job, list([])):
+                heapq.heappush(
+                    ready["run"],
+                    (-self.history.expected(container), next(counter),
+                     container))
+            for child in graph.children.get(images.get(job), list([])):
+                child = History.image_key(child)
+                if child not in pending:
+                    continue
+                pending[child] -= 1
+                if not pending[child]:
+                    heapq.heappush(
+                        ready["build"],
+                        (-priorities[child], next(counter), child))
+        return schedule, now
+
+
+class Shard(object):
+    """
+    Partition the image builds and container runs into shards, e.g. for
+    multiple CI nodes. The longest expected job is added to the shard which
+    is finished first. A shard builds all images which are required by its
+    container runs, so container runs of the same image tend to stay
+    together. Every node has to compute the same partitioning, so only the
+    configuration and a shared history (e.g. the history which is merged by
+    `--merge`) are used. Without a shared history every job is expected to
+    take the same time.
+    """
+
+    def __init__(self, config, history, index, total):
+        self.config = config
+        self.history = history
+        self.index = int(index)
+        self.total = int(total)
+        if self.total < 1 or not 0 <= self.index < self.total:
+            raise ValueError(
+                "Invalid shard index %s for %s shard(s)." %
+                (self.index, self.total))
+
+    def apply(self, build_only=False):
+        """ Restrict the configuration to the jobs of this shard """
+        images, containers = self.partition(build_only)[self.index]
+        self.config["docker_images"] = [
+            _image for _image in self.config["docker_images"]
+            if _image in images]
+        self.config["shard"] = [self.index, self.total]
+        self.config["shard_containers"] = containers
+        return images, containers
+
+    def expected(self, key):
+        """ Get the expected duration of a job (from the shared history) """
+        duration = 0.0
+        if self.history is not None:
+            duration = self.history.expected(key)
+        return duration or 1.0
+
+    def partition(self, build_only=False):
+        """
+        Partition all jobs. Returns a list of (images, containers) tuples,
+        one for each shard. The containers are (image, environment) tuples.
+        """
+        load = [0.0] * self.total
+        shards = [(set([]), set([])) for _ in range(self.total)]
+        builds = dict(
+            (_image, self.expected(History.image_key(_image)))
+            for _image in self.config["docker_images"])
+        runs = list([])
+        if not build_only:
+            for image in self.config["docker_images"]:
+                for env, _ in _environments(self.config, image):
+                    runs.append((
+                        -self.expected(History.container_key(image, env)),
+                        image,
+                        "%s" % env,
+                        env))
+        for duration, image, _, env in sorted(runs):
+            shard = min(
+                range(self.total),
+                key=lambda _shard, _image=image: (
+                    load[_shard] +
+                    (0.0 if _image in shards[_shard][0] else builds[_image]),
+                    _shard))
+            if image not in shards[shard][0]:
+                load[shard] += builds[image]
+                shards[shard][0].add(image)
+            load[shard] -= duration
+            shards[shard][1].add((image, env))
+        required = set(_image for _, _image, _, _ in runs)
+        for duration, image in sorted((-_duration, _image) for
+                                      _image, _duration in builds.iteritems()
+                                      if _image not in required):
+            shard = min(
+                range(self.total),
+                key=lambda _shard: (load[_shard], _shard))
+            load[shard] -= duration
+            shards[shard][0].add(image)
+        return shards
+
+
+class DockerClientPool(object):
+    """
+    Docker clients for one or more Docker daemons. Jobs are placed on the
+    least loaded daemon (the daemon with the least running jobs). Jobs are
+    pinned to daemons which have their images. Built images are transferred
+    (save/load) to all other daemons by separate transfer jobs, the daemons
+    are used for the container runs of an image as soon as the image is
+    loaded. The log output of the containers is streamed with separate
+    clients (`log_clients`), so the long running log requests are not using
+    the connections of the API calls.
+    """
+
+    def __init__(self, clients, log_clients=None):
+        self.clients = clients
+        self.condition = Condition(Lock())
+        self.images = dict((_host, set([])) for _host in clients)
+        self.load = dict((_host, 0) for _host in clients)
+        self.log_clients = log_clients or dict({})
+        self.pending = dict((_host, set([])) for _host in clients)
+        self.transfers = WorkerPool(max(1, len(clients) - 1), "Transfer")
+
+    def __len__(self):
+        return len(self.clients)
+
+    def acquire(self, image_ids=None):
+        """
+        Get the host and the client of the least loaded Docker daemon. If
+        image IDs are given only daemons which have all images are used (it
+        waits for the transfers if no daemon has all images yet).
+        """
+        image_ids = set([_id for _id in image_ids or list([]) if _id])
+        with self.condition:
+            while True:
+                hosts = [_host for _host in sorted(self.clients.keys())
+                         if self.images[_host].issuperset(image_ids)]
+                if bool(hosts) or not any(
+                        image_ids & _pending
+                        for _pending in self.pending.itervalues()):
+                    break
+                self.condition.wait()
+            hosts = hosts or sorted(self.clients.keys())
+            host = min(hosts, key=lambda _host: self.load[_host])
+            self.load[host] += 1
+            return host, self.clients[host]
+
+    def add_image(self, host, image):
+        """
+        Register an image on a Docker daemon and queue the transfers to all
+        other daemons.
+        """
+        with self.condition:
+            self.images[host].add(image.id)
+            hosts = [_host for _host in sorted(self.clients.keys())
+                     if image.id not in self.images[_host] and
+                     image.id not in self.pending[_host]]
+            for _host in hosts:
+                self.pending[_host].add(image.id)
+        for _host in hosts:
+            self.transfers.submit(_TransferImage(self, host, _host, image))
+
+    def cancel(self):
+        """ Skip the queued transfers """
+        self.transfers.cancel()
+
+    def join(self):
+        """ Wait until all transfers are done """
+        self.transfers.join()
+
+    def log_client(self, host):
+        """ Get the client for the log output of a Docker daemon """
+        return self.log_clients.get(host, self.clients[host])
+
+    def release(self, host):
+        """ Release a Docker daemon """
+        with self.condition:
+            self.load[host] -= 1
+
+    def transfer(self, source, target, image):
+        """ Transfer an image from one Docker daemon to another one """
+        start_time = time()
+        LOG.info("Transfer image %s from %s to %s...",
+                 image.short_id, source, target)
+        loaded = False
+        try:
+            with TRACER.span(
+                    "Transfer image", "transfer", image=image.short_id,
+                    source=source, target=target):
+                self.clients[target].images.load(image.save())
+            loaded = True
+        except (docker.errors.APIError,
+                requests.exceptions.RequestException) as error:
+            LOG.error("Transfer of image %s to %s failed: %s",
+                      image.short_id, target, error)
+        finally:
+            with self.condition:
+                self.pending[target].discard(image.id)
+                if loaded:
+                    self.images[target].add(image.id)
+                self.condition.notify_all()
+        if loaded:
+            LOG.info("Image %s transferred to %s. [Duration: %s]",
+                     image.short_id, target, Time(start_time).delta_in_hms())
+
+    def transfer_skipped(self, target, image):
+        """ Forget a transfer which was skipped """
+        with self.condition:
+            self.pending[target].discard(image.id)
+            self.condition.notify_all()
+
+
+class _TransferImage(object):
+    """
+    Transfer job of a built image. Transfers are executed in the worker pool
+    of the DockerClientPool and are not using the build threads.
+    """
+
+    kind = "Transfer"
+
+    def __init__(self, docker_clients, source, target, image):
+        self.deadline = None
+        self.docker_clients = docker_clients
+        self.image = image
+        self.name = "%s_%s" % (image.short_id.split(":")[-1], target)
+        self.priority = 0.0
+        self.source = source
+        self.target = target
+        self.watchdog = None
+
+    def cancel(self):
+        """ A running transfer can't be cancelled """
+
+    def run(self):
+        """ Transfer the image """
+        self.docker_clients.transfer(self.source, self.target, self.image)
+
+    def skip(self):
+        """ Skip the transfer """
+        LOG.debug("Transfer of image %s to %s skipped.",
+                  self.image.short_id, self.target)
+        self.docker_clients.transfer_skipped(self.target, self.image)
+
+
+class ContainerEvents(object):
+    """
+    Track the end of the container runs with one `/events` stream per Docker
+    daemon (`die` and `oom` events of the labeled containers of this run)
+    instead of a blocking `wait` request per container. If the stream of a
+    daemon fails, the container runs are falling back to `wait`. Only the
+    events of the running containers (see `add` and `remove`) are kept.
+    """
+
+    label = "docker_test_runner.run"
+
+    def __init__(self, docker_clients):
+        self.condition = Condition(Lock())
+        self.exit_codes = dict({})
+        self.failed = set([])
+        self.names = set([])
+        self.oom = set([])
+        self.run_id = "%s_%s" % (
+            os.getpid(),
+            random.SystemRandom().randrange(100000, 999999))
+        self.streams = dict({})
+        for host, docker_client in sorted(docker_clients.clients.items()):
+            try:
+                stream = docker_client.api.events(
+                    decode=True,
+                    filters={
+                        "event": ["die", "oom"],
+                        "label": "%s=%s" % (self.label, self.run_id),
+                        "type": "container"})
+            except (docker.errors.APIError,
+                    requests.exceptions.RequestException) as error:
+                LOG.warning(
+                    "Events of Docker host %s are not available: %s",
+                    host,
+                    error)
+                self.failed.add(host)
+                continue
+            self.streams[host] = stream
+            thread = Thread(
+                target=self._read,
+                args=(host, stream),
+                name="Events-%s" % host)
+            thread.daemon = True
+            thread.start()
+
+    def add(self, name):
+        """ Track the events of a container (before it's started) """
+        with self.condition:
+            self.names.add(name)
+
+    def close(self):
+        """ Close the event streams """
+        for stream in self.streams.itervalues():
+            try:
+                stream.close()
+            except (AttributeError, requests.exceptions.RequestException,
+                    socket.error):
+                pass
+        self.streams = dict({})
+
+    def labels(self):
+        """ Get the labels of the containers of this run """
+        return {self.label: self.run_id}
+
+    def remove(self, name):
+        """
+        Stop tracking the events of a container and drop the events which
+        were not waited for (e.g. of a cancelled container run)
+        """
+        with self.condition:
+            self.names.discard(name)
+            self.exit_codes.pop(name, None)
+            self.oom.discard(name)
+
+    def wait(self, docker_host, container):
+        """
+        Wait until a container has stopped. Returns the exit code and if the
+        container was out of memory.
+        """
+        with self.condition:
+            while container.name not in self.exit_codes and \
+                    docker_host not in self.failed:
+                self.condition.wait()
+            exit_code = self.exit_codes.pop(container.name, None)
+            oom = container.name in self.oom
+            self.oom.discard(container.name)
+        if exit_code is None:
+            exit_code = int(container.wait()["StatusCode"])
+        return exit_code, oom
+
+    def _read(self, host, stream):
+        TRACER.thread_name(current_thread().name)
+        try:
+            for event in stream:
+                attributes = event.get("Actor", dict({})).get(
+                    "Attributes", dict({}))
+                name = attributes.get("name")
+                with self.condition:
+                    if name not in self.names:
+                        continue
+                    if event.get("Action", event.get("status")) == "oom":
+                        self.oom.add(name)
+                    else:
+                        self.exit_codes[name] = int(
+                            attributes.get("exitCode", 1))
+                    self.condition.notify_all()
+        except (
+                docker.errors.APIError,
+                requests.exceptions.RequestException,
+                urllib3.exceptions.ProtocolError,
+                socket.error,
+                ValueError) as error:
+            LOG.debug("Events of Docker host %s failed: %s", host, error)
+        finally:
+            with self.condition:
+                self.failed.add(host)
+                self.condition.notify_all()
+
+
+class ContainerLog(object):
+    """
+    Write the output of a container run to a log file (with large buffered
+    writes). Only the last lines are kept in memory. The lines are passed to
+    `console` (if set) as well.
+    """
+
+    buffer_size = 64 * 1024
+
+    def __init__(self, path, tail, console=None):
+        self.console = console
+        self.lines = deque(maxlen=tail)
+        self.log_file = open(path, "wb", self.buffer_size)
+        self.partial = b""
+        self.path = path
+
+    def close(self):
+        """ Flush and close the log file """
+        if bool(self.partial):
+            self._lines([self.partial])
+            self.partial = b""
+        self.log_file.close()
+
+    def tail(self):
+        """ Get the last lines """
+        return [_line.decode("utf-8", "replace") for _line in self.lines]
+
+    def write(self, data):
+        """ Write a chunk of the output """
+        self.log_file.write(data)
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        if len(self.partial) > self.buffer_size:
+            lines.append(self.partial)
+            self.partial = b""
+        self._lines(lines)
+
+    def _lines(self, lines):
+        if self.console is not None:
+            for line in lines:
+                self.console(line)
+        self.lines.extend(lines[-self.lines.maxlen:])
+
+
+class ContainerLogs(object):
+    """
+    Create the log files of the container runs in `log_dir`. The log file
+    of a container run is named after the container (the image, the
+    environment and a random suffix), so multiple runs of the same image and
+    environment (e.g. of the watch mode or the daemon) are not writing to the
+    same file.
+    """
+
+    def __init__(self, config):
+        self.live_output = bool(config["live_output"])
+        self.log_dir = config["log_dir"]
+        if self.log_dir is None:
+            self.log_dir = os.path.join(config["cache_dir"], "logs")
+        self.log_tail = int(config["log_tail"])
+
+    def open(self, name, container, console=None):
+        """
+        Open the log file of a container run. The console is only used if
+        `live_output` is enabled.
+        """
+        _makedirs(self.log_dir)
+        path = os.path.join(self.log_dir, "%s.log" % name)
+        container["log_file"] = path
+        if not self.live_output:
+            console = None
+        return ContainerLog(path, self.log_tail, console)
+
+
+class ContainerPool(object):
+    """
+    Started containers which are reused for multiple container runs of the
+    same image. The image command is executed (exec) with the environment of
+    each run. A container is removed after `docker_container_reuse` runs or
+    after a failed run. Containers are only reused for runs with the same
+    resources (limits), since the limits are set when a container is started.
+    Only the creation and the start of a container are saved: the entrypoint
+    (including any setup it does) runs again for every run.
+    """
+
+    command = [
+        "/bin/sh",
+        "-c",
+        "trap 'exit 0' INT TERM; while true; do sleep 60 & wait $!; done"]
+
+    def __init__(self, config, workspace=None):
+        self.commands = dict({})
+        self.config = config
+        self.containers = dict({})
+        self.lock = Lock()
+        self.uses = dict({})
+        self.max_uses = int(config["docker_container_reuse"])
+        self.workspace = workspace
+
+    def acquire(self, docker_client, docker_host, container):
+        """
+        Get an idle container of the image (on a Docker host) or start a new
+        one. Returns the container and the command of the image.
+        """
+        key = self._key(docker_host, container)
+        with self.lock:
+            if self.containers.get(key):
+                return self.containers[key].pop(), self.commands[key]
+        image = docker_client.images.get(container["image_id"])
+        command = (image.attrs["Config"].get("Entrypoint") or list([])) + \
+            (image.attrs["Config"].get("Cmd") or list([]))
+        name = "%s_pool_%s" % (
+            container["image_name"],
+            random.SystemRandom().randrange(100000, 999999))
+        volumes = container["volumes"]
+        if self.workspace is not None:
+            volumes = self.workspace.create(name, volumes)
+        LOG.debug("Starting pool container %s...", name)
+        docker_container = docker_client.containers.run(
+            container["image"],
+            detach=True,
+            entrypoint=self.command,
+            name=name,
+            remove=True,
+            volumes=volumes,
+            **_limits(container["resources"]))
+        with self.lock:
+            self.commands[key] = command
+            self.uses[docker_container.id] = 0
+        return docker_container, command
+
+    def close(self):
+        """ Stop all idle containers """
+        with self.lock:
+            containers = [_container for _containers in
+                          self.containers.itervalues()
+                          for _container in _containers]
+            self.containers = dict({})
+        for container in containers:
+            self._stop(container)
+
+    def release(self, docker_host, container, docker_container, failed):
+        """
+        Give a container back to the pool. Failed or used up containers are
+        stopped (and removed).
+        """
+        key = self._key(docker_host, container)
+        with self.lock:
+            self.uses[docker_container.id] += 1
+            if not failed and \
+                    self.uses[docker_container.id] < self.max_uses:
+                self.containers.setdefault(key, list([])).append(
+                    docker_container)
+                return
+        self._stop(docker_container)
+
+    @staticmethod
+    def _key(docker_host, container):
+        return (docker_host, container["image_id"],
+                tuple(sorted(container["resources"].iteritems())))
+
+    def _stop(self, docker_container):
+        with self.lock:
+            del self.uses[docker_container.id]
+        LOG.debug("Stopping pool container %s...", docker_container.name)
+        try:
+            docker_container.stop(timeout=5)
+        except docker.errors.APIError as error:
+            LOG.debug(
+                "Stopping pool container %s failed: %s",
+                docker_container.name,
+                error)
+        if self.workspace is not None:
+            self.workspace.remove(docker_container.name)
+
+
+class Workspace(object):
+    """
+    Private copies of the writable (`rw`) volumes for every container, so
+    parallel container runs are not writing to the same host directory.
+    `copy` creates the copies in `cache_dir` (as reflinks where the file
+    system supports them), `tmpfs` in the memory backed `/dev/shm`. The
+    copies are removed after the container run.
+    """
+
+    modes = ["copy", "tmpfs"]
+
+    def __init__(self, config):
+        self.mode = config["docker_container_workspace"]
+        if self.mode not in self.modes:
+            raise ValueError(
+                "Invalid workspace mode \"%s\" (valid: %s)." %
+                (self.mode, ", ".join(self.modes)))
+        self.path = os.path.join(
+            os.path.abspath(config["cache_dir"]), "workspaces")
+        if self.mode == "tmpfs":
+            if os.path.isdir("/dev/shm"):
+                self.path = os.path.join("/dev/shm", "docker_test_runner")
+            else:
+                LOG.warning(
+                    "No tmpfs (/dev/shm) available, using %s for the "
+                    "workspaces.", self.path)
+
+    def create(self, name, volumes):
+        """
+        Copy the writable volumes of a container. Returns the volumes with
+        the copies as source.
+        """
+        path = os.path.join(self.path, name)
+        _volumes = dict({})
+        for index, (source, volume) in enumerate(sorted(volumes.items())):
+            if volume.get("mode", "rw") != "rw" or \
+                    not os.path.exists(source):
+                _volumes[source] = volume
+                continue
+            _makedirs(path)
+            copy = os.path.join(path, str(index))
+            with TRACER.span("Copy workspace", "container"):
+                self._copy(source, copy)
+            _volumes[copy] = volume
+        if os.path.isdir(path):
+            LOG.debug("Workspace of container %s: %s", name, path)
+        return _volumes
+
+    def remove(self, name):
+        """ Remove the copies of a container """
+        path = os.path.join(self.path, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, onerror=self._remove_error)
+
+    @staticmethod
+    def _copy(source, destination):
+        """ Copy a file or directory (as reflink if possible) """
+        try:
+            with open(os.devnull, "w") as devnull:
+                if subprocess.call(
+                        ["cp", "-a", "--reflink=auto", source, destination],
+                        stderr=devnull) == 0:
+                    return
+        except OSError:
+            pass
+        if os.path.isdir(destination):
+            shutil.rmtree(destination)
+        if os.path.isdir(source):
+            shutil.copytree(source, destination, symlinks=True)
+        else:
+            shutil.copy2(source, destination)
+
+    @staticmethod
+    def _remove_error(function, path, excinfo):
+        del function
+        LOG.warning("Removing workspace file %s failed: %s", path, excinfo[1])
+
+
+class _DockerThreadedObject(object):
+
+    def __init__(  # pylint: disable=R0913
+            self,
+            docker_clients,
+            semaphore,
+            config,
+            class_instance,
+            workers,
+            history=None,
+            history_key=None,
+            **kwargs):
+        self.class_instance = class_instance
+        self.class_kwargs = kwargs
+        self.history = history
+        self.history_key = history_key
+        self.config = config
+        self.docker_clients = docker_clients
+        self.objects = dict({})
+        self.pool = WorkerPool(workers, class_instance.kind)
+        self.on_failure = None
+        self.queue = Queue()
+        self.reported = 0
+        self.semaphore = semaphore
+        self.started = 0
+        self.timeout = None
+
+    def cancel(self):
+        """ Skip the queued objects and cancel the running objects """
+        self.pool.cancel()
+
+    def completed(self):
+        """
+        Yield the object name and the object information as soon as a
+        started object has finished.
+        """
+        while self.reported < self.started:
+            result = self.queue.get()
+            self.reported += 1
+            self.objects.update(result)
+            for obj, obj_info in result.iteritems():
+                yield obj, obj_info
+
+    def get(self, obj=None):
+        """ Get object informations (for an specific object) """
+        self._wait_for_queue()
+        if obj is not None:
+            try:
+                return self.objects[obj]
+            except KeyError as error:
+                raise error
+        return self.objects
+
+    def info(self):
+        """ Display complete object information """
+        print(dumps(self.get(), indent=4, sort_keys=True))
+
+    def join(self):
+        """ Wait until all started objects are finished """
+        self.pool.join()
+
+    def priority(self, obj):
+        """ Get the priority (the expected duration) of an object """
+        if self.history is None:
+            return 0.0
+        return self.history.expected(self.history_key(obj))
+
+    def run(self):
+        """ Start to run the threaded the object class """
+        self.start()
+        self.join()
+
+    def start(self, objs=None):
+        """
+        Queue all (or only the given) objects in the worker pool. The
+        objects with the longest expected duration are started first.
+        """
+        if objs is None:
+            objs = self.objects.keys()
+        for obj in sorted(objs, key=self.priority, reverse=True):
+            job = self.class_instance(
+                self.docker_clients,
+                self.semaphore,
+                self.queue,
+                obj,
+                self.objects[obj],
+                **self.class_kwargs)
+            job.on_failure = self.on_failure
+            job.priority = self.priority(obj)
+            if self.timeout:
+                job.timeout = float(self.timeout)
+            self.pool.submit(job)
+            self.started += 1
+
+    def _wait_for_queue(self):
+        while not self.queue.empty():
+            self.objects.update(self.queue.get())
+            self.reported += 1
+        self._validate()
+
+    def _validate(self):
+        if not bool(self.objects):
+            raise KeyError(
+                "%s: Object dictionary is empty." %
+                self.__class__.__name__)
+
+
+class DockerContainers(_DockerThreadedObject):
+    """ Create container configuration and give the possibility to run them """
+
+    def __init__(  # pylint: disable=R0913
+            self,
+            docker_clients,
+            semaphore,
+            config,
+            images=None,
+            history=None):
+        admission = None
+        container_events = None
+        container_pool = None
+        result_cache = None
+        workspace = None
+        if docker_clients is not None:
+            container_events = ContainerEvents(docker_clients)
+        if docker_clients is not None and Admission.enabled(config):
+            admission = Admission(
+                config,
+                [_client.info() for _client in
+                 docker_clients.clients.itervalues()])
+        if config["docker_container_workspace"]:
+            workspace = Workspace(config)
+        if config["docker_container_reuse"]:
+            container_pool = ContainerPool(config, workspace)
+        if config["docker_result_cache"]:
+            result_cache = ResultCache(config)
+        _DockerThreadedObject.__init__(
+            self,
+            docker_clients,
+            semaphore,
+            config,
+            _RunDockerContainer,
+            config["run_threads"],
+            history,
+            self._history_key,
+            admission=admission,
+            container_events=container_events,
+            container_logs=ContainerLogs(config),
+            container_pool=container_pool,
+            result_cache=result_cache,
+            workspace=workspace)
+        self.container_events = container_events
+        self.container_pool = container_pool
+        self.images = dict({}) if images is None else images
+        self.timeout = config["run_timeout"]
+        self._objects()
+
+    def add(self, image, image_info):
+        """
+        Add the container run configuration for a (successfully built) image.
+        Returns a list of the added container names.
+        """
+        self.images[image] = image_info
+        return self._image_objects(image)
+
+    def join(self):
+        """ Wait until all started objects are finished """
+        _DockerThreadedObject.join(self)
+        if self.container_pool is not None:
+            self.container_pool.close()
+        if self.container_events is not None:
+            self.container_events.close()
+
+    def _history_key(self, obj):
+        return History.container_key(
+            self.objects[obj]["image_name"],
+            self.objects[obj]["environment_name"])
+
+    def _objects(self):
+        """ Create the container run configuration """
+        for image in self.images.iterkeys():
+            self._image_objects(image)
+
+    def _image_objects(self, image):
+        """ Create the container run configuration for a single image """
+        containers = list([])
+        for env, env_settings in _environments(self.config, image):
+            _rand = random.SystemRandom().randrange(100000, 999999)
+            if env is not None:
+                container = "%s_%s_%s" % (
+                    image,
+                    env,
+                    _rand)
+            else:
+                container = "%s_%s" % (
+                    image,
+                    _rand)
+            self._container_object(container, image, env, env_settings)
+            containers.append(container)
+        return containers
+
+    def _container_object(self, container, image, env, environment):
+        self.objects[container] = dict({})
+        self.objects[container]["environment"] = environment
+        self.objects[container]["environment_name"] = env
+        self.objects[container]["image_name"] = image
+        self.objects[container]["image"] = self.images[image]["image"]
+        self.objects[container]["image_id"] = \
+            self.images[image].get("image_id")
+        self.objects[container]["messages"] = list([])
+        self.objects[container]["resources"] = _resources(
+            self.config, image, environment)
+        if "docker_container_volumes" in self.config:
+            self.objects[container]["volumes"] = \
+                self.config["docker_container_volumes"]
+
+
+class DockerImages(_DockerThreadedObject):
+    """ Create Docker images """
+
+    def __init__(self, docker_clients, semaphore, config, history=None):
+        build_cache = None
+        build_context = BuildContext(config)
+        if config["docker_build_cache"]:
+            build_cache = BuildCache(config, build_context)
+        self.layer_cache = None
+        if config["docker_layer_cache"]:
+            self.layer_cache = LayerCache(config)
+        self.built = set([])
+        self.graph = _image_graph(config)
+        self.image_ids = dict({})
+        _DockerThreadedObject.__init__(
+            self,
+            docker_clients,
+            semaphore,
+            config,
+            _BuildDockerImage,
+            config["build_threads"],
+            history,
+            History.image_key,
+            build_cache=build_cache,
+            build_context=build_context,
+            image_graph=self.graph,
+            image_ids=self.image_ids,
+            layer_cache=self.layer_cache)
+        self.timeout = config["build_timeout"]
+        self._objects()
+
+    def add_built(self, image, image_info):
+        """
+        Record a successfully built image. Returns the children which have
+        all parents built now.
+        """
+        self.built.add(image)
+        self.image_ids[image] = image_info.get("image_id")
+        return [_child for _child in self.graph.ready(image, self.built)
+                if _child in self.objects]
+
+    def cancel(self):
+        """
+        Skip the queued objects and image transfers and cancel the running
+        objects
+        """
+        _DockerThreadedObject.cancel(self)
+        if self.docker_clients is not None:
+            self.docker_clients.cancel()
+
+    def join(self):
+        """
+        Wait until all started objects and image transfers are finished and
+        save the built images to the layer cache (if any).
+        """
+        _DockerThreadedObject.join(self)
+        if self.docker_clients is not None:
+            self.docker_clients.join()
+        if self.layer_cache is not None:
+            self.layer_cache.save(self.docker_clients, self.objects)
+
+    def priority(self, obj):
+        """
+        Get the priority of an image build. This is the expected duration
+        of the build plus the longest expected container run of the image
+        or the highest priority of its children (the critical path).
+        """
+        if self.history is None:
+            return 0.0
+        return self.history.expected(self.history_key(obj)) + max(
+            [self.history.expected_max(History.container_key(obj, ""))] +
+            [self.priority(_child) for _child in self.graph.children[obj]
+             if _child in self.objects])
+
+    def roots(self):
+        """ Get the images without parents """
+        return [_image for _image in self.objects.keys()
+                if not self.graph.parents[_image]]
+
+    def skip_descendants(self, image):
+        """
+        Mark the descendants of a failed image as skipped. Returns the
+        skipped images.
+        """
+        skipped = list([])
+        for descendant in sorted(self.graph.descendants(image)):
+            if descendant not in self.objects or descendant in self.built:
+                continue
+            log_message = "Image {} skipped (parent image {} failed)." \
+                .format(descendant, image)
+            LOG.error(log_message)
+            self.objects[descendant] = {
+                "ended": time(),
+                "exit_code": 1,
+                "messages": [log_message],
+                "status": "skipped"}
+            skipped.append(descendant)
+        return skipped
+
+    def _objects(self):
+        for image in self.config["docker_images"]:
+            self.objects[image] = self.config
+
+
+class DockerPipeline(object):
+    """
+    Build Docker images and start the container runs of an image as soon as
+    the image build has finished. There is no barrier between the image
+    builds and the container runs. With `fail_fast` all queued and running
+    jobs are cancelled after the first failed job.
+    """
+
+    def __init__(self, images, containers=None, fail_fast=False):
+        self.containers = containers
+        self.failed = False
+        self.images = images
+        self.lock = Lock()
+        if fail_fast:
+            self.images.on_failure = self._failure
+            if containers is not None:
+                self.containers.on_failure = self._failure
+
+    def cancel(self):
+        """ Skip the queued jobs and cancel the running jobs """
+        self.images.cancel()
+        if self.containers is not None:
+            self.containers.cancel()
+
+    def run(self):
+        """
+        Build the images (parents before their children) and run the
+        containers (if any).
+        """
+        self.images.start(self.images.roots())
+        for image, image_info in self.images.completed():
+            if image_info.get("exit_code") == 0 and "image" in image_info:
+                self.images.start(self.images.add_built(image, image_info))
+            else:
+                self.images.skip_descendants(image)
+            if self.containers is None:
+                continue
+            if image_info.get("exit_code") == 0 and "image" in image_info:
+                LOG.debug("Dispatch container runs for image %s.", image)
+                self.containers.start(
+                    self.containers.add(image, image_info))
+            else:
+                LOG.error(
+                    "Build of image %s failed. Dropping the container runs.",
+                    image)
+        self.images.join()
+        if self.containers is not None:
+            self.containers.join()
+
+    def _failure(self, job):
+        with self.lock:
+            if self.failed:
+                return
+            self.failed = True
+        LOG.error(
+            "%s %s failed. Cancelling all remaining jobs (fail fast).",
+            job.kind,
+            job.name)
+        self.cancel()
+
+
+class _DockerJob(object):
+    """ Base class of the jobs which are executed in a WorkerPool """
+
+    kind = "Job"
+
+    def __init__(  # pylint: disable=R0913
+            self,
+            docker_clients,
+            semaphore,
+            queue,
+            name,
+            result):
+        self.cancelled = False
+        self.deadline = None
+        self.docker_client = None
+        self.docker_clients = docker_clients
+        self.docker_host = None
+        self.name = name
+        self.on_failure = None
+        self.priority = 0.0
+        self.queue = queue
+        self.queued = time()
+        self.result = result
+        self.semaphore = semaphore
+        self.timed_out = False
+        self.timeout = None
+        self.watchdog = None
+
+    def cancel(self):
+        """ Cancel the job """
+        self.cancelled = True
+
+    def expire(self):
+        """ Cancel the job because it exceeded the timeout """
+        self.timed_out = True
+        self.cancel()
+
+    def acquire_client(self, image_ids=None):
+        """
+        Acquire the Docker client of the least loaded Docker daemon (which
+        has the images).
+        """
+        self.docker_host, self.docker_client = \
+            self.docker_clients.acquire(image_ids)
+        self.result["docker_host"] = self.docker_host
+
+    def release_client(self):
+        """ Release the Docker client """
+        self.docker_clients.release(self.docker_host)
+
+    def report(self):
+        """
+        Report the result of the job. Failed jobs (which are not cancelled)
+        are passed to `on_failure`.
+        """
+        result = self.result
+        result.setdefault("exit_code", 1)
+        result["ended"] = time()
+        result["queued"] = self.queued
+        if self.cancelled:
+            result["status"] = self.state()
+        if result["exit_code"] != 0 and self.on_failure is not None and \
+                (self.timed_out or not self.cancelled):
+            self.on_failure(self)
+        self.queue.put({self.name: result})
+
+    def skip(self):
+        """ Report the job as cancelled without executing it """
+        self.cancelled = True
+        log_message = "{} {} cancelled.".format(self.kind, self.name)
+        LOG.warning(log_message)
+        result = self.result
+        result["exit_code"] = 1
+        result["messages"].append(log_message)
+        self.report()
+
+    def begin(self):
+        """ Mark the job as started and start its timeout (if any) """
+        self.result["started"] = time()
+        if self.timeout and self.watchdog is not None:
+            self.deadline = self.watchdog.add(self)
+
+    def state(self):
+        """ Get the reason why the job was cancelled """
+        if self.timed_out:
+            return "timed out"
+        return "cancelled"
+
+
+class _RunDockerContainer(_DockerJob):
+
+    kind = "Container"
+
+    def __init__(  # pylint: disable=R0913
+            self,
+            docker_clients,
+            semaphore,
+            queue,
+            name,
+            config,
+            admission=None,
+            container_events=None,
+            container_logs=None,
+            container_pool=None,
+            result_cache=None,
+            workspace=None):
+        _DockerJob.__init__(
+            self,
+            docker_clients,
+            semaphore,
+            queue,
+            name,
+            config)
+        self.admission = admission
+        self.color = Color()
+        self.container = config
+        self.container_events = container_events
+        self.container_logs = container_logs
+        self.container_pool = container_pool
+        self.docker_container = None
+        self.result_cache = result_cache
+        self.workspace = workspace
+
+    def cancel(self):
+        """ Cancel the job and kill the running container """
+        _DockerJob.cancel(self)
+        if self.docker_container is not None:
+            try:
+                self.docker_container.kill()
+            except docker.errors.APIError as error:
+                LOG.debug("Killing container %s failed: %s", self.name, error)
+
+    def run(self):
+        digest = None
+        if self.result_cache is not None:
+            digest = self.result_cache.digest(self.container)
+            LOG.debug("Result cache key of container %s: %s",
+                      self.name, digest)
+            if self.result_cache.get(digest) is not None:
+                self._cached_pass()
+                self.report()
+                return
+            self.container["cache"] = "miss"
+        resources = None
+        if self.admission is not None:
+            with TRACER.span("Wait for resources", "semaphore"):
+                resources = self.admission.acquire(
+                    self.container["resources"],
+                    self.priority)
+        with TRACER.span("Wait for thread", "semaphore"):
+            self.semaphore.acquire(self.priority)
+        if self.cancelled:
+            self.semaphore.release()
+            if resources is not None:
+                self.admission.release(resources)
+            self.skip()
+            return
+        self.begin()
+        start_time = time()
+        with TRACER.span("Acquire Docker client", "client"):
+            self.acquire_client([self.container["image_id"]])
+        try:
+            self._run_container()
+            self.container["duration"] = Time(start_time).delta
+            if digest is not None and self.container["exit_code"] == 0:
+                self.result_cache.set(digest, self.name)
+        finally:
+            self.release_client()
+            self.report()
+            self.semaphore.release()
+            if resources is not None:
+                self.admission.release(resources)
+
+    def _cached_pass(self):
+        self.container["started"] = time()
+        log_message = "Container {} run skipped. [Result: cached pass]". \
+            format(self.name)
+        LOG.info(log_message)
+        self.container["cache"] = "hit"
+        self.container["exit_code"] = 0
+        self.container["messages"].append(log_message)
+
+    def _exec_container(self, container_log):
+        """ Run the image command in a container of the container pool """
+        with TRACER.span("Acquire pooled container", "container"):
+            container, command = self.container_pool.acquire(
+                self.docker_client,
+                self.docker_host,
+                self.container)
+        exit_code = 1
+        try:
+            LOG.info(
+                "Executing container %s in %s...",
+                self.name,
+                container.name)
+            self.docker_container = container
+            if self.cancelled:
+                self.cancel()
+            with TRACER.span("Create exec", "container"):
+                exec_id = self.docker_client.api.exec_create(
+                    container.id,
+                    command,
+                    environment=self.container["environment"],
+                    stderr=True,
+                    stdout=True)["Id"]
+            with TRACER.span("Stream exec output", "container"):
+                for chunk in self.docker_client.api.exec_start(
+                        exec_id,
+                        stream=True):
+                    container_log.write(chunk)
+            with TRACER.span("Inspect exec", "container"):
+                exit_code = int(
+                    self.docker_client.api.exec_inspect(exec_id)["ExitCode"])
+        finally:
+            self.container_pool.release(
+                self.docker_host,
+                self.container,
+                container,
+                exit_code != 0 or self.cancelled)
+        return exit_code
+
+    def _run_container(self):
+        start_time = time()
+        color = random.SystemRandom().choice(self.color.colors())
+        container_log = self.container_logs.open(
+            self.name,
+            self.container,
+            lambda _line: LOG.info(self.color.cstring(_line.strip(), color)))
+        try:
+            if self.container_pool is not None:
+                self.container["exit_code"] = self._exec_container(
+                    container_log)
+            else:
+                self.container["exit_code"] = self._start_container(
+                    container_log)
+            if self.cancelled:
+                log_message = "Container {} run {}. [Duration: {}]". \
+                    format(
+                        self.name,
+                        self.state(),
+                        Time(start_time).delta_in_hms())
+                LOG.error(log_message)
+                self.container["exit_code"] = 1
+                self.container["messages"].append(log_message)
+            elif self.container["exit_code"] == 0:
+                log_message = "Container {} run succeeded. [Duration: {}]". \
+                    format(
+                        self.name,
+                        Time(start_time).delta_in_hms())
+                LOG.info(log_message)
+                self.container["messages"].append(log_message)
+            else:
+                log_message = "Container {} run failed. [Duration: {}]". \
+                    format(
+                        self.name,
+                        Time(start_time).delta_in_hms())
+                LOG.error(log_message)
+                self.container["exit_code"] = 1
+                self.container["messages"].append(log_message)
+        except (
+                docker.errors.ContainerError,
+                docker.errors.ImageNotFound,
+                docker.errors.APIError) as error:
+            log_message = "Container {} run failed. [Duration: {}]". \
+                format(
+                    self.name,
+                    Time(start_time).delta_in_hms())
+            LOG.error(log_message)
+            self.container["exit_code"] = 1
+            self.container["messages"].append(log_message)
+            raise error
+        finally:
+            container_log.close()
+            if self.container.get("exit_code", 1) != 0:
+                self.container["log_tail"] = container_log.tail()
+
+    def _start_container(self, container_log):
+        """ Run the image command in a new container """
+        labels = None
+        if self.container_events is not None:
+            labels = self.container_events.labels()
+            self.container_events.add(self.name)
+        volumes = self.container["volumes"]
+        if self.workspace is not None:
+            volumes = self.workspace.create(self.name, volumes)
+        try:
+            LOG.info("Starting container %s...", self.name)
+            with TRACER.span("Start container", "container"):
+                container = self.docker_client.containers.run(
+                    self.container["image"],
+                    detach=True,
+                    environment=self.container["environment"],
+                    labels=labels,
+                    name=self.name,
+                    remove=True,
+                    stderr=True,
+                    stdout=True,
+                    volumes=volumes,
+                    **_limits(self.container["resources"]))
+            self.docker_container = container
+            if self.cancelled:
+                self.cancel()
+            with TRACER.span("Stream container output", "container"):
+                for chunk in self.docker_clients.log_client(
+                        self.docker_host).api.logs(
+                            container.id,
+                            follow=True,
+                            stream=True):
+                    container_log.write(chunk)
+            with TRACER.span("Wait for container", "container"):
+                if self.container_events is None:
+                    return int(container.wait()["StatusCode"])
+                exit_code, oom = self.container_events.wait(
+                    self.docker_host,
+                    container)
+            if oom:
+                log_message = "Container {} ran out of memory.".format(
+                    self.name)
+                LOG.error(log_message)
+                self.container["messages"].append(log_message)
+                self.container["oom"] = True
+            return exit_code
+        finally:
+            if self.container_events is not None:
+                self.container_events.remove(self.name)
+            if self.workspace is not None:
+                self.workspace.remove(self.name)
+
+
+class _BuildDockerImage(_DockerJob):
+
+    kind = "Image"
+
+    def __init__(  # pylint: disable=R0913
+            self,
+            docker_clients,
+            semaphore,
+            queue,
+            name,
+            config,
+            build_cache=None,
+            build_context=None,
+            image_graph=None,
+            image_ids=None,
+            layer_cache=None):
+        self.image = dict({})
+        self.image["messages"] = list([])
+        _DockerJob.__init__(
+            self,
+            docker_clients,
+            semaphore,
+            queue,
+            name,
+            self.image)
+        self.build_cache = build_cache
+        self.build_context = build_context
+        self.config = config
+        self.image_graph = image_graph
+        self.image_ids = image_ids
+        self.layer_cache = layer_cache
+        self.response = None
+
+    def cancel(self):
+        """ Cancel the job and abort the running build """
+        _DockerJob.cancel(self)
+        self._abort()
+
+    def run(self):
+        with TRACER.span("Wait for thread", "semaphore"):
+            self.semaphore.acquire(self.priority)
+        if self.cancelled:
+            self.semaphore.release()
+            self.skip()
+            return
+        self.begin()
+        start_time = time()
+        with TRACER.span("Acquire Docker client", "client"):
+            self.acquire_client(self._parent_ids())
+        try:
+            self._build()
+        finally:
+            self.release_client()
+            self.image["duration"] = Time(start_time).delta
+            self.report()
+            self.semaphore.release()
 
     def _build(self):
         start_time = time()
@@ -493,65 +3211,1745 @@ class _BuildDockerImage(Thread, _Verbose):
             (self.config["docker_image_path"],
              self.name)
         LOG.debug("Using Dockerfile: %s", dockerfile)
-        self.image["messages"] = list([])
         try:
-            LOG.info("Build %s image...", self.name)
-            LOG.debug(
-                "Build information:\nbuildargs: %s\ndockerfile: %s\npath: %s",
-                self.config["docker_image_build_args"],
-                dockerfile,
-                self.config["docker_image_path"])
-            project_name = None
-            _tag = "%s" % self.name
-            if self.config["project_name"] is not None:
-                project_name = SearchAndReplace(
-                    "[^0-9a-zA-Z]+",
-                    "_").in_str(
-                        self.config["project_name"],
-                        True)
-                _tag = "%s_%s" % (project_name, self.name)
-            tag = _tag.lower()
-            image, build_logs = self.docker_client.images.build(
-                buildargs=self.config["docker_image_build_args"],
-                dockerfile=dockerfile,
-                path=self.config["docker_image_path"],
-                rm=bool(self.config["docker_remove_images"]),
-                tag=tag)
-            del build_logs
-            LOG.debug("ID of image %s: %s", self.name, image.short_id)
-            self.image["image"] = image.short_id
-            log_message = "{} image created. [Duration: {}]" \
-                .format(self.name, Time(start_time).delta_in_hms())
-            LOG.info(log_message)
-            self.image["exit_code"] = 0
-            self.image["messages"].append(log_message)
-        except (
-                docker.errors.BuildError,
-                docker.errors.APIError,
-                TypeError) as error:
-            log_message = "Build image {} failed. [Duration: {}]" \
-                .format(self.name, Time(start_time).delta_in_hms())
-            LOG.error(log_message)
-            self.image["exit_code"] = 1
-            self.image["messages"].append(log_message)
-            raise error
+            LOG.info("Build %s image...", self.name)
+            LOG.debug(
+                "Build information:\nbuildargs: %s\ndockerfile: %s\npath: %s",
+                self.config["docker_image_build_args"],
+                dockerfile,
+                self.config["docker_image_path"])
+            tag = _image_tag(self.config, self.name)
+            image = None
+            if self.build_cache is not None:
+                with TRACER.span("Build cache lookup", "build"):
+                    digest = self.build_cache.digest(
+                        dockerfile,
+                        self._parent_ids())
+                    image = self.build_cache.get(
+                        self.docker_client, tag, digest)
+                LOG.debug("Build cache key of image %s: %s", self.name, digest)
+                self.image["cache"] = "hit" if image is not None else "miss"
+            if image is None:
+                cache_from = list([])
+                if self.layer_cache is not None:
+                    cache_from = self.layer_cache.load(
+                        self.docker_client,
+                        self.docker_host,
+                        self.name)
+                with TRACER.span("Open build context", "build"):
+                    context = self.build_context.open()
+                with context:
+                    image = self._build_image(context, tag, cache_from)
+                if self.build_cache is not None and image is not None:
+                    self.build_cache.set(tag, digest, image)
+                log_message = "{} image created. [Duration: {}]"
+            else:
+                image.tag(tag)
+                log_message = "{} image reused from build cache. " \
+                    "[Duration: {}]"
+            if self.cancelled:
+                log_message = "Build image {} {}. [Duration: {}]" \
+                    .format(self.name, self.state(),
+                            Time(start_time).delta_in_hms())
+                LOG.error(log_message)
+                self.image["exit_code"] = 1
+                self.image["messages"].append(log_message)
+                return
+            LOG.debug("ID of image %s: %s", self.name, image.short_id)
+            self.docker_clients.add_image(self.docker_host, image)
+            self.image["image"] = image.short_id
+            self.image["image_id"] = image.id
+            log_message = log_message \
+                .format(self.name, Time(start_time).delta_in_hms())
+            LOG.info(log_message)
+            self.image["exit_code"] = 0
+            self.image["messages"].append(log_message)
+        except (
+                docker.errors.BuildError,
+                docker.errors.APIError,
+                IOError,
+                TypeError) as error:
+            log_message = "Build image {} failed. [Duration: {}]" \
+                .format(self.name, Time(start_time).delta_in_hms())
+            LOG.error(log_message)
+            self.image["exit_code"] = 1
+            self.image["messages"].append(log_message)
+            raise error
+
+    def _parent_ids(self):
+        """ Get the image IDs of the parent images """
+        if self.image_graph is None:
+            return list([])
+        return [self.image_ids.get(_parent) for _parent in
+                sorted(self.image_graph.parents[self.name])]
+
+    def _abort(self):
+        """
+        Shut down the connection of the running build, so a build which
+        doesn't send any output is aborted as well
+        """
+        response = self.response
+        if response is None:
+            return
+        try:
+            response.raw.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error) as error:
+            LOG.debug("Aborting build %s failed: %s", self.name, error)
+
+    def _build_image(self, context, tag, cache_from=None):
+        """
+        Build the image. The build is aborted (the connection to the Docker
+        daemon is shut down) when the job is cancelled. Returns None if the
+        build was aborted.
+        """
+        image_id = None
+        _BUILD_RESPONSE.response = None
+        stream = self.docker_client.api.build(
+            buildargs=self.config["docker_image_build_args"],
+            cache_from=cache_from or None,
+            custom_context=True,
+            decode=True,
+            dockerfile="Dockerfile_%s" % self.name,
+            fileobj=context,
+            rm=bool(self.config["docker_remove_images"]),
+            tag=tag,
+            timeout=float(self.timeout) if self.timeout else None)
+        self.response = _BUILD_RESPONSE.response
+        if self.cancelled:
+            self._abort()
+        try:
+            with TRACER.span("Stream build output", "build"):
+                for chunk in stream:
+                    if self.cancelled:
+                        return None
+                    if "error" in chunk:
+                        raise docker.errors.BuildError(chunk["error"], [chunk])
+                    match = re.search(
+                        r"(^Successfully built |sha256:)([0-9a-f]+)$",
+                        chunk.get("stream", ""))
+                    if match:
+                        image_id = match.group(2)
+        except (requests.exceptions.RequestException,
+                urllib3.exceptions.ProtocolError,
+                urllib3.exceptions.ReadTimeoutError) as error:
+            if isinstance(error, urllib3.exceptions.ReadTimeoutError):
+                # The read timeout is the build timeout
+                self.expire()
+            if self.cancelled:
+                return None
+            raise docker.errors.BuildError(error, list([]))
+        finally:
+            self.response = None
+            stream.close()
+        if self.cancelled:
+            return None
+        if image_id is None:
+            raise docker.errors.BuildError("Unknown image ID", list([]))
+        with TRACER.span("Get image", "build"):
+            return self.docker_client.images.get(image_id)
+
+
+class _AsyncHTTPRequest(asyncore.dispatcher):
+    """
+    A single HTTP/1.1 request on a unix socket. The response body is passed
+    to `on_data` (if set) while it is received. `on_done` is called with
+    the status code (None on connection errors) and the collected body.
+    """
+
+    def __init__(  # pylint: disable=R0913
+            self,
+            socket_map,
+            socket_path,
+            request,
+            on_data=None,
+            on_done=None):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.body = list([])
+        self.buffer = b""
+        self.chunk_size = None
+        self.chunked = False
+        self.finished = False
+        self.headers = dict({})
+        self.length = None
+        self.on_data = on_data
+        self.on_done = on_done
+        self.outgoing = request
+        self.received = 0
+        self.sent = 0
+        self.status = None
+        self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addr = socket_path
+        self._connect()
+
+    def abort(self):
+        """ Close the connection and finish the request """
+        self.status = None
+        self._finish()
+
+    def handle_close(self):
+        self._finish()
+
+    def handle_connect(self):
+        pass
+
+    def handle_error(self):
+        LOG.debug("HTTP request failed.", exc_info=True)
+        self.status = None
+        self._finish()
+
+    def handle_read(self):
+        data = self.recv(1024 * 64)
+        if data:
+            self._feed(data)
+
+    def handle_write(self):
+        for index, chunk in enumerate(self.outgoing):
+            if self.sent < len(chunk):
+                self.sent += self.send(buffer(chunk, self.sent, 1024 * 64))
+                return
+            self.outgoing = self.outgoing[index + 1:]
+            self.sent = 0
+            return
+
+    def readable(self):
+        return self.connected
+
+    def writable(self):
+        if not self.connected and not self.finished:
+            self._connect()
+        return self.connected and bool(self.outgoing)
+
+    def _connect(self):
+        """
+        Connect without blocking the event loop. A connect on a unix socket
+        fails with EAGAIN while the listen backlog of the Docker daemon is
+        full, then it's retried on the next iteration of the loop.
+        """
+        error = self.socket.connect_ex(self.addr)
+        if error in (errno.EAGAIN, errno.EINPROGRESS):
+            return
+        if error not in (0, errno.EISCONN):
+            LOG.debug("Connection to %s failed: %s", self.addr,
+                      os.strerror(error))
+            self._finish()
+            return
+        self.handle_connect_event()
+
+    def _data(self, data):
+        if self.on_data is not None:
+            self.on_data(data)
+        else:
+            self.body.append(data)
+
+    def _feed(self, data):
+        self.buffer += data
+        if self.status is None:
+            if b"\r\n\r\n" not in self.buffer:
+                return
+            head, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+            lines = head.split(b"\r\n")
+            self.status = int(lines[0].split(b" ")[1])
+            for line in lines[1:]:
+                key, _, value = line.partition(b":")
+                self.headers[key.strip().lower()] = value.strip()
+            self.chunked = \
+                self.headers.get(b"transfer-encoding") == b"chunked"
+            if b"content-length" in self.headers:
+                self.length = int(self.headers[b"content-length"])
+        if self.chunked:
+            self._feed_chunked()
+            return
+        if self.buffer:
+            self.received += len(self.buffer)
+            self._data(self.buffer)
+            self.buffer = b""
+        if self.length is not None and self.received >= self.length:
+            self._finish()
+
+    def _feed_chunked(self):
+        while not self.finished:
+            if self.chunk_size is None:
+                if b"\r\n" not in self.buffer:
+                    return
+                line, self.buffer = self.buffer.split(b"\r\n", 1)
+                self.chunk_size = int(line.split(b";")[0], 16)
+                if self.chunk_size == 0:
+                    self._finish()
+                    return
+            if len(self.buffer) < self.chunk_size + 2:
+                return
+            chunk = self.buffer[:self.chunk_size]
+            self.buffer = self.buffer[self.chunk_size + 2:]
+            self.chunk_size = None
+            self._data(chunk)
+
+    def _finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.close()
+        if self.on_done is not None:
+            self.on_done(self.status, b"".join(self.body))
+
+
+class AsyncDockerAPI(object):
+    """
+    Minimal asynchronous client for the Docker Engine API on a unix socket.
+    All requests are multiplexed on one asyncore event loop.
+    """
+
+    def __init__(self, socket_path, version=None):
+        self.socket_map = dict({})
+        self.socket_path = socket_path
+        self.version = version or docker.constants.DEFAULT_DOCKER_API_VERSION
+
+    def busy(self):
+        """ Check if there are open requests """
+        return bool(self.socket_map)
+
+    def info(self):
+        """ Get the system information of the Docker daemon (blocking) """
+        response = dict({})
+
+        def _on_done(status, info):
+            response["status"] = status
+            response["info"] = info
+        self.json("GET", "/info", _on_done)
+        while self.busy():
+            self.loop()
+        if response.get("status") != 200:
+            raise docker.errors.DockerException(
+                "Docker daemon on %s is not reachable." % self.socket_path)
+        return response["info"]
+
+    def json(  # pylint: disable=R0913
+            self,
+            method,
+            url,
+            callback,
+            params=None,
+            data=None):
+        """
+        Send a request with an (optional) JSON body. The callback is called
+        with the status code and the decoded JSON response.
+        """
+        def _on_done(status, body):
+            try:
+                response = loads(body) if body else None
+            except ValueError:
+                response = body
+            callback(status, response)
+        body = b""
+        headers = dict({})
+        if data is not None:
+            body = dumps(data)
+            headers["Content-Type"] = "application/json"
+        return self.request(
+            method,
+            url,
+            params=params,
+            body=body,
+            headers=headers,
+            on_done=_on_done)
+
+    def loop(self, timeout=1.0):
+        """ Process the events of the open requests (one iteration) """
+        if not all(_request.connected for _request in
+                   self.socket_map.itervalues()):
+            # Retry the pending connects soon
+            timeout = min(timeout, 0.05)
+        asyncore.loop(
+            timeout=timeout,
+            use_poll=True,
+            map=self.socket_map,
+            count=1)
+
+    def ping(self):
+        """ Ping the Docker daemon (blocking) """
+        response = dict({})
+
+        def _on_done(status, body):
+            response["status"] = status
+            response["body"] = body
+        self.request("GET", "/_ping", on_done=_on_done)
+        while self.busy():
+            self.loop()
+        if response.get("status") != 200:
+            raise docker.errors.DockerException(
+                "Docker daemon on %s is not reachable." % self.socket_path)
+        return True
+
+    def request(  # pylint: disable=R0913
+            self,
+            method,
+            url,
+            params=None,
+            body=b"",
+            headers=None,
+            on_data=None,
+            on_done=None):
+        """ Send a request. Returns the request (which can be aborted). """
+        path = "/v%s%s" % (self.version, url)
+        if params:
+            path = "%s?%s" % (path, urlencode(params))
+        head = [
+            "%s %s HTTP/1.1" % (method, path),
+            "Host: docker",
+            "Connection: close",
+            "Content-Length: %s" % len(body)]
+        for key, value in (headers or dict({})).iteritems():
+            head.append("%s: %s" % (key, value))
+        request = [b"\r\n".join(head) + b"\r\n\r\n", body]
+        return _AsyncHTTPRequest(
+            self.socket_map,
+            self.socket_path,
+            [_part.encode("utf-8") if isinstance(_part, unicode) else _part
+             for _part in request],
+            on_data,
+            on_done)
+
+
+class AsyncEngine(object):  # pylint: disable=R0902
+    """
+    Build the images and run the containers on a single event loop. The
+    object configuration (DockerImages, DockerContainers) is the same as for
+    the threaded engine, but there is no thread per job. The limits of
+    `threads`, `build_threads` and `run_threads` are applied to the amount
+    of parallel builds and container runs. Timeouts and `fail_fast` are
+    applied by aborting the build requests and killing the containers.
+    """
+
+    def __init__(self, api, config, images, containers=None):
+        self.admission = None
+        self.admitted = dict({})
+        self.api = api
+        self.cancels = dict({})
+        self.color = Color()
+        self.config = config
+        self.containers = containers
+        self.context = None
+        self.counter = itertools.count()
+        self.deadlines = list([])
+        self.failed = False
+        self.images = images
+        self.queued = dict({})
+        self.limits = {"build": int(config["build_threads"]),
+                       "run": int(config["run_threads"]),
+                       "total": int(config["threads"])}
+        self.ready = {"build": list([]), "run": list([])}
+        self.result_cache = None
+        self.container_logs = None
+        self.workspace = None
+        if containers is not None:
+            self.container_logs = containers.class_kwargs["container_logs"]
+            self.result_cache = containers.class_kwargs.get("result_cache")
+            self.workspace = containers.class_kwargs.get("workspace")
+            if Admission.enabled(config):
+                self.admission = Admission(config, [api.info()])
+        self.running = {"build": 0, "run": 0}
+        self.slots = {"build": dict({}), "run": dict({})}
+        self.timeouts = {"build": config["build_timeout"],
+                         "run": config["run_timeout"]}
+
+    def run(self):
+        """
+        Build the images and run the containers. Returns the image and the
+        container objects.
+        """
+        with TRACER.span("Read build context", "build"):
+            self.context = self.images.class_kwargs["build_context"].read()
+        for image in self.images.roots():
+            self._queue("build", image, self.images.priority(image))
+        while self.ready["build"] or self.ready["run"] or self.api.busy():
+            self._dispatch()
+            if self.api.busy():
+                self.api.loop()
+            self._expire()
+        containers = dict({})
+        if self.containers is not None:
+            containers = self.containers.objects
+        return self.images.objects, containers
+
+    def _admit(self, name):
+        """ Take the resources of a container run (if there is admission) """
+        if self.admission is None:
+            return True
+        resources = self.admission.admit(
+            self.containers.objects[name]["resources"])
+        if resources is None:
+            return False
+        self.admitted[name] = resources
+        return True
+
+    def _build(self, image):
+        start_time = time()
+        result = dict({})
+        result["messages"] = list([])
+        result["queued"] = self.queued.pop(image)
+        result["started"] = start_time
+        state = {"buffer": b"", "cancelled": None, "error": None, "id": None}
+        _log(image, logging.INFO, "Build %s image...", image)
+
+        def _on_data(data):
+            state["buffer"] += data
+            lines = state["buffer"].split(b"\n")
+            state["buffer"] = lines.pop()
+            for line in lines:
+                self._build_event(image, state, line)
+
+        def _cancel(reason):
+            state["cancelled"] = reason
+            request.abort()
+
+        def _on_done(status, body):
+            del body
+            self.cancels.pop(image, None)
+            self._build_event(image, state, state["buffer"])
+            if status != 200 and state["error"] is None:
+                state["error"] = "HTTP status %s" % status
+            self.running["build"] -= 1
+            result["duration"] = Time(start_time).delta
+            result["ended"] = time()
+            if state["cancelled"] is not None:
+                result["exit_code"] = 1
+                result["status"] = state["cancelled"]
+                log_message = "Build image {} {}. [Duration: {}]" \
+                    .format(image, state["cancelled"],
+                            Time(start_time).delta_in_hms())
+                _log(image, logging.ERROR, log_message)
+            elif state["error"] is None and state["id"] is not None:
+                image_id = "sha256:%s" % state["id"]
+                result["image"] = image_id[:17]
+                result["image_id"] = image_id
+                result["exit_code"] = 0
+                log_message = "{} image created. [Duration: {}]" \
+                    .format(image, Time(start_time).delta_in_hms())
+                _log(image, logging.INFO, log_message)
+            else:
+                result["exit_code"] = 1
+                log_message = "Build image {} failed. [Duration: {}]" \
+                    .format(image, Time(start_time).delta_in_hms())
+                _log(image, logging.ERROR, "%s", state["error"])
+                _log(image, logging.ERROR, log_message)
+            result["messages"].append(log_message)
+            self.images.objects[image] = result
+            self._trace("build", image, result)
+            if state["cancelled"] != "cancelled":
+                self._failure(result, "Image", image)
+            self._built(image, result)
+
+        params = {
+            "buildargs": dumps(self.config["docker_image_build_args"]),
+            "dockerfile": "Dockerfile_%s" % image,
+            "rm": int(bool(self.config["docker_remove_images"])),
+            "t": _image_tag(self.config, image)}
+        request = self.api.request(
+            "POST",
+            "/build",
+            params=params,
+            body=self.context,
+            headers={"Content-Type": "application/x-tar"},
+            on_data=_on_data,
+            on_done=_on_done)
+        self._watch("build", "Image", image, _cancel)
+
+    @staticmethod
+    def _build_event(image, state, line):
+        if not line.strip():
+            return
+        try:
+            event = loads(line)
+        except ValueError:
+            return
+        if "error" in event:
+            state["error"] = event["error"]
+        if "aux" in event and "ID" in event["aux"]:
+            state["id"] = event["aux"]["ID"].split(":")[-1]
+        if "stream" in event:
+            LOG.debug("%s: %s", image, event["stream"].strip())
+            match = re.search(
+                r"(^Successfully built |sha256:)([0-9a-f]+)$",
+                event["stream"].strip())
+            if match:
+                state["id"] = match.group(2)
+
+    def _built(self, image, result):
+        if result["exit_code"] == 0:
+            for child in self.images.add_built(image, result):
+                self._queue("build", child, self.images.priority(child))
+        else:
+            self.images.skip_descendants(image)
+        if self.containers is None:
+            return
+        if result["exit_code"] != 0:
+            LOG.error(
+                "Build of image %s failed. Dropping the container runs.",
+                image)
+            return
+        for container in self.containers.add(image, result):
+            self._queue(
+                "run",
+                container,
+                self.containers.priority(container))
+
+    def _dispatch(self):
+        if self.failed:
+            for kind in ("build", "run"):
+                while self.ready[kind]:
+                    self._skip(kind, heapq.heappop(self.ready[kind])[2])
+            return
+        blocked = set([])
+        while self.running["build"] + self.running["run"] < \
+                self.limits["total"]:
+            kinds = [_kind for _kind in ("build", "run")
+                     if self.ready[_kind] and _kind not in blocked and
+                     self.running[_kind] < self.limits[_kind]]
+            if not bool(kinds):
+                return
+            kind = min(kinds, key=lambda _kind: self.ready[_kind][0])
+            if kind == "run" and not self._admit(self.ready[kind][0][2]):
+                blocked.add(kind)
+                continue
+            obj = heapq.heappop(self.ready[kind])[2]
+            self.running[kind] += 1
+            slots = set(self.slots[kind].values())
+            self.slots[kind][obj] = next(
+                _slot for _slot in itertools.count(1) if _slot not in slots)
+            if kind == "build":
+                self._build(obj)
+            else:
+                self._run_container(obj)
+
+    def _expire(self):
+        while self.deadlines and self.deadlines[0][0] <= time():
+            _, _, kind, name = heapq.heappop(self.deadlines)
+            cancel = self.cancels.pop(name, None)
+            if cancel is not None:
+                LOG.error(
+                    "%s %s exceeded the timeout of %ss.",
+                    kind,
+                    name,
+                    self.timeouts["build" if kind == "Image" else "run"])
+                cancel("timed out")
+
+    def _failure(self, result, kind, name):
+        if result["exit_code"] == 0 or self.failed or \
+                not self.config["fail_fast"]:
+            return
+        self.failed = True
+        LOG.error(
+            "%s %s failed. Cancelling all remaining jobs (fail fast).",
+            kind,
+            name)
+        cancels = self.cancels
+        self.cancels = dict({})
+        for cancel in cancels.itervalues():
+            cancel("cancelled")
+
+    def _queue(self, kind, obj, priority):
+        self.queued[obj] = time()
+        heapq.heappush(self.ready[kind], (-priority, next(self.counter), obj))
+
+    def _release(self, name):
+        resources = self.admitted.pop(name, None)
+        if resources is not None:
+            self.admission.release(resources)
+
+    def _skip(self, kind, name):
+        if kind == "build":
+            result = self.images.objects[name] = dict({})
+            result["messages"] = list([])
+            log_message = "Image {} cancelled.".format(name)
+        else:
+            result = self.containers.objects[name]
+            log_message = "Container {} cancelled.".format(name)
+        _log(name, logging.WARNING, log_message)
+        result["ended"] = time()
+        result["exit_code"] = 1
+        result["messages"].append(log_message)
+        result["queued"] = self.queued.pop(name)
+        result["status"] = "cancelled"
+
+    def _trace(self, kind, name, result):
+        """ Record the job on the track of its slot (parallel job) """
+        slot = self.slots[kind].pop(name)
+        TRACER.complete(
+            name,
+            kind,
+            result["started"],
+            result["ended"],
+            track="%s-%s" % (kind.capitalize(), slot),
+            exit_code=result["exit_code"])
+
+    def _watch(self, kind, type_name, name, cancel):
+        self.cancels[name] = cancel
+        if self.timeouts[kind]:
+            heapq.heappush(
+                self.deadlines,
+                (time() + float(self.timeouts[kind]), next(self.counter),
+                 type_name, name))
+
+    def _run_container(self, name):  # pylint: disable=R0915
+        container = self.containers.objects[name]
+        container["queued"] = self.queued.pop(name)
+        container["started"] = time()
+        digest = None
+        if self.result_cache is not None:
+            digest = self.result_cache.digest(container)
+            if self.result_cache.get(digest) is not None:
+                log_message = "Container {} run skipped. " \
+                    "[Result: cached pass]".format(name)
+                _log(name, logging.INFO, log_message)
+                container["cache"] = "hit"
+                container["ended"] = time()
+                container["exit_code"] = 0
+                container["messages"].append(log_message)
+                self.running["run"] -= 1
+                self._release(name)
+                self._trace("run", name, container)
+                return
+            container["cache"] = "miss"
+        start_time = time()
+        color = random.SystemRandom().choice(self.color.colors())
+        container_log = self.container_logs.open(
+            name,
+            container,
+            lambda _line: _log(name, logging.INFO, self.color.cstring(
+                _line.strip(), color)))
+        state = {"buffer": b"", "cancelled": None, "exit_code": None,
+                 "finished": False, "id": None, "logs": False, "wait": False}
+
+        def _cancel(reason):
+            state["cancelled"] = reason
+            if state["id"] is not None:
+                self.api.request("POST", "/containers/%s/kill" % state["id"])
+
+        def _finish(error=None, running=False):
+            # The logs and the wait request are finishing the run together,
+            # an error of one of them finishes it before the other one.
+            if state["finished"]:
+                return
+            state["finished"] = True
+            self.cancels.pop(name, None)
+            if not running:
+                self.running["run"] -= 1
+                self._release(name)
+            container_log.close()
+            container["duration"] = Time(start_time).delta
+            container["ended"] = time()
+            if state["cancelled"] is not None:
+                container["exit_code"] = 1
+                container["status"] = state["cancelled"]
+                container["log_tail"] = container_log.tail()
+                log_message = "Container {} run {}. [Duration: {}]" \
+                    .format(name, state["cancelled"],
+                            Time(start_time).delta_in_hms())
+                _log(name, logging.ERROR, log_message)
+            elif error is None and state["exit_code"] == 0:
+                container["exit_code"] = 0
+                log_message = "Container {} run succeeded. [Duration: {}]" \
+                    .format(name, Time(start_time).delta_in_hms())
+                _log(name, logging.INFO, log_message)
+                if digest is not None:
+                    self.result_cache.set(digest, name)
+            else:
+                if error is not None:
+                    _log(name, logging.ERROR, "%s", error)
+                container["exit_code"] = 1
+                container["log_tail"] = container_log.tail()
+                log_message = "Container {} run failed. [Duration: {}]" \
+                    .format(name, Time(start_time).delta_in_hms())
+                _log(name, logging.ERROR, log_message)
+            container["messages"].append(log_message)
+            self._trace("run", name, container)
+            if state["cancelled"] != "cancelled":
+                self._failure(container, "Container", name)
+            if state["id"] is not None:
+                self.api.request(
+                    "DELETE",
+                    "/containers/%s" % state["id"],
+                    params={"force": 1, "v": 1},
+                    on_done=_on_removed if running else None)
+            if self.workspace is not None:
+                self.workspace.remove(name)
+
+        def _on_logs(data):
+            if state["finished"]:
+                return
+            state["buffer"] += data
+            while len(state["buffer"]) >= 8:
+                size = struct.unpack(">L", state["buffer"][4:8])[0]
+                if len(state["buffer"]) < 8 + size:
+                    return
+                container_log.write(state["buffer"][8:8 + size])
+                state["buffer"] = state["buffer"][8 + size:]
+
+        def _on_logs_done(status, body):
+            del status, body
+            state["logs"] = True
+            if state["wait"]:
+                _finish()
+
+        def _on_removed(status, body):
+            # The container was still running (the wait failed), so the run
+            # keeps its slot until the container is removed.
+            del status, body
+            self.running["run"] -= 1
+            self._release(name)
+
+        def _on_wait(status, response):
+            state["wait"] = True
+            if status != 200:
+                state["logs"] = True
+                _finish(response, running=True)
+                return
+            state["exit_code"] = int(response["StatusCode"])
+            if state["logs"]:
+                _finish()
+
+        def _on_start(status, response):
+            if status not in (204, 304):
+                _finish(response)
+                return
+            if state["cancelled"] is not None:
+                _cancel(state["cancelled"])
+            self.api.request(
+                "GET",
+                "/containers/%s/logs" % state["id"],
+                params={"follow": 1, "stderr": 1, "stdout": 1},
+                on_data=_on_logs,
+                on_done=_on_logs_done)
+            self.api.json(
+                "POST",
+                "/containers/%s/wait" % state["id"],
+                _on_wait)
+
+        def _on_create(status, response):
+            if status != 201:
+                _finish(response)
+                return
+            state["id"] = response["Id"]
+            if state["cancelled"] is not None:
+                _finish()
+                return
+            self.api.json(
+                "POST",
+                "/containers/%s/start" % state["id"],
+                _on_start)
+
+        volumes = container.get("volumes", dict({}))
+        if self.workspace is not None:
+            volumes = self.workspace.create(name, volumes)
+        host_config = {
+            "Binds": docker.utils.convert_volume_binds(volumes)}
+        if container["resources"]["cpus"]:
+            host_config["NanoCpus"] = int(
+                container["resources"]["cpus"] * 1e9)
+        if container["resources"]["memory"]:
+            host_config["Memory"] = container["resources"]["memory"]
+        _log(name, logging.INFO, "Starting container %s...", name)
+        self._watch("run", "Container", name, _cancel)
+        self.api.json(
+            "POST",
+            "/containers/create",
+            _on_create,
+            params={"name": name},
+            data={
+                "AttachStderr": True,
+                "AttachStdout": True,
+                "Env": docker.utils.format_environment(
+                    container["environment"]),
+                "HostConfig": host_config,
+                "Image": container["image"]})
+
+
+class Session(object):
+    """
+    State which is kept between multiple runs of one process (watch mode,
+    daemon): the Docker clients, the histories and the pipeline of the
+    current run (to cancel it).
+    """
+
+    def __init__(self):
+        self.clients = dict({})
+        self.histories = dict({})
+        self.lock = Lock()
+        self.pipeline = None
+        self.stale = False
+
+    def attach(self, pipeline):
+        """ Register the pipeline of the current run (to cancel it) """
+        with self.lock:
+            self.pipeline = pipeline
+            stale = self.stale
+        if stale:
+            pipeline.cancel()
+
+    def cancel(self):
+        """ Cancel the current run """
+        with self.lock:
+            self.stale = True
+            pipeline = self.pipeline
+        if pipeline is not None:
+            pipeline.cancel()
+
+    def configuration(self, config_file):  # pylint: disable=R0201
+        """ Get the configuration of a run """
+        return Configuration(config_file)
+
+    def configure(self, config):
+        """ Apply the session to the configuration of a run """
+
+    def docker_clients(self, config):
+        """ Get the Docker clients (created once per Docker hosts) """
+        key = (tuple(config["docker_hosts"] or [None]),
+               _max_pool_size(config),
+               config["run_threads"])
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = _docker_clients(config)
+            return self.clients[key]
+
+    def history(self, config):
+        """ Get the history (loaded once per cache directory) """
+        key = os.path.abspath(config["cache_dir"])
+        with self.lock:
+            if key not in self.histories:
+                self.histories[key] = History(config)
+            return self.histories[key]
+
+    def reset(self):
+        """ Forget the pipeline of the previous run """
+        with self.lock:
+            self.pipeline = None
+            self.stale = False
+
+
+class FileWatcher(object):
+    """
+    Watch files and directories (recursively) for changes. Changes are read
+    from inotify (Linux, via ctypes) with a fallback to polling the
+    modification times of the files.
+    """
+
+    # IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+    # IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF
+    mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+    interval = 1.0
+    settle = 0.3
+
+    def __init__(self, paths, exclude=None):
+        self.exclude = [os.path.abspath(_path) for _path in exclude or []]
+        self.fd = None  # pylint: disable=C0103
+        self.libc = None
+        self.paths = [os.path.abspath(_path) for _path in paths]
+        self.snapshot = None
+        self.watches = dict({})
+        try:
+            self._inotify()
+        except (AttributeError, OSError) as error:
+            LOG.debug("inotify is not available (%s), polling for changes.",
+                      error)
+            self.close()
+            self.snapshot = self._snapshot()
+
+    def close(self):
+        """ Stop watching """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout=None):
+        """
+        Wait for changes (until the timeout). Returns the changed paths as
+        soon as there are no further changes for a moment.
+        """
+        changed = set([])
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            wait_time = None
+            if bool(changed):
+                wait_time = self.settle
+            elif deadline is not None:
+                wait_time = max(0.0, deadline - time())
+            if self.fd is not None:
+                paths = self._read(wait_time)
+            else:
+                paths = self._poll(wait_time)
+            if not bool(paths):
+                if bool(changed) or \
+                        (deadline is not None and time() >= deadline):
+                    return changed
+                continue
+            changed.update(paths)
+
+    def _add_watches(self, path):
+        for root, dirs, _ in os.walk(path):
+            dirs[:] = [_dir for _dir in dirs
+                       if not self._excluded(os.path.join(root, _dir))]
+            wd = self.libc.inotify_add_watch(  # pylint: disable=C0103
+                self.fd,
+                root.encode("utf-8") if isinstance(root, unicode) else root,
+                self.mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.watches[wd] = root
+
+    def _excluded(self, path):
+        return any(path == _exclude or path.startswith(_exclude + os.sep)
+                   for _exclude in self.exclude)
+
+    def _inotify(self):
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6",
+            use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            self.fd = None
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        for path in self.paths:
+            if os.path.isdir(path):
+                self._add_watches(path)
+            elif os.path.dirname(path) not in self.watches.values():
+                self._add_watches(os.path.dirname(path))
+
+    def _poll(self, wait_time):
+        """ Compare the modification times of the files after a while """
+        sleep(self.interval if wait_time is None
+              else min(self.interval, wait_time))
+        snapshot = self._snapshot()
+        changed = set(
+            _path for _path in set(snapshot) | set(self.snapshot)
+            if snapshot.get(_path) != self.snapshot.get(_path))
+        self.snapshot = snapshot
+        return changed
+
+    def _read(self, wait_time):
+        """ Read the inotify events (until the wait time is over) """
+        if not select.select([self.fd], [], [], wait_time)[0]:
+            return set([])
+        data = os.read(self.fd, 65536)
+        changed = set([])
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, _, length = struct.unpack_from(  # pylint: disable=C0103
+                "iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if wd not in self.watches:
+                continue
+            path = os.path.join(self.watches[wd], name)
+            if mask & 0x8000:
+                del self.watches[wd]
+                continue
+            if mask & 0x40000000 and mask & (0x80 | 0x100) and \
+                    not self._excluded(path):
+                self._add_watches(path)
+            if self._watched(path):
+                changed.add(path)
+        return changed
+
+    def _snapshot(self):
+        """ Get the modification times and the sizes of the files """
+        snapshot = dict({})
+        for path in self.paths:
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                snapshot[path] = (stat.st_mtime, stat.st_size)
+                continue
+            for root, dirs, files in os.walk(path):
+                dirs[:] = [_dir for _dir in dirs
+                           if not self._excluded(os.path.join(root, _dir))]
+                for filename in files:
+                    _path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(_path)
+                    except OSError:
+                        continue
+                    snapshot[_path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def _watched(self, path):
+        return not self._excluded(path) and any(
+            path == _path or path.startswith(_path + os.sep)
+            for _path in self.paths)
+
+
+class Watch(Session):
+    """
+    Watch mode: Run once, then watch the configuration file, the
+    `docker_image_path` and the sources of the volumes and run only the
+    image builds and container runs which are affected by a change. A run
+    which is in progress is cancelled (stale) and its jobs are part of the
+    next run. The Docker clients are kept between the runs and unchanged
+    images are reused from the build cache.
+    """
+
+    def __init__(self, args):
+        Session.__init__(self)
+        self.args = args
+        self.config = None
+        self.config_file = None
+        self.exit_code = 0
+        self.patterns = None
+
+    def affected(self, paths):
+        """
+        Get the `image:environment` patterns of the jobs which are affected
+        by the changed paths. Returns None if all jobs are affected.
+        """
+        patterns = set([])
+        image_path = os.path.abspath(self.config["docker_image_path"])
+        for path in sorted(paths):
+            if path == self.config_file:
+                changes = self._config_changes()
+                if changes is None:
+                    return None
+                patterns.update(changes)
+            elif os.path.dirname(path) == image_path and \
+                    os.path.basename(path).startswith("Dockerfile_"):
+                image = os.path.basename(path)[len("Dockerfile_"):]
+                if image in self.config["docker_images"]:
+                    patterns.add(image)
+                    patterns.update(
+                        ImageGraph(self.config).descendants(image))
+            else:
+                return None
+        return patterns
+
+    def configure(self, config):
+        """ Apply the watch mode to the configuration of a run """
+        if config["engine"] == "async":
+            LOG.warning("The watch mode is not supported by the async "
+                        "engine. Using the thread engine.")
+            config["engine"] = "thread"
+        config["docker_build_cache"] = True
+        if not config["docker_container_workspace"]:
+            config["docker_container_workspace"] = "copy"
+        if self.patterns is not None:
+            config["docker_container_watch"] = sorted(self.patterns)
+            LOG.info("Changed: %s", ", ".join(sorted(self.patterns)))
+
+    def run(self):
+        """ Run and watch for changes until interrupted (Ctrl-C) """
+        self._load()
+        try:
+            while True:
+                pending = self._cycle()
+                while pending is not None and not bool(pending):
+                    pending = self._changes(
+                        FileWatcher(self._paths(), [self.config["cache_dir"]]),
+                        pending)
+                self.patterns = pending
+        except KeyboardInterrupt:
+            self.cancel()
+            LOG.info("Watch mode stopped.")
+        return self.exit_code
+
+    def _changes(self, watcher, pending):
+        """ Wait for changes and add the affected jobs to the pending ones """
+        try:
+            paths = watcher.wait()
+        finally:
+            watcher.close()
+        LOG.debug("Changed paths: %s", ", ".join(sorted(paths)))
+        return self._merge(pending, self.affected(paths))
+
+    def _config_changes(self):
+        """
+        Get the patterns of the changed images and environments of the
+        configuration. Returns None if other settings have changed.
+        """
+        previous = self.config
+        try:
+            self._load()
+            graph = ImageGraph(self.config)
+        except (IOError, KeyError, ValueError, yaml.YAMLError) as error:
+            LOG.error("Configuration %s is invalid: %s",
+                      self.config_file, error)
+            return set([])
+        patterns = set([])
+        keys = ["docker_container_environments", "docker_image_parents",
+                "docker_image_resources", "docker_images"]
+        if any(previous.get(_key) != self.config.get(_key)
+               for _key in set(previous) | set(self.config)
+               if _key not in keys):
+            return None
+        environments = [_config["docker_container_environments"] or dict({})
+                        for _config in (previous, self.config)]
+        for env, env_settings in environments[1].iteritems():
+            if environments[0].get(env) != env_settings:
+                patterns.add("*:%s" % env)
+        for image in self.config["docker_images"]:
+            if image not in previous["docker_images"] or any(
+                    previous[_key].get(image) != self.config[_key].get(image)
+                    for _key in keys[1:3]):
+                patterns.add(image)
+                patterns.update(graph.descendants(image))
+        return patterns
+
+    def _cycle(self):
+        """
+        Run (in a thread) until the run is done or a change happens. A
+        change cancels the run. Returns the pending jobs (patterns).
+        """
+        self.reset()
+        thread = Thread(target=self._run, name="Watch")
+        thread.daemon = True
+        thread.start()
+        watcher = FileWatcher(self._paths(), [self.config["cache_dir"]])
+        pending = set([])
+        try:
+            while thread.is_alive():
+                paths = watcher.wait(0.5)
+                if not bool(paths):
+                    continue
+                pending = self._merge(pending, self.affected(paths))
+                if pending is not None and not bool(pending):
+                    continue
+                LOG.warning("Changes detected. Cancelling the stale run.")
+                self.cancel()
+                while thread.is_alive():
+                    thread.join(0.5)
+                return self._merge(pending, self.patterns)
+        finally:
+            watcher.close()
+        LOG.info("Watching for changes... (Ctrl-C to stop)")
+        return set([])
+
+    def _load(self):
+        configuration = Configuration(self.args.config_file)
+        self.config = configuration.get()
+        self.config_file = os.path.abspath(configuration.config_file)
+
+    @staticmethod
+    def _merge(pending, affected):
+        if pending is None or affected is None:
+            return None
+        return pending | affected
+
+    def _paths(self):
+        return [self.config_file, self.config["docker_image_path"]] + [
+            _source for _source in self.config["docker_container_volumes"]
+            if os.path.exists(_source)]
+
+    def _run(self):
+        try:
+            self.exit_code = _run(self.args, self)
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Run failed with an unexpected error.")
+            self.exit_code = 1
+
+
+class Daemon(Session):
+    """
+    Runner daemon: Keep the configurations, the Docker clients and the
+    histories in memory and execute the runs which are submitted over a
+    local HTTP API (unix socket). The runs are queued per submitter and the
+    submitters take turns (round robin), so a submitter with many runs
+    can't starve the others. The runs are executed one after another (the
+    working directory, the environment and the logging are process wide),
+    every run uses all of its threads. The build and result cache indexes
+    are read again for every run.
+    """
+
+    def __init__(self, args):
+        Session.__init__(self)
+        self.args = args
+        self.condition = Condition()
+        self.configurations = dict({})
+        self.current = None
+        self.handler = None
+        self.job_ids = itertools.count(1)
+        self.queues = dict({})
+        self.turns = deque([])
+
+    def cancel_job(self, job):
+        """ Cancel a queued or a running job (the client has disconnected) """
+        with self.condition:
+            if job.state == "queued":
+                queue = self.queues[job.submitter]
+                queue.remove(job)
+                if not bool(queue):
+                    del self.queues[job.submitter]
+                    self.turns.remove(job.submitter)
+                job.state = "cancelled"
+                LOG.info("Job %s of %s cancelled.", job.id, job.submitter)
+                return
+            # The session is reset before a job is published as the current
+            # job and the job is unpublished before it finishes (both under
+            # the condition), so the cancel can't get lost or hit the next job
+            if self.current is job:
+                LOG.warning("Job %s of %s cancelled (client disconnected).",
+                            job.id, job.submitter)
+                self.cancel()
+
+    def configuration(self, config_file):
+        """
+        Get the configuration of a run. A configuration file is parsed
+        again only if it has changed.
+        """
+        key = (os.getcwd(), config_file)
+        with self.lock:
+            cached = self.configurations.get(key)
+        if cached is not None:
+            mtime, configuration = cached
+            try:
+                if os.path.getmtime(configuration.config_file) == mtime:
+                    return deepcopy(configuration)
+            except OSError:
+                pass
+        configuration = Configuration(config_file)
+        with self.lock:
+            self.configurations[key] = (
+                os.path.getmtime(configuration.config_file),
+                deepcopy(configuration))
+        return configuration
+
+    def configure(self, config):
+        """ Send the log records of the run on its log level """
+        if self.handler is not None:
+            self.handler.setLevel(config["log_level"])
+
+    def job(self, request):
+        """ Create a job from a submit request (raises ValueError) """
+        try:
+            argv = [str(_arg) for _arg in request["argv"]]
+            cwd = str(request["cwd"])
+            submitter = str(request.get("submitter") or "default")
+        except (KeyError, TypeError, UnicodeError) as error:
+            raise ValueError("Invalid request: %s" % error)
+        if not os.path.isdir(cwd):
+            raise ValueError("Working directory %s doesn't exist." % cwd)
+        try:
+            args = _parser().parse_args(argv)
+        except SystemExit:
+            raise ValueError("Invalid arguments: %s" % " ".join(argv))
+        if args.daemon or args.merge or args.version or args.watch:
+            raise ValueError("--daemon, --merge, --version and --watch "
+                             "can't be submitted.")
+        if _shard_error(args) is not None:
+            raise ValueError(_shard_error(args))
+        if _threads_error(args) is not None:
+            raise ValueError(_threads_error(args))
+        if _timeout_error(args) is not None:
+            raise ValueError(_timeout_error(args))
+        return DaemonJob(next(self.job_ids), submitter, cwd, args)
+
+    def jobs(self):
+        """ Get the running and the queued jobs """
+        with self.condition:
+            return {
+                "queued": [_job.info() for _submitter in self.turns
+                           for _job in self.queues[_submitter]],
+                "running": self.current.info() if self.current else None}
+
+    def run(self):
+        """
+        Serve the API and execute the submitted runs until interrupted
+        (Ctrl-C)
+        """
+        level = self.args.log_level or "INFO"
+        _logger(level, self.args.disable_logging)
+        root = logging.getLogger()
+        for handler in root.handlers:
+            handler.setLevel(level)
+        root.setLevel(logging.NOTSET)
+        path = self.args.daemon
+        if os.path.exists(path):
+            if DaemonClient(path).alive():
+                LOG.error("A daemon is already listening on %s.", path)
+                return 1
+            os.remove(path)
+        server = _DaemonServer(path, _DaemonRequestHandler)
+        server.session = self
+        thread = Thread(target=server.serve_forever, name="API")
+        thread.daemon = True
+        thread.start()
+        LOG.info("Listening on %s (Ctrl-C to stop)", path)
+        try:
+            while True:
+                self._execute(self._next())
+        except KeyboardInterrupt:
+            self.cancel()
+            LOG.info("Daemon stopped.")
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(path)
+        return 0
+
+    def submit(self, job):
+        """ Queue a job behind the other jobs of its submitter """
+        with self.condition:
+            if job.submitter not in self.queues:
+                self.queues[job.submitter] = deque([])
+                self.turns.append(job.submitter)
+            self.queues[job.submitter].append(job)
+            queued = sum(len(_queue) for _queue in self.queues.values())
+            running = self.current is not None
+            self.condition.notify()
+        job.emit(log="Job %s queued (%s queued, %s running)" % (
+            job.id, queued, int(running)))
+
+    def _execute(self, job):
+        """
+        Execute a job in the working directory of its submitter. The process
+        wide state (working directory, environment, logging) is restored
+        afterwards.
+        """
+        global TRACER  # pylint: disable=W0603
+        _start_time = time()
+        LOG.info("Job %s of %s started in %s.", job.id, job.submitter,
+                 job.cwd)
+        self.handler = _DaemonLogHandler(job)
+        self.handler.setFormatter(colorlog.ColoredFormatter(LOG_FORMAT))
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        cwd = os.getcwd()
+        environ = dict(os.environ)
+        exit_code = 1
+        try:
+            os.chdir(job.cwd)
+            exit_code = _run(job.args, self)
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Run failed with an unexpected error.")
+        finally:
+            root.removeHandler(self.handler)
+            self.handler = None
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+            LOG.disabled = bool(self.args.disable_logging)
+            TRACER = NullTracer()
+            with self.condition:
+                self.current = None
+            job.finish(exit_code)
+        LOG.info(
+            "Job %s of %s finished with exit code %s. [Duration: %s]",
+            job.id,
+            job.submitter,
+            exit_code,
+            Time(_start_time).delta_in_hms())
+
+    def _next(self):
+        """ Wait for the next job. The submitters take turns. """
+        with self.condition:
+            while not bool(self.turns):
+                self.condition.wait(0.5)
+            submitter = self.turns.popleft()
+            queue = self.queues[submitter]
+            job = queue.popleft()
+            if bool(queue):
+                self.turns.append(submitter)
+            else:
+                del self.queues[submitter]
+            job.state = "running"
+            self.reset()
+            self.current = job
+            return job
+
+
+class DaemonClient(object):
+    """
+    Thin client of the daemon: Submit a run and stream its log output. The
+    run is cancelled if the client is interrupted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def alive(self):
+        """ Check if a daemon is listening """
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            finally:
+                sock.close()
+        except socket.error:
+            return False
+        return True
+
+    def submit(self, argv, submitter):
+        """ Submit a run and get its exit code """
+        connection = _UnixHTTPConnection(self.path)
+        try:
+            connection.request(
+                "POST",
+                "/jobs",
+                dumps({"argv": argv,
+                       "cwd": os.getcwd(),
+                       "submitter": submitter}),
+                {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            if response.status != 200:
+                LOG.error("%s", loads(response.read())["error"])
+                return 2
+            for line in iter(response.fp.readline, ""):
+                if not bool(line.strip()):
+                    continue
+                message = loads(line)
+                if "log" in message:
+                    sys.stderr.write("%s\n" % message["log"].encode("utf-8"))
+                if "exit_code" in message:
+                    return message["exit_code"]
+        except KeyboardInterrupt:
+            return 130
+        except (httplib.HTTPException, socket.error, ValueError) as error:
+            LOG.error("Daemon %s: %s", self.path, error)
+            return 1
+        finally:
+            connection.close()
+        LOG.error("Daemon %s: Connection lost.", self.path)
+        return 1
+
+
+class DaemonJob(object):
+    """ A run which was submitted to the daemon """
+
+    def __init__(self, job_id, submitter, cwd, args):
+        self.args = args
+        self.cwd = cwd
+        self.exit_code = None
+        self.id = job_id  # pylint: disable=C0103
+        self.output = Queue()
+        self.state = "queued"
+        self.submitted = time()
+        self.submitter = submitter
+
+    def emit(self, **message):
+        """ Send a message to the client """
+        self.output.put(message)
+
+    def finish(self, exit_code):
+        """ Send the exit code to the client """
+        self.exit_code = exit_code
+        self.state = "finished"
+        self.emit(exit_code=exit_code)
+
+    def info(self):
+        """ Get the job information (for the API) """
+        return {"cwd": self.cwd,
+                "id": self.id,
+                "state": self.state,
+                "submitted": self.submitted,
+                "submitter": self.submitter}
+
+
+class _DaemonLogHandler(logging.Handler):
+    """ Send the log records of a run to its client """
+
+    def __init__(self, job):
+        logging.Handler.__init__(self)
+        self.job = job
+
+    def emit(self, record):
+        try:
+            self.job.emit(log=self.format(record))
+        except Exception:  # pylint: disable=W0703
+            self.handleError(record)
+
 
+class _DaemonRequestHandler(BaseHTTPRequestHandler):
+    """
+    The HTTP API of the daemon:
 
-def _docker_client():
+    GET /jobs: The running and the queued jobs.
+    POST /jobs: Submit a run ({"argv": [...], "cwd": ..., "submitter": ...}).
+    The response is streamed (one JSON object per line) with the log output
+    ({"log": ...}) and finally the exit code ({"exit_code": ...}).
+    """
+
+    keepalive = 5
+
+    def do_GET(self):  # pylint: disable=C0103
+        """ Get the jobs """
+        if self.path.rstrip("/") != "/jobs":
+            self._reply(404, {"error": "Not found: %s" % self.path})
+            return
+        self._reply(200, self.server.session.jobs())
+
+    def do_POST(self):  # pylint: disable=C0103
+        """ Submit a run and stream its output until it is finished """
+        if self.path.rstrip("/") != "/jobs":
+            self._reply(404, {"error": "Not found: %s" % self.path})
+            return
+        session = self.server.session
+        try:
+            length = int(self.headers.getheader("Content-Length") or 0)
+            job = session.job(loads(self.rfile.read(length)))
+        except ValueError as error:
+            self._reply(400, {"error": str(error)})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        session.submit(job)
+        try:
+            while True:
+                try:
+                    message = job.output.get(timeout=self.keepalive)
+                except Empty:
+                    self.wfile.write("\n")
+                    continue
+                self.wfile.write("%s\n" % dumps(message))
+                if "exit_code" in message:
+                    break
+        except socket.error:
+            session.cancel_job(job)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """ Log the requests (debug) """
+        LOG.debug("API: %s", format % args)
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(dumps(body))
+
+
+class _DaemonServer(ThreadingMixIn, UnixStreamServer):
+    """ Threaded HTTP server on a unix socket """
+
+    daemon_threads = True
+    session = None
+
+    def handle_error(self, request, client_address):
+        """ Disconnected clients are expected (their runs are cancelled) """
+        LOG.debug("API: Request failed.", exc_info=True)
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+    """ HTTP connection to a unix socket """
+
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def _build_response_hook(response, **kwargs):
+    """
+    Response hook of the Docker API clients: Record the response of an image
+    build (for the thread which has sent the request), so the connection
+    can be shut down to abort the build
+    """
+    del kwargs
+    if urlparse(response.url).path.endswith("/build"):
+        _BUILD_RESPONSE.response = response
+    return response
+
+
+def _docker_client(base_url=None, max_pool_size=None):
+    kwargs = dict({})
+    if max_pool_size:
+        kwargs["max_pool_size"] = int(max_pool_size)
     try:
-        docker_client = docker.from_env()
+        if base_url is not None:
+            docker_client = docker.DockerClient(base_url=base_url, **kwargs)
+        else:
+            docker_client = docker.from_env(**kwargs)
+        docker_client.api.hooks["response"].append(_build_response_hook)
         docker_client.ping()
         return docker_client
     except docker.errors.DockerException as error:
         raise error
 
 
+def _docker_clients(config):
+    """
+    Create the Docker clients of all configured Docker hosts. The connection
+    pool of the API clients is sized for all parallel jobs (`max_pool_size`),
+    the log output is streamed with an own client per host (one connection
+    per parallel container run).
+    """
+    hosts = config["docker_hosts"] or [None]
+    clients = dict({})
+    log_clients = dict({})
+    for host in hosts:
+        name = host if host is not None else "default"
+        clients[name] = _docker_client(host, _max_pool_size(config))
+        log_clients[name] = _docker_client(host, config["run_threads"])
+    return DockerClientPool(clients, log_clients)
+
+
+def _docker_socket():
+    """ Get the path of the Docker unix socket (for the async engine) """
+    docker_host = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+    if not docker_host.startswith("unix://"):
+        raise docker.errors.DockerException(
+            "The async engine supports only unix sockets (DOCKER_HOST=%s)." %
+            docker_host)
+    return docker_host[len("unix://"):]
+
+
+def _environments(config, image):
+    """
+    Yield the environment names and settings of all container runs of an
+    image. If there are no environments the name is None.
+    """
+    return _matrix(config).runs(image)
+
+
+def _in_shard(config, image, env):
+    """ Check if a container run belongs to the current shard """
+    shard_containers = config.get("shard_containers")
+    return shard_containers is None or (image, env) in shard_containers
+
+
+def _image_graph(config):
+    """ Get the image dependencies of the configuration """
+    if "image_graph" not in config:
+        config["image_graph"] = ImageGraph(config)
+    return config["image_graph"]
+
+
+def _image_tag(config, image):
+    """ Get the tag of an image """
+    _tag = "%s" % image
+    if config["project_name"] is not None:
+        project_name = SearchAndReplace(
+            "[^0-9a-zA-Z]+",
+            "_").in_str(
+                config["project_name"],
+                True)
+        _tag = "%s_%s" % (project_name, image)
+    return _tag.lower()
+
+
+def _limits(resources):
+    """ Get the container limits (`containers.run` arguments) of a run """
+    limits = dict({})
+    if resources["cpus"]:
+        limits["nano_cpus"] = int(resources["cpus"] * 1e9)
+    if resources["memory"]:
+        limits["mem_limit"] = resources["memory"]
+    return limits
+
+
+def _log(name, level, message, *args):
+    """
+    Log a message on behalf of a job. The job name is used as thread name
+    (used by the async engine where all jobs are running in one thread).
+    """
+    thread = current_thread()
+    thread_name = thread.name
+    thread.name = name
+    try:
+        LOG.log(level, message, *args)
+    finally:
+        thread.name = thread_name
+
+
 def _logger(log_level="INFO", disable_logging=False):
     try:
         log_level = logging.getLevelName(log_level)
-        log_format = ("%(log_color)s[%(levelname)s] "
-                      "%(threadName)s:%(reset)s %(message)s")
-        colorlog.basicConfig(level=log_level, format=log_format)
+        colorlog.basicConfig(level=log_level, format=LOG_FORMAT)
         logger = colorlog.getLogger(__name__)
         if disable_logging is True:
             logger.disabled = True
@@ -560,6 +4958,32 @@ def _logger(log_level="INFO", disable_logging=False):
         raise error
 
 
+def _max_pool_size(config):
+    """
+    Get the connection pool size of the Docker API clients: all parallel
+    jobs, the base image pulls and the event stream
+    """
+    if config["max_pool_size"]:
+        return int(config["max_pool_size"])
+    return int(config["threads"]) + int(config["prefetch_threads"]) + 1
+
+
+def _matrix(config):
+    """ Get the (compiled) matrix of the configuration """
+    if "matrix" not in config:
+        config["matrix"] = Matrix(config)
+    return config["matrix"]
+
+
+def _makedirs(path):
+    """ Create a directory (and its parents) if it doesn't exist """
+    try:
+        os.makedirs(path)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise error
+
+
 def _recursive_iglob(root_dir=".", pattern="*"):
     for root, dirs, files in os.walk(root_dir):
         del dirs
@@ -567,12 +4991,30 @@ def _recursive_iglob(root_dir=".", pattern="*"):
             yield os.path.join(root, filename)
 
 
-def _run(args):  # pylint: disable=R0912,R0914,R0915
-    """ Run the Docker test runner """
+def _resources(config, image, environment):
+    """
+    Get the CPU and memory requests of a container run. The `resources` of
+    the environment are overriding the `resources` of the image.
+    """
+    resources = dict(config["docker_image_resources"].get(image) or dict({}))
+    resources.update((environment or dict({})).get("resources") or dict({}))
+    return {"cpus": float(resources.get("cpus") or 0),
+            "memory": docker.utils.parse_bytes(resources.get("memory") or 0)}
+
+
+def _run(args, session=None):  # pylint: disable=R0912,R0914,R0915
+    """
+    Run the Docker test runner (once or as a run of the watch mode or the
+    daemon)
+    """
+    global TRACER  # pylint: disable=W0603
 
     def _config(config_file):
         """ Make me nice one day... """
-        _config = Configuration(config_file)
+        if session is not None:
+            _config = session.configuration(config_file)
+        else:
+            _config = Configuration(config_file)
         if "TRAVIS" in os.environ:
             _config.add(
                 "TRAVIS",
@@ -594,32 +5036,53 @@ def _run(args):  # pylint: disable=R0912,R0914,R0915
             _log_level = "INFO"
         if args.threads:
             _threads = args.threads
-        elif _config["threads"]:
-            _threads = _config["threads"]
         else:
-            _threads = 2
+            _threads = _config["threads"]
+        if args.build_cache:
+            _config["docker_build_cache"] = args.build_cache
+        if args.engine:
+            _config["engine"] = args.engine
+        if args.result_cache:
+            _config["docker_result_cache"] = args.result_cache
+        if args.layer_cache:
+            _config["docker_layer_cache"] = args.layer_cache
+        if args.reuse_containers is not None:
+            _config["docker_container_reuse"] = args.reuse_containers
+        if args.workspace:
+            _config["docker_container_workspace"] = args.workspace
+        if args.live_output:
+            _config["live_output"] = args.live_output
+        if args.fail_fast:
+            _config["fail_fast"] = args.fail_fast
+        if args.only:
+            _config["docker_container_only"] = args.only
+        for _key in ["build_timeout", "run_timeout"]:
+            if getattr(args, _key) is not None:
+                _config[_key] = getattr(args, _key)
+        if args.prefetch_threads is not None:
+            _config["prefetch_threads"] = args.prefetch_threads
+        if args.max_load is not None:
+            _config["max_load"] = args.max_load
+        if args.max_pool_size is not None:
+            _config["max_pool_size"] = args.max_pool_size
         _config["disable_logging"] = _disable_logging
         _config["log_level"] = _log_level
-        _config["threads"] = _threads
+        for _key in ["build_threads", "run_threads"]:
+            if getattr(args, _key):
+                _config[_key] = getattr(args, _key)
+        if not _threads and \
+                (_config["build_threads"] or _config["run_threads"]):
+            # The pools are only limited by their own size
+            _threads = int(_config["build_threads"] or 2) + \
+                int(_config["run_threads"] or 2)
+        _config["threads"] = _threads or 2
+        for _key in ["build_threads", "run_threads"]:
+            if not _config[_key]:
+                _config[_key] = _threads or 2
         return _config
 
-    def _objects_messages(name, objects):
-        for obj in objects.itervalues():
-            if obj["exit_code"] == 0:
-                _sucessfull[name] += 1
-            _exit_code.append(obj["exit_code"])
-            for message in obj["messages"]:
-                if obj["exit_code"] == 0:
-                    LOG.info(message)
-                else:
-                    LOG.error(message)
-
-    _exit_code = [0]
     _expected = dict({})
     _start_time = time()
-    _sucessfull = dict({})
-    _sucessfull["container_runs"] = 0
-    _sucessfull["image_runs"] = 0
 
     config = _config(args.config_file)
 
@@ -627,80 +5090,528 @@ def _run(args):  # pylint: disable=R0912,R0914,R0915
         config["log_level"],
         config["disable_logging"])
 
-    _semaphore = Semaphore(config["threads"])
-    semaphore, threads = _semaphore.get()
+    if session is not None:
+        session.configure(config)
+
+    if args.trace:
+        TRACER = Tracer()
+
+    semaphore, threads = Semaphore(config["threads"]).get()
+    build_threads = int(config["build_threads"])
+    run_threads = int(config["run_threads"])
 
     LOG.info("%s Threads", threads)
+    LOG.info("%s build threads", build_threads)
+    LOG.info("%s run threads", run_threads)
 
+    graph = _image_graph(config)
+    matrix = _matrix(config)
+    if matrix.filtered():
+        config["docker_images"] = matrix.images(args.build_only)
+
+    history = None
+    if config["history"] or args.plan:
+        if session is not None:
+            history = session.history(config)
+        else:
+            history = History(config)
+
+    if args.shard_total is not None:
+        shard_history = None
+        if args.shard_history:
+            if not os.path.isfile(args.shard_history):
+                LOG.warning(
+                    "Shard history %s doesn't exist, the shards are "
+                    "balanced by the number of jobs.",
+                    args.shard_history)
+            shard_history = History(config, args.shard_history)
+        _images, _containers = Shard(
+            config,
+            shard_history,
+            args.shard_index or 0,
+            args.shard_total).apply(args.build_only)
+        LOG.info(
+            "Shard %s/%s: %s images, %s container runs",
+            args.shard_index or 0,
+            args.shard_total,
+            len(_images),
+            0 if args.build_only else len(_containers))
+
+    config["docker_images"] = graph.closure(config["docker_images"])
     _expected["docker_images"] = len(config["docker_images"])
     LOG.info("%s expected images", _expected["docker_images"])
-    if not args.build_only:  # pylint: disable=R1702
-        if bool(config["docker_container_environments"]):
-            _skip = 0
-            for _docker_image in config["docker_images"]:
-                for _docker_env, _docker_env_settings in \
-                        config["docker_container_environments"].iteritems():
-                    if "skip_images" in _docker_env_settings:
-                        for _skip_image in _docker_env_settings["skip_images"]:
-                            if _docker_image == _skip_image:
-                                _skip += 1
-            _docker_envs = len(config["docker_container_environments"])
-            _expected["docker_container_runs"] = (
-                _docker_envs *
-                _expected["docker_images"]) - _skip
-            LOG.info("%s environments", _docker_envs)
-            LOG.info(
-                "%s expected container runs",
-                _expected["docker_container_runs"])
-        else:
-            _expected["docker_container_runs"] = _expected["docker_images"]
-            LOG.info("%s environments", "0")
-            LOG.info(
-                "%s expected container runs",
-                _expected["docker_container_runs"])
+    if not args.build_only:
+        _expected["docker_container_runs"] = matrix.count()
+        LOG.info(
+            "%s environments",
+            len(config["docker_container_environments"] or dict({})))
+        LOG.info(
+            "%s expected container runs",
+            _expected["docker_container_runs"])
 
-    docker_client = _docker_client()
+    if args.plan:
+        return _plan(config, history, args.build_only)
 
-    _docker_images = DockerImages(docker_client, semaphore, config)
-    _docker_images.run()
-    docker_images = _docker_images.get()
+    docker_containers = None
+    _engine_start = time()
+    if config["engine"] == "async":
+        docker_images, docker_containers = _run_async(
+            config,
+            history,
+            args.build_only)
+    else:
+        if session is not None:
+            docker_clients = session.docker_clients(config)
+        else:
+            docker_clients = _docker_clients(config)
+        LOG.info("%s Docker host(s)", len(docker_clients))
+        Prefetch(config, docker_clients).run()
 
-    if not args.build_only:
-        _docker_containers = DockerContainers(
-            docker_client,
+        _docker_images = DockerImages(
+            docker_clients,
             semaphore,
             config,
-            docker_images)
-        _docker_containers.run()
-        docker_containers = _docker_containers.get()
+            history)
+        if args.build_only:
+            pipeline = DockerPipeline(
+                _docker_images,
+                fail_fast=config["fail_fast"])
+        else:
+            _docker_containers = DockerContainers(
+                docker_clients,
+                semaphore,
+                config,
+                history=history)
+            pipeline = DockerPipeline(
+                _docker_images,
+                _docker_containers,
+                config["fail_fast"])
+        if session is not None:
+            session.attach(pipeline)
+        pipeline.run()
+        if not args.build_only:
+            docker_containers = dict({})
+            if bool(_docker_containers.objects):
+                docker_containers = _docker_containers.get()
+        docker_images = _docker_images.get()
+    TRACER.complete(
+        "Engine",
+        "engine",
+        _engine_start,
+        time(),
+        engine=config["engine"])
+
+    if history is not None and config["history"]:
+        history.record_objects(
+            docker_images,
+            lambda _image, _: History.image_key(_image))
+        if not args.build_only:
+            history.record_objects(
+                docker_containers,
+                lambda _, _container: History.container_key(
+                    _container["image_name"],
+                    _container["environment_name"]))
+        history.save()
+
+    if args.results:
+        _results(
+            args.results,
+            config,
+            _expected,
+            docker_images,
+            docker_containers,
+            history)
+
+    exit_code = _summary(
+        config,
+        _expected,
+        docker_images,
+        docker_containers,
+        (threads, build_threads, run_threads))
+    _reports(
+        args,
+        config,
+        docker_images,
+        docker_containers,
+        exit_code,
+        _start_time)
+    if args.trace:
+        TRACER.save(args.trace)
+    LOG.info("Total duration: %s", Time(_start_time).delta_in_hms())
+    return exit_code
+
+
+def _check_shards(shards):
+    """
+    Check that the merged results are covering every shard exactly once.
+    The shards are (index, total) tuples, None for runs without sharding.
+    Returns an error message or None.
+    """
+    if not any(_shard is not None for _shard in shards):
+        return None
+    if None in shards:
+        return "Results of sharded and not sharded runs can't be merged."
+    totals = sorted(set(_total for _, _total in shards))
+    if len(totals) > 1:
+        return "Results of %s shards can't be merged." % \
+            " and ".join(str(_total) for _total in totals)
+    indexes = sorted(_index for _index, _ in shards)
+    missing = [str(_index) for _index in range(totals[0])
+               if _index not in indexes]
+    if bool(missing):
+        return "Results of shard(s) %s of %s are missing." % (
+            ", ".join(missing), totals[0])
+    if len(indexes) != totals[0]:
+        return "Results of shard(s) %s are merged more than once." % \
+            ", ".join(sorted(set(str(_index) for _index in indexes
+                                 if indexes.count(_index) > 1)))
+    return None
+
+
+def _merge(args):
+    """ Merge the results of multiple (sharded) runs """
+    LOG = _logger(  # pylint: disable=C0103,W0621
+        args.log_level or "INFO",
+        args.disable_logging)
+    config = dict({})
+    _expected = {"docker_images": 0, "docker_container_runs": 0}
+    docker_images = dict({})
+    docker_containers = None
+    history = None
+    if args.shard_history:
+        history = History(config, args.shard_history)
+    shards = list([])
+    for results_file in args.merge:
+        with open(results_file, "r") as _results_file:
+            results = load(_results_file)
+        LOG.info("Merging results of %s", results_file)
+        shards.append(results.get("shard"))
+        if history is not None:
+            history.merge(results.get("history") or dict({}))
+        for _key in ["docker_build_cache", "docker_result_cache"]:
+            config[_key] = config.get(_key) or results[_key]
+        config["project_name"] = results["project_name"]
+        for image, image_info in results["docker_images"].iteritems():
+            if image not in docker_images or image_info["exit_code"] != 0:
+                docker_images[image] = image_info
+        if results["docker_containers"] is not None:
+            if docker_containers is None:
+                docker_containers = dict({})
+            docker_containers.update(results["docker_containers"])
+            _expected["docker_container_runs"] += \
+                results["expected"]["docker_container_runs"]
+    error = _check_shards(shards)
+    if error is not None:
+        LOG.error(error)
+        return 1
+    _expected["docker_images"] = len(docker_images)
+    if history is not None:
+        history.save()
+        LOG.info("Shard history written to %s", args.shard_history)
+    exit_code = _summary(config, _expected, docker_images, docker_containers)
+    _reports(args, config, docker_images, docker_containers, exit_code)
+    return exit_code
+
+
+def _report(docker_images, docker_containers=None):
+    """ Get the report records of all image builds and container runs """
+    records = list([])
+    for kind, objects in [("image", docker_images),
+                          ("container", docker_containers or dict({}))]:
+        for name, obj in sorted(objects.iteritems()):
+            queue_wait = None
+            if obj.get("queued") is not None and \
+                    obj.get("started") is not None:
+                queue_wait = obj["started"] - obj["queued"]
+            status = obj.get("status")
+            if status is None:
+                status = "passed" if obj["exit_code"] == 0 else "failed"
+            records.append({
+                "cache": obj.get("cache"),
+                "docker_host": obj.get("docker_host"),
+                "duration": obj.get("duration"),
+                "ended": obj.get("ended"),
+                "environment": obj.get("environment_name"),
+                "exit_code": obj["exit_code"],
+                "image": obj.get("image_name", name),
+                "image_id": obj.get("image_id"),
+                "kind": kind,
+                "log_file": obj.get("log_file"),
+                "log_tail": obj.get("log_tail"),
+                "messages": obj["messages"],
+                "name": name,
+                "queue_wait": queue_wait,
+                "queued": obj.get("queued"),
+                "started": obj.get("started"),
+                "status": status})
+    return records
+
+
+def _report_json(path, config, records, exit_code, start_time=None):
+    """ Write the report of a run as JSON """
+    report = {
+        "duration": None,
+        "exit_code": exit_code,
+        "jobs": records,
+        "project_name": config["project_name"],
+        "started": start_time,
+        "version": __version__}
+    if start_time is not None:
+        report["duration"] = Time(start_time).delta
+    with open(path, "w") as report_file:
+        dump(report, report_file, indent=4, sort_keys=True)
+    LOG.info("JSON report written to %s", path)
+
+
+def _report_junit(path, config, records):
+    """ Write the report of a run as JUnit XML """
+    project_name = config["project_name"] or "docker_test_runner"
+    testsuites = ElementTree.Element("testsuites", name=project_name)
+    for kind in ["image", "container"]:
+        _records = [_record for _record in records
+                    if _record["kind"] == kind]
+        testsuite = ElementTree.SubElement(
+            testsuites,
+            "testsuite",
+            errors="0",
+            failures=str(len([_record for _record in _records
+                              if _record["status"] not in
+                              ("cancelled", "passed", "skipped")])),
+            name="%ss" % kind,
+            skipped=str(len([_record for _record in _records
+                             if _record["status"] in
+                             ("cancelled", "skipped")])),
+            tests=str(len(_records)),
+            time="%.3f" % sum(_record["duration"] or 0.0
+                              for _record in _records))
+        started = [_record["started"] for _record in _records
+                   if _record["started"] is not None]
+        if bool(started):
+            testsuite.set(
+                "timestamp",
+                datetime.utcfromtimestamp(min(started)).strftime(
+                    "%Y-%m-%dT%H:%M:%S"))
+        for record in _records:
+            testcase = ElementTree.SubElement(
+                testsuite,
+                "testcase",
+                classname="%s.%ss" % (project_name, kind),
+                name=record["name"],
+                time="%.3f" % (record["duration"] or 0.0))
+            properties = ElementTree.SubElement(testcase, "properties")
+            for key in ["cache", "docker_host", "environment", "image",
+                        "image_id", "log_file", "queue_wait"]:
+                if record[key] is not None:
+                    ElementTree.SubElement(
+                        properties,
+                        "property",
+                        name=key,
+                        value="%s" % record[key])
+            if record["status"] in ("cancelled", "skipped"):
+                ElementTree.SubElement(
+                    testcase,
+                    "skipped",
+                    message=" ".join(record["messages"]))
+            elif record["status"] != "passed":
+                failure = ElementTree.SubElement(
+                    testcase,
+                    "failure",
+                    message=" ".join(record["messages"]),
+                    type=record["status"])
+                failure.text = "\n".join(record["log_tail"] or list([]))
+    ElementTree.ElementTree(testsuites).write(
+        path,
+        encoding="utf-8",
+        xml_declaration=True)
+    LOG.info("JUnit report written to %s", path)
+
+
+def _reports(args, config, docker_images, docker_containers, exit_code,
+             start_time=None):
+    """ Write the requested reports """
+    if not args.report_json and not args.report_junit:
+        return
+    records = _report(docker_images, docker_containers)
+    if args.report_json:
+        _report_json(
+            args.report_json,
+            config,
+            records,
+            exit_code,
+            start_time)
+    if args.report_junit:
+        _report_junit(args.report_junit, config, records)
+
+
+def _results(path, config, expected, docker_images, docker_containers,
+             history=None):
+    """
+    Write the results of a run to a JSON file. The history of the jobs is
+    included, so `--merge` can combine the histories of all shards.
+    """
+    keys = [History.image_key(_image) for _image in docker_images]
+    keys += [History.container_key(_container["image_name"],
+                                   _container["environment_name"])
+             for _container in (docker_containers or dict({})).itervalues()]
+    results = {
+        "docker_build_cache": config["docker_build_cache"],
+        "docker_containers": docker_containers,
+        "docker_images": docker_images,
+        "docker_result_cache": config["docker_result_cache"],
+        "expected": expected,
+        "history": history.select(keys) if history is not None else None,
+        "project_name": config["project_name"],
+        "shard": config.get("shard"),
+        "version": __version__}
+    with open(path, "w") as results_file:
+        dump(results, results_file, indent=4, sort_keys=True)
+    LOG.info("Results written to %s", path)
+
+
+def _run_async(config, history, build_only=False):
+    """ Build the images and run the containers with the async engine """
+    if bool(config["docker_hosts"]):
+        raise docker.errors.DockerException(
+            "The async engine doesn't support multiple Docker hosts.")
+    api = AsyncDockerAPI(_docker_socket())
+    api.ping()
+    if config["docker_build_cache"]:
+        LOG.warning("The build cache is not supported by the async engine.")
+        config["docker_build_cache"] = False
+    if config["docker_container_reuse"]:
+        LOG.warning(
+            "The container reuse is not supported by the async engine.")
+        config["docker_container_reuse"] = 0
+    if config["docker_layer_cache"]:
+        LOG.warning("The layer cache is not supported by the async engine.")
+        config["docker_layer_cache"] = None
+    if int(config["prefetch_threads"]):
+        Prefetch(
+            config, DockerClientPool({"default": _docker_client()})).run()
+    docker_images = DockerImages(None, None, config, history)
+    docker_containers = None
+    if not build_only:
+        docker_containers = DockerContainers(
+            None,
+            None,
+            config,
+            history=history)
+    return AsyncEngine(api, config, docker_images, docker_containers).run()
+
+
+def _plan(config, history, build_only=False):
+    """ Display the predicted schedule and makespan """
+    schedule, makespan = Plan(config, history).simulate(build_only)
+    LOG.info("Plan (longest expected job first):")
+    for job, start, end in schedule:
+        _known = "" if history.known(job) else " (no history)"
+        LOG.info(
+            "%s - %s %s%s",
+            Time.in_hms(start),
+            Time.in_hms(end),
+            job,
+            _known)
+    LOG.info("Predicted makespan: %s", Time.in_hms(makespan))
+    return 0
+
+
+def _threads_error(args):
+    """ Check the thread arguments. Returns an error message or None. """
+    for key in ["threads", "build_threads", "run_threads"]:
+        value = getattr(args, key)
+        if value is not None and value < 1:
+            return "--%s has to be at least 1" % key.replace("_", "-")
+    return None
+
+
+def _timeout_error(args):
+    """ Check the timeout arguments. Returns an error message or None. """
+    for key in ["build_timeout", "run_timeout"]:
+        value = getattr(args, key)
+        if value is not None and value <= 0:
+            return "--%s has to be greater than 0" % key.replace("_", "-")
+    return None
+
+
+def _shard_error(args):
+    """ Check the shard arguments. Returns an error message or None. """
+    if args.shard_total is None:
+        if args.shard_index is not None:
+            return "--shard-index requires --shard-total"
+        return None
+    if args.shard_total < 1:
+        return "--shard-total has to be at least 1"
+    if not 0 <= (args.shard_index or 0) < args.shard_total:
+        return "--shard-index has to be between 0 and %s" % \
+            (args.shard_total - 1)
+    return None
+
+
+def _summary(config, expected, docker_images, docker_containers=None,
+             threads=None):
+    """
+    Display the summary of the images and containers and return the exit
+    code. Without containers (None) only the images are summarized.
+    """
+
+    def _objects_messages(objects):
+        sucessfull = 0
+        for obj in objects.itervalues():
+            if obj["exit_code"] == 0:
+                sucessfull += 1
+            _exit_code.append(obj["exit_code"])
+            for message in obj["messages"]:
+                if obj["exit_code"] == 0:
+                    LOG.info(message)
+                else:
+                    LOG.error(message)
+            if obj["exit_code"] != 0 and bool(obj.get("log_tail")):
+                LOG.error(
+                    "Last %s lines of %s:",
+                    len(obj["log_tail"]),
+                    obj["log_file"])
+                for line in obj["log_tail"]:
+                    LOG.error("  %s", line.rstrip())
+        return sucessfull
+
+    def _count_msg(name, sucessfull, expected):
+        msg = "%s: %s/%s" % (name, sucessfull, expected)
+        if sucessfull == expected:
+            LOG.info(msg)
+        else:
+            LOG.error(msg)
+
+    _exit_code = [0]
 
     _summary_msg = "Summary:"
     if config["project_name"] is not None:
         _summary_msg = "Summary for project %s:" % config["project_name"]
     LOG.info(_summary_msg)
-    _objects_messages("image_runs", docker_images)
-    if not args.build_only:
-        _objects_messages("container_runs", docker_containers)
-    LOG.info("Threads: %s", threads)
-    image_msg = "Images: %s/%s" % \
-                (_sucessfull["image_runs"],
-                 _expected["docker_images"])
-    if _sucessfull["image_runs"] == _expected["docker_images"]:
-        LOG.info(image_msg)
-    else:
-        LOG.error(image_msg)
-    if not args.build_only:
-        container_msg = "Containers: %s/%s" % \
-            (_sucessfull["container_runs"],
-             _expected["docker_container_runs"])
-        if _sucessfull["container_runs"] == _expected["docker_container_runs"]:
-            LOG.info(container_msg)
-        else:
-            LOG.error(container_msg)
-    LOG.info("Total duration: %s", Time(_start_time).delta_in_hms())
-
-    exit_code = sum(_exit_code)
-    return exit_code
+    _sucessfull_images = _objects_messages(docker_images)
+    if config["docker_build_cache"]:
+        LOG.info(
+            "Build cache hits: %s/%s",
+            len([_image for _image in docker_images.itervalues()
+                 if _image.get("cache") == "hit"]),
+            expected["docker_images"])
+    if docker_containers is not None:
+        _sucessfull_containers = _objects_messages(docker_containers)
+        if config["docker_result_cache"]:
+            LOG.info(
+                "Result cache hits: %s/%s",
+                len([_container for _container in
+                     docker_containers.itervalues()
+                     if _container.get("cache") == "hit"]),
+                expected["docker_container_runs"])
+    if threads is not None:
+        LOG.info("Threads: %s (build threads: %s, run threads: %s)", *threads)
+    _count_msg("Images", _sucessfull_images, expected["docker_images"])
+    if docker_containers is not None:
+        _count_msg(
+            "Containers",
+            _sucessfull_containers,
+            expected["docker_container_runs"])
+    return sum(_exit_code)
 
 
 def _version():
@@ -708,9 +5619,8 @@ def _version():
     return 0
 
 
-def main():
-    """ Build Docker images and run containers in different environments. """
-
+def _parser():
+    """ Create the parser of the command line arguments """
     parser = ArgumentParser(
         description="Build Docker images and run containers in different"
                     "environments.",
@@ -728,13 +5638,226 @@ def main():
         "-t",
         "--threads",
         dest="threads",
-        help="The amount of threads to use.\n"
-             "(default: 2)")
+        type=int,
+        help="The amount of threads to use. This is the limit for all\n"
+             "parallel image builds and container runs together.\n"
+             "(default: 2, or the build threads + the run threads if one\n"
+             "of them is given)")
+    parser.add_argument(
+        "--build-threads",
+        dest="build_threads",
+        type=int,
+        help="The amount of parallel image builds.\n"
+             "(default: the amount of threads)")
+    parser.add_argument(
+        "--run-threads",
+        dest="run_threads",
+        type=int,
+        help="The amount of parallel container runs.\n"
+             "(default: the amount of threads)")
+    parser.add_argument(
+        "--prefetch-threads",
+        dest="prefetch_threads",
+        type=int,
+        help="The amount of parallel pulls of the base images (FROM)\n"
+             "before the image builds. 0 disables the prefetch.\n"
+             "(default: 4)")
+    parser.add_argument(
+        "--max-load",
+        dest="max_load",
+        metavar="LOAD",
+        type=float,
+        help="Delay new container runs (with an exponential backoff)\n"
+             "while the load average per CPU of the host is above LOAD\n"
+             "or less than 10%% of the memory is available. Only for a\n"
+             "local Docker daemon.\n"
+             "(default: no limit)")
+    parser.add_argument(
+        "--max-pool-size",
+        dest="max_pool_size",
+        metavar="CONNECTIONS",
+        type=int,
+        help="The size of the connection pool of the Docker clients.\n"
+             "The log output is streamed with separate clients (one\n"
+             "connection per container run).\n"
+             "(default: threads + prefetch threads + 1)")
+    parser.add_argument(
+        "--engine",
+        choices=["async", "thread"],
+        dest="engine",
+        help="The execution engine. \"thread\" uses a thread per running\n"
+             "job, \"async\" runs all jobs on one event loop which talks\n"
+             "directly to the Docker unix socket.\n"
+             "(default: thread)")
+    parser.add_argument(
+        "--build-timeout",
+        dest="build_timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Abort image builds which are running longer.\n"
+             "(default: no timeout)")
+    parser.add_argument(
+        "--run-timeout",
+        dest="run_timeout",
+        metavar="SECONDS",
+        type=float,
+        help="Kill container runs which are running longer.\n"
+             "(default: no timeout)")
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        dest="fail_fast",
+        help="Cancel all queued and running image builds and container\n"
+             "runs after the first failure.")
     parser.add_argument(
         "--build-only",
         action="store_true",
         dest="build_only",
         help="Build Docker images. Don't start Docker containers.")
+    parser.add_argument(
+        "--build-cache",
+        action="store_true",
+        dest="build_cache",
+        help="Reuse images if the Dockerfile, the build arguments and the\n"
+             "build context are unchanged.")
+    parser.add_argument(
+        "--result-cache",
+        action="store_true",
+        dest="result_cache",
+        help="Skip container runs which already passed with the same image,\n"
+             "environment and volume content.")
+    parser.add_argument(
+        "--layer-cache",
+        dest="layer_cache",
+        metavar="DIR",
+        help="Load the images of the previous runs from DIR (e.g. a\n"
+             "directory restored by the CI cache) and use them as build\n"
+             "cache. The built images are saved to DIR after the run.")
+    parser.add_argument(
+        "--reuse-containers",
+        dest="reuse_containers",
+        metavar="RUNS",
+        type=int,
+        help="Reuse started containers for up to RUNS container runs of\n"
+             "the same image. The environments are executed inside of the\n"
+             "running containers. A container is replaced after a failed\n"
+             "run.\n"
+             "(default: 0 - every run starts a new container)")
+    parser.add_argument(
+        "--workspace",
+        choices=Workspace.modes,
+        dest="workspace",
+        help="Give every container a private copy of the writable (rw)\n"
+             "volumes. \"copy\" copies them into the cache directory (as\n"
+             "reflinks if possible), \"tmpfs\" into /dev/shm. The copies\n"
+             "are removed after the container run.\n"
+             "(default: the volumes are shared by all containers)")
+    parser.add_argument(
+        "--only",
+        action="append",
+        dest="only",
+        metavar="IMAGE[:ENV]",
+        help="Run only the container runs which are matching the pattern\n"
+             "(shell-style wildcards, e.g. \"Debian_*:env_1\"). Can be used\n"
+             "multiple times. Only the images of the selected container\n"
+             "runs are built.")
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        dest="watch",
+        help="Run, then watch the configuration, the docker_image_path\n"
+             "and the volume sources and re-run only the affected image\n"
+             "builds and container runs on changes. A run in progress is\n"
+             "cancelled by a change. Uses the build cache and private\n"
+             "workspaces (copy). Stop it with Ctrl-C.")
+    parser.add_argument(
+        "--daemon",
+        dest="daemon",
+        metavar="SOCKET",
+        help="Run as daemon: Keep the configurations, the Docker clients\n"
+             "and the histories in memory and execute the runs which are\n"
+             "submitted with --connect to the unix socket SOCKET. The runs\n"
+             "of the submitters take turns. Stop it with Ctrl-C.")
+    parser.add_argument(
+        "--connect",
+        dest="connect",
+        metavar="SOCKET",
+        help="Submit the run (with all other arguments) to the daemon\n"
+             "listening on SOCKET and stream its output. Ctrl-C cancels\n"
+             "the run.")
+    parser.add_argument(
+        "--submitter",
+        dest="submitter",
+        metavar="NAME",
+        help="The name of the submitter of a run (--connect). The runs of\n"
+             "the submitters take turns.\n"
+             "(default: $USER)")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        dest="plan",
+        help="Display the predicted schedule and makespan based on the\n"
+             "durations of the previous runs. Don't build or run anything.")
+    parser.add_argument(
+        "--shard-index",
+        dest="shard_index",
+        metavar="INDEX",
+        type=int,
+        help="The index of the shard to run, starting at 0.\n"
+             "(default: 0)")
+    parser.add_argument(
+        "--shard-total",
+        dest="shard_total",
+        metavar="TOTAL",
+        type=int,
+        help="Split the image builds and container runs into TOTAL\n"
+             "shards (e.g. for multiple CI nodes) and run only the shard\n"
+             "INDEX. The shards are balanced by the durations of the\n"
+             "shard history (--shard-history) or by the number of jobs.")
+    parser.add_argument(
+        "--shard-history",
+        dest="shard_history",
+        metavar="FILE",
+        help="The history file which is used to balance the shards. It\n"
+             "has to be the same file on every node. With --merge the\n"
+             "histories of all shards are merged into FILE.")
+    parser.add_argument(
+        "--results",
+        dest="results",
+        metavar="FILE",
+        help="Write the results of the run to a JSON file.")
+    parser.add_argument(
+        "--report-json",
+        dest="report_json",
+        metavar="FILE",
+        help="Write a JSON report with the timings (queue wait, start,\n"
+             "end, duration), the exit code, the image ID, the environment,\n"
+             "the cache status and the log file of every job.")
+    parser.add_argument(
+        "--report-junit",
+        dest="report_junit",
+        metavar="FILE",
+        help="Write a JUnit XML report of every job.")
+    parser.add_argument(
+        "--trace",
+        dest="trace",
+        metavar="FILE",
+        help="Write a timeline of the run (Chrome trace event format, one\n"
+             "track per worker thread) to FILE. It can be opened with\n"
+             "chrome://tracing or https://ui.perfetto.dev.")
+    parser.add_argument(
+        "--merge",
+        dest="merge",
+        metavar="FILE",
+        nargs="+",
+        help="Merge the results files of multiple (sharded) runs and\n"
+             "display the summary. Don't build or run anything.")
+    parser.add_argument(
+        "--live-output",
+        action="store_true",
+        dest="live_output",
+        help="Display the output of the container runs while they are\n"
+             "running. The output is always written to the log files.")
     parser.add_argument(
         "--log-level",
         dest="log_level",
@@ -752,11 +5875,46 @@ def main():
         action="store_true",
         dest="version",
         help="Display version information.")
+    return parser
+
+
+def main():
+    """ Build Docker images and run containers in different environments. """
+
+    parser = _parser()
     args = parser.parse_args()
 
     if args.version:
         exit(_version())
 
+    if _shard_error(args) is not None:
+        parser.error(_shard_error(args))
+
+    if _threads_error(args) is not None:
+        parser.error(_threads_error(args))
+
+    if _timeout_error(args) is not None:
+        parser.error(_timeout_error(args))
+
+    if args.merge:
+        exit(_merge(args))
+
+    if args.daemon:
+        exit(Daemon(args).run())
+
+    if args.connect:
+        if args.watch:
+            parser.error("--watch can't be used with --connect")
+        _logger(args.log_level or "INFO", args.disable_logging)
+        exit(DaemonClient(args.connect).submit(
+            sys.argv[1:],
+            args.submitter or os.environ.get("USER") or "default"))
+
+    if args.watch:
+        if args.plan or args.shard_total is not None:
+            parser.error("--watch can't be used with --plan or --shard-total")
+        exit(Watch(args).run())
+
     exit(_run(args))
 
 
@@ -0,0 +1,720 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+
+"""
+DOCUMENTATION
+---
+script: docker_test_runner_benchmark
+author: "Timo Runge (@timorunge)"
+short_description: Measure the overhead and the scaling of
+                    `docker_test_runner` without a Docker daemon.
+description:
+    A fake Docker client (with configurable build and run latencies, log
+    volume and failure rates) is plugged into `docker_test_runner`. Every
+    matrix size is executed in a separate process with a synthetic
+    configuration and the following values are reported:
+
+    - Wall time and CPU time (user + system) of the runner
+    - Peak RSS and peak amount of threads
+    - Scheduling efficiency (ideal makespan vs. wall time)
+"""
+
+
+from __future__ import print_function
+from argparse import ArgumentParser, RawTextHelpFormatter
+import hashlib
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from threading import Event, Lock, Thread, active_count
+from Queue import Queue
+from time import sleep, time
+from json import dump, dumps, load, loads
+from yaml import safe_dump
+import docker
+
+import docker_test_runner
+
+
+__author__ = "Timo Runge"
+__copyright__ = "Copyright 2018, Timo Runge"
+__email__ = "me@timorunge.com"
+__license__ = "BSD 3-Clause 'New' or 'Revised' License"
+__maintainer__ = "Timo Runge"
+__title__ = "docker_test_runner_benchmark"
+__version__ = docker_test_runner.__version__
+
+
+# Fake Docker client
+
+
+class Latency(object):
+    """
+    Deterministic latencies and failures of the fake jobs. The values of a
+    job only depend on its name and the seed, so the ideal makespan can be
+    calculated before the run.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def build(self, image):
+        """ Get the build duration of an image """
+        return self._duration(
+            "build:%s" % image,
+            self.settings["build_time"])
+
+    def build_failed(self, image):
+        """ Check if the build of an image fails """
+        return self._random("build_failure:%s" % image) < \
+            self.settings["build_failure_rate"]
+
+    def run(self, image, environment):
+        """ Get the duration of a container run """
+        return self._duration(
+            "run:%s:%s" % (image, environment),
+            self.settings["run_time"])
+
+    def run_failed(self, image, environment):
+        """ Check if a container run fails """
+        return self._random("run_failure:%s:%s" % (image, environment)) < \
+            self.settings["run_failure_rate"]
+
+    def _duration(self, key, mean):
+        jitter = float(self.settings["jitter"])
+        return max(0.0, mean * (1 + jitter * (2 * self._random(key) - 1)))
+
+    def _random(self, key):
+        digest = hashlib.md5(
+            "%s:%s" % (self.settings["seed"], key)).hexdigest()
+        return int(digest[:8], 16) / float(0xffffffff)
+
+
+class FakeContainer(object):
+    """ A container which produces log lines until its duration is over """
+
+    def __init__(self, client, image, name, environment=None):
+        self.client = client
+        self.environment = environment
+        self.id = hashlib.sha256(name).hexdigest()  # pylint: disable=C0103
+        self.image = image
+        self.killed = Event()
+        self.name = name
+
+    def kill(self):
+        """ Stop the output immediately """
+        self.killed.set()
+
+    def logs(self, stream=True):
+        """ Stream the log output of the run """
+        del stream
+        return self.client.output(
+            self.client.latency.run(self.image.name, self._env(self.env())),
+            self.killed)
+
+    def env(self):
+        """ Get the environment of the container run """
+        return self.environment or dict({})
+
+    def remove(self, **kwargs):
+        """ Remove the container (nothing to do) """
+
+    def stop(self, **kwargs):
+        """ Stop the container """
+        self.killed.set()
+
+    def wait(self):
+        """ Get the exit code of the container run """
+        if self.killed.is_set():
+            return {"StatusCode": 137}
+        failed = self.client.latency.run_failed(
+            self.image.name,
+            self._env(self.env()))
+        return {"StatusCode": 1 if failed else 0}
+
+    @staticmethod
+    def _env(environment):
+        return environment.get("BENCHMARK_ENVIRONMENT")
+
+
+class FakeImage(object):
+    """ An image which was built by the fake Docker client """
+
+    def __init__(self, name, tag):
+        digest = hashlib.sha256(tag).hexdigest()
+        self.attrs = {"Config": {"Cmd": None, "Entrypoint": ["/run.sh"]}}
+        self.id = "sha256:%s" % digest  # pylint: disable=C0103
+        self.name = name
+        self.short_id = self.id[:17]
+        self.tags = [tag]
+
+    def save(self):
+        """ Export the image """
+        yield dumps({"name": self.name, "tag": self.tags[0]})
+
+    def tag(self, repository, tag=None):
+        """ Add a tag to the image """
+        self.tags.append("%s:%s" % (repository, tag))
+        return True
+
+
+class FakeEvents(object):
+    """ The event stream of the fake client (until it's closed) """
+
+    def __init__(self):
+        self.queue = Queue()
+
+    def __iter__(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        """ Stop the stream """
+        self.queue.put(None)
+
+
+class FakeAPI(object):
+    """
+    The low level API (image builds, execs, logs and events) of the fake
+    client
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.counter = 0
+        self.events_streams = list([])
+        self.execs = dict({})
+        self.lock = Lock()
+
+    def build(self, dockerfile=None, tag=None, **kwargs):
+        """ Stream the build output of an image """
+        del kwargs
+        name = dockerfile[len("Dockerfile_"):]
+        return self._build(name, tag)
+
+    def events(self, **kwargs):
+        """ Subscribe to the `die` events of the containers """
+        del kwargs
+        stream = FakeEvents()
+        with self.lock:
+            self.events_streams.append(stream)
+        return stream
+
+    def exec_create(self, container, command, environment=None, **kwargs):
+        """ Create an exec instance in a (pooled) container """
+        del command, kwargs
+        with self.lock:
+            self.counter += 1
+            exec_id = "exec_%s" % self.counter
+            self.execs[exec_id] = FakeContainer(
+                self.client,
+                self.client.containers.get(container).image,
+                exec_id,
+                environment)
+        return {"Id": exec_id}
+
+    def exec_inspect(self, exec_id):
+        """ Get the exit code of an exec instance """
+        with self.lock:
+            container = self.execs.pop(exec_id)
+        return {"ExitCode": container.wait()["StatusCode"]}
+
+    def exec_start(self, exec_id, stream=True):
+        """ Stream the output of an exec instance """
+        with self.lock:
+            container = self.execs[exec_id]
+        return container.logs(stream)
+
+    def logs(self, container, **kwargs):
+        """ Stream the log output of a container and send its `die` event """
+        del kwargs
+        container = self.client.containers.get(container)
+        for chunk in container.logs():
+            yield chunk
+        event = {
+            "Action": "die",
+            "Actor": {"Attributes": {
+                "exitCode": str(container.wait()["StatusCode"]),
+                "name": container.name}}}
+        with self.lock:
+            streams = list(self.events_streams)
+        for stream in streams:
+            stream.queue.put(event)
+
+    def _build(self, name, tag):
+        killed = Event()
+        for chunk in self.client.output(
+                self.client.latency.build(name),
+                killed,
+                lambda line: {"stream": line}):
+            yield chunk
+        if self.client.latency.build_failed(name):
+            yield {"error": "The build of %s failed (benchmark)." % name}
+            return
+        image = self.client.images.add(FakeImage(name, tag))
+        yield {"stream": "Successfully built %s\n" % image.id[7:19]}
+
+
+class FakeContainers(object):
+    """ The container collection of the fake client """
+
+    def __init__(self, client):
+        self.client = client
+        self.containers = dict({})
+        self.lock = Lock()
+
+    def get(self, container_id):
+        """ Get a started container """
+        with self.lock:
+            return self.containers[container_id]
+
+    def run(self, image, name=None, environment=None, **kwargs):
+        """ Start a container """
+        del kwargs
+        container = FakeContainer(
+            self.client,
+            self.client.images.get(image),
+            name,
+            environment)
+        with self.lock:
+            self.containers[container.id] = container
+        return container
+
+
+class FakeImages(object):
+    """ The image collection of the fake client """
+
+    def __init__(self):
+        self.images = dict({})
+        self.lock = Lock()
+
+    def add(self, image):
+        """ Register an image """
+        with self.lock:
+            self.images[image.id] = image
+        return image
+
+    def get(self, name):
+        """ Get an image by ID, short ID or tag """
+        with self.lock:
+            for image in self.images.itervalues():
+                if name in (image.id, image.short_id, image.id[7:19]) or \
+                        name in image.tags:
+                    return image
+        raise docker.errors.ImageNotFound(name)
+
+    def load(self, data):
+        """ Import an image """
+        image = loads(b"".join(data))
+        return [self.add(FakeImage(image["name"], image["tag"]))]
+
+
+class FakeDockerClient(object):  # pylint: disable=R0903
+    """
+    A Docker client which simulates the image builds and the container runs
+    with the latencies, the log volume and the failure rates of the
+    benchmark settings.
+    """
+
+    def __init__(self, settings):
+        self.api = FakeAPI(self)
+        self.containers = FakeContainers(self)
+        self.images = FakeImages()
+        self.latency = Latency(settings)
+        self.settings = settings
+
+    @staticmethod
+    def info():
+        """ The fake daemon has enough resources for all container runs """
+        return {"MemTotal": 1024 ** 4, "NCPU": 1024}
+
+    def output(self, duration, killed, wrap=None):
+        """
+        Yield the log lines of a job in (up to) ten chunks which are spread
+        over the duration. Stops if the job is killed.
+        """
+        lines = int(self.settings["log_lines"])
+        line = "%s\n" % ("x" * max(0, int(self.settings["line_size"]) - 1))
+        chunks = max(1, min(10, lines))
+        for chunk in range(chunks):
+            if killed.wait(duration / chunks):
+                return
+            count = lines // chunks + (1 if chunk < lines % chunks else 0)
+            if count:
+                yield wrap(line * count) if wrap else line * count
+
+    @staticmethod
+    def ping():
+        """ The fake daemon is always available """
+        return True
+
+
+# Benchmark
+
+
+class ThreadSampler(Thread):
+    """ Sample the amount of threads (without the sampler itself) """
+
+    def __init__(self, interval=0.005):
+        Thread.__init__(self, name="ThreadSampler")
+        self.daemon = True
+        self.interval = interval
+        self.peak = 0
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, active_count() - 1)
+            sleep(self.interval)
+
+    def stop(self):
+        """ Stop sampling and get the peak amount of threads """
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def _ideal_makespan(settings, images, environments):
+    """
+    Get the lower bound of the makespan: The work divided by the threads
+    (total, build and run) or the longest image build plus its longest
+    container run, whichever is larger.
+    """
+    latency = Latency(settings)
+    threads = int(settings["threads"])
+    build_threads = min(threads, int(settings["build_threads"] or threads))
+    run_threads = min(threads, int(settings["run_threads"] or threads))
+    build_work = 0.0
+    run_work = 0.0
+    critical_path = 0.0
+    for image in images:
+        build = latency.build(image)
+        build_work += build
+        runs = list([])
+        if not latency.build_failed(image):
+            runs = [latency.run(image, _env) for _env in environments]
+        run_work += sum(runs)
+        critical_path = max(critical_path, build + max(runs or [0.0]))
+    return max(
+        critical_path,
+        build_work / build_threads,
+        run_work / run_threads,
+        (build_work + run_work) / threads)
+
+
+def _matrix(settings, jobs):
+    """ Get the image and environment names of a matrix with `jobs` runs """
+    images = max(1, min(int(settings["images"]), jobs))
+    environments = max(1, -(-jobs // images))
+    return (["Image_%s" % _index for _index in range(images)],
+            ["env_%s" % _index for _index in range(environments)])
+
+
+def _scenario(settings, jobs):
+    """
+    Execute a single benchmark in the current process. The synthetic
+    configuration is created in a temporary directory.
+    """
+    images, environments = _matrix(settings, jobs)
+    work_dir = tempfile.mkdtemp(prefix="docker_test_runner_benchmark_")
+    try:
+        image_path = os.path.join(work_dir, "docker")
+        os.makedirs(image_path)
+        for image in images:
+            with open(os.path.join(image_path, "Dockerfile_%s" % image),
+                      "w") as dockerfile:
+                dockerfile.write("FROM scratch\n")
+        config_file = os.path.join(work_dir, "docker_test_runner.yml")
+        with open(config_file, "w") as _config_file:
+            safe_dump({
+                "cache_dir": os.path.join(work_dir, "cache"),
+                "docker_container_environments": dict(
+                    (_env, {"BENCHMARK_ENVIRONMENT": _env})
+                    for _env in environments),
+                "docker_image_build_args": dict({}),
+                "docker_image_path": image_path,
+                "docker_images": images,
+                "engine": "thread",
+                "project_name": "Benchmark"}, _config_file)
+        args = ["--file", config_file, "--threads", str(settings["threads"])]
+        for key in ["build_threads", "run_threads"]:
+            if settings[key]:
+                args += ["--%s" % key.replace("_", "-"), str(settings[key])]
+        parser = docker_test_runner._parser()  # pylint: disable=W0212
+        args = parser.parse_args(args + settings["runner_args"])
+        client = FakeDockerClient(settings)
+        docker_test_runner._docker_client = \
+            lambda base_url=None, max_pool_size=None: \
+            client  # pylint: disable=W0212
+        os.chdir(work_dir)
+        sampler = ThreadSampler()
+        sampler.start()
+        cpu_time = os.times()
+        start_time = time()
+        exit_code = docker_test_runner._run(args)  # pylint: disable=W0212
+        wall_time = time() - start_time
+        cpu_time = sum(os.times()[:2]) - sum(cpu_time[:2])
+        threads = sampler.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    ideal = _ideal_makespan(settings, images, environments)
+    return {
+        "cpu_time": cpu_time,
+        "efficiency": ideal / wall_time if wall_time else 0.0,
+        "environments": len(environments),
+        "exit_code": exit_code,
+        "ideal_makespan": ideal,
+        "images": len(images),
+        "jobs": len(images) * len(environments),
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_threads": threads,
+        "wall_time": wall_time}
+
+
+def _run_scenario(settings, jobs):
+    """
+    Execute a benchmark in a new process (for a clean peak RSS, thread
+    count and runner state).
+    """
+    result_fd, result_file = tempfile.mkstemp(suffix=".json")
+    os.close(result_fd)
+    try:
+        output = None
+        if not settings["verbose"]:
+            output = open(os.devnull, "w")
+        try:
+            subprocess.check_call(
+                [sys.executable, os.path.abspath(__file__),
+                 "--scenario", dumps(settings), str(jobs), result_file],
+                stdout=output,
+                stderr=output)
+        finally:
+            if output is not None:
+                output.close()
+        with open(result_file, "r") as _result_file:
+            return load(_result_file)
+    finally:
+        os.remove(result_file)
+
+
+def _compare(baseline_file, results, tolerance):
+    """
+    Compare the wall and CPU times with a baseline. Returns the amount of
+    regressions (results which are slower than the baseline + tolerance).
+    """
+    with open(baseline_file, "r") as _baseline_file:
+        baseline = dict(
+            (_result["jobs"], _result)
+            for _result in load(_baseline_file)["results"])
+    regressions = 0
+    for result in results:
+        if result["jobs"] not in baseline:
+            continue
+        for key in ["wall_time", "cpu_time"]:
+            limit = baseline[result["jobs"]][key] * (1 + tolerance)
+            if result[key] > limit:
+                regressions += 1
+                print("Regression: %s jobs %s %.3fs > %.3fs (baseline "
+                      "%.3fs + %s%%)" % (
+                          result["jobs"],
+                          key,
+                          result[key],
+                          limit,
+                          baseline[result["jobs"]][key],
+                          int(tolerance * 100)))
+    return regressions
+
+
+def _print(results):
+    """ Print the results as table """
+    columns = [
+        ("Jobs", "jobs", "%d"),
+        ("Images", "images", "%d"),
+        ("Wall (s)", "wall_time", "%.2f"),
+        ("Ideal (s)", "ideal_makespan", "%.2f"),
+        ("Efficiency", "efficiency", "%.1f%%"),
+        ("CPU (s)", "cpu_time", "%.2f"),
+        ("Peak RSS (MiB)", "peak_rss_mib", "%.1f"),
+        ("Threads", "peak_threads", "%d"),
+        ("Exit code", "exit_code", "%d")]
+    rows = list([])
+    for result in results:
+        values = dict(result)
+        values["efficiency"] = result["efficiency"] * 100
+        values["peak_rss_mib"] = result["peak_rss_kib"] / 1024.0
+        rows.append([_format % values[_key] for _, _key, _format in columns])
+    widths = [max(len(_title), *[len(_row[_index]) for _row in rows])
+              for _index, (_title, _, _) in enumerate(columns)]
+    print("  ".join(_title.rjust(_width) for (_title, _, _), _width in
+                    zip(columns, widths)))
+    for row in rows:
+        print("  ".join(_value.rjust(_width) for _value, _width in
+                        zip(row, widths)))
+
+
+def main():
+    """ Benchmark `docker_test_runner` with a fake Docker client. """
+
+    if len(sys.argv) == 5 and sys.argv[1] == "--scenario":
+        result = _scenario(loads(sys.argv[2]), int(sys.argv[3]))
+        with open(sys.argv[4], "w") as result_file:
+            dump(result, result_file)
+        exit(0)
+
+    parser = ArgumentParser(
+        description="Benchmark docker_test_runner with a fake Docker client. "
+                    "Unknown arguments are passed to docker_test_runner "
+                    "(e.g. --reuse-containers 4).",
+        formatter_class=RawTextHelpFormatter)
+    parser.add_argument(
+        "--jobs",
+        default=[10, 100, 1000, 5000],
+        dest="jobs",
+        metavar="JOBS",
+        nargs="+",
+        type=int,
+        help="The sizes of the synthetic matrices (container runs).\n"
+             "(default: 10 100 1000 5000)")
+    parser.add_argument(
+        "--images",
+        default=10,
+        dest="images",
+        type=int,
+        help="The amount of images of a matrix.\n"
+             "(default: 10)")
+    parser.add_argument(
+        "-t",
+        "--threads",
+        default=16,
+        dest="threads",
+        type=int,
+        help="The amount of threads of docker_test_runner.\n"
+             "(default: 16)")
+    parser.add_argument(
+        "--build-threads",
+        dest="build_threads",
+        type=int,
+        help="The amount of parallel image builds.\n"
+             "(default: the amount of threads)")
+    parser.add_argument(
+        "--run-threads",
+        dest="run_threads",
+        type=int,
+        help="The amount of parallel container runs.\n"
+             "(default: the amount of threads)")
+    parser.add_argument(
+        "--build-time",
+        default=0.5,
+        dest="build_time",
+        metavar="SECONDS",
+        type=float,
+        help="The mean duration of an image build.\n"
+             "(default: 0.5)")
+    parser.add_argument(
+        "--run-time",
+        default=0.05,
+        dest="run_time",
+        metavar="SECONDS",
+        type=float,
+        help="The mean duration of a container run.\n"
+             "(default: 0.05)")
+    parser.add_argument(
+        "--jitter",
+        default=0.5,
+        dest="jitter",
+        type=float,
+        help="The relative deviation of the durations from the mean.\n"
+             "(default: 0.5)")
+    parser.add_argument(
+        "--log-lines",
+        default=100,
+        dest="log_lines",
+        type=int,
+        help="The amount of log lines of a build or a container run.\n"
+             "(default: 100)")
+    parser.add_argument(
+        "--line-size",
+        default=80,
+        dest="line_size",
+        metavar="BYTES",
+        type=int,
+        help="The size of a log line.\n"
+             "(default: 80)")
+    parser.add_argument(
+        "--build-failure-rate",
+        default=0.0,
+        dest="build_failure_rate",
+        metavar="RATE",
+        type=float,
+        help="The rate (0.0 - 1.0) of failing image builds.\n"
+             "(default: 0.0)")
+    parser.add_argument(
+        "--run-failure-rate",
+        default=0.0,
+        dest="run_failure_rate",
+        metavar="RATE",
+        type=float,
+        help="The rate (0.0 - 1.0) of failing container runs.\n"
+             "(default: 0.0)")
+    parser.add_argument(
+        "--seed",
+        default=0,
+        dest="seed",
+        type=int,
+        help="The seed of the latencies and failures.\n"
+             "(default: 0)")
+    parser.add_argument(
+        "--json",
+        dest="json",
+        metavar="FILE",
+        help="Write the results to a JSON file (e.g. as baseline).")
+    parser.add_argument(
+        "--baseline",
+        dest="baseline",
+        metavar="FILE",
+        help="Compare the wall and CPU times with the results of a\n"
+             "previous benchmark. Exits with 1 on regressions.")
+    parser.add_argument(
+        "--tolerance",
+        default=0.2,
+        dest="tolerance",
+        type=float,
+        help="The allowed relative regression compared to the baseline.\n"
+             "(default: 0.2)")
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        dest="verbose",
+        help="Display the output of docker_test_runner.")
+    args, runner_args = parser.parse_known_args()
+
+    for runner_arg in runner_args:
+        if runner_arg.split("=")[0] in ["-f", "--file", "--engine"]:
+            parser.error("%s can't be used in the benchmark." % runner_arg)
+
+    settings = vars(args)
+    settings["runner_args"] = runner_args
+    results = list([])
+    for jobs in args.jobs:
+        results.append(_run_scenario(settings, jobs))
+    _print(results)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            dump({"results": results, "settings": settings}, json_file,
+                 indent=2, sort_keys=True)
+
+    if args.baseline and _compare(args.baseline, results, args.tolerance):
+        exit(1)
+    exit(0)
+
+
+if __name__ == "__main__":
+    main()
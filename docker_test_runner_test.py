@@ -0,0 +1,1946 @@
+#!/usr/bin/env python2
+# coding: utf-8
+
+
+"""
+DOCUMENTATION
+---
+script: docker_test_runner_test
+author: "Timo Runge (@timorunge)"
+short_description: Test `docker_test_runner` against fake Docker daemons.
+description:
+    A fake Docker Engine API is served on a unix socket (one per Docker
+    host). Image builds, container runs and their log output are simulated
+    and every request is recorded, so the engines can be tested without a
+    Docker daemon:
+
+    - Pipeline (container runs start while other images are built)
+    - Worker pools (thread limit, cancellation and timeouts)
+    - History (longest expected job first) and the plan
+    - JSON and JUnit XML reports
+    - Trace (Chrome trace event format)
+    - Async engine (event loop) and its error handling
+    - Multiple Docker daemons (placement and image transfers)
+    - Prefetch of the base images
+    - Thread limits and timeouts
+    - Container pool (with a stub of the Docker client) and workspaces
+    - Container events
+    - Admission (resource requests of the container runs)
+    - Build context, build cache and result cache
+    - Layer cache (blob store)
+    - Image dependencies
+    - Matrix (skips and filters of the container runs)
+    - Sharding (partitioning and merging of the results)
+    - Watch mode (jobs which are affected by changes)
+    - Runner daemon (submits, turns of the submitters and cancels)
+"""
+
+
+from __future__ import print_function
+from BaseHTTPServer import BaseHTTPRequestHandler
+import hashlib
+import logging
+import os
+import re
+import shutil
+import socket
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from StringIO import StringIO
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+from threading import Event, Lock, Thread
+from Queue import Queue
+from time import sleep, time
+from json import dumps, load, loads
+import unittest
+from urlparse import parse_qsl, urlparse
+from xml.etree import ElementTree
+from yaml import safe_dump
+
+import docker_test_runner
+
+
+__author__ = "Timo Runge"
+__copyright__ = "Copyright 2018, Timo Runge"
+__email__ = "me@timorunge.com"
+__license__ = "BSD 3-Clause 'New' or 'Revised' License"
+__maintainer__ = "Timo Runge"
+__title__ = "docker_test_runner_test"
+__version__ = docker_test_runner.__version__
+
+
+# Fake Docker daemon
+
+
+class FakeDockerDaemon(object):  # pylint: disable=R0902,R0904
+    """
+    A fake Docker Engine API on a unix socket. Every container runs for
+    `run_time` seconds and produces a few log lines. Containers with a name
+    which contains one of the `wait_errors` are answered with an error by
+    `/wait` (while their logs are still streamed). Image loads take
+    `load_time` seconds, image builds (of tags which contain one of the
+    `slow_builds`, all by default) hang for `build_time` seconds after
+    their first output. Builds of tags which contain one of the
+    `build_errors` are failing (after 0.3 seconds).
+    """
+
+    def __init__(  # pylint: disable=R0913
+            self,
+            path,
+            run_time=0.2,
+            wait_errors=None,
+            load_time=0.0,
+            build_time=0.0,
+            build_errors=None,
+            slow_builds=None):
+        self.build_errors = build_errors or list([])
+        self.build_time = build_time
+        self.containers = dict({})
+        self.events = list([])
+        self.images = dict({})
+        self.load_time = load_time
+        self.lock = Lock()
+        self.path = path
+        self.peak = 0
+        self.requests = list([])
+        self.run_time = run_time
+        self.running = set([])
+        self.server = None
+        self.slow_builds = slow_builds
+        self.stopping = Event()
+        self.wait_errors = wait_errors or list([])
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add_image(self, tags, image_id=None):
+        """ Register an image. Returns the image ID. """
+        image_id = image_id or "sha256:%s" % hashlib.sha256(
+            ",".join(tags)).hexdigest()
+        with self.lock:
+            self.images.setdefault(image_id, set([])).update(tags)
+        return image_id
+
+    def count(self, method, pattern):
+        """ Count the recorded requests which are matching a pattern """
+        return len(self.times(method, pattern))
+
+    def create(self, name, config):
+        """ Create a container """
+        container_id = hashlib.sha256(name).hexdigest()
+        with self.lock:
+            self.containers[container_id] = {
+                "config": config, "finished": False, "killed": False,
+                "name": name}
+        return container_id
+
+    def finish(self, container_id, exit_code):
+        """ Stop a container and send its `die` event (once) """
+        with self.lock:
+            container = self.containers[container_id]
+            self.running.discard(container_id)
+            if container["finished"]:
+                return
+            container["finished"] = True
+            streams = list(self.events)
+        event = {
+            "Action": "die",
+            "Actor": {"Attributes": {"exitCode": str(exit_code),
+                                     "name": container["name"]}},
+            "Type": "container"}
+        for stream in streams:
+            stream.put(event)
+
+    def image(self, name):
+        """ Get the ID and the tags of an image (by ID or tag) or None """
+        with self.lock:
+            for image_id, tags in self.images.iteritems():
+                if name in (image_id, image_id[7:19]) or name in tags or \
+                        "%s:latest" % name in tags:
+                    return image_id, sorted(tags)
+        return None
+
+    def kill(self, container_id):
+        """ Stop a container (its logs and its wait) """
+        with self.lock:
+            if container_id in self.containers:
+                self.containers[container_id]["killed"] = True
+        self.finish(container_id, 137)
+
+    def run(self, container_id):
+        """
+        Wait until the run of a container is over. Returns False if the
+        container was killed.
+        """
+        end = time() + self.run_time
+        while time() < end:
+            with self.lock:
+                if self.containers[container_id]["killed"]:
+                    return False
+            sleep(0.01)
+        return True
+
+    def start(self):
+        """ Serve the API (in a thread) """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = _FakeDockerServer(self.path, _FakeDockerHandler)
+        self.server.daemon = self
+        thread = Thread(target=self.server.serve_forever, name=self.path)
+        thread.daemon = True
+        thread.start()
+
+    def start_container(self, container_id):
+        """ Start a container (and track the peak of running containers) """
+        with self.lock:
+            self.running.add(container_id)
+            self.peak = max(self.peak, len(self.running))
+
+    def stop(self):
+        """ Stop serving the API """
+        self.stopping.set()
+        with self.lock:
+            streams = list(self.events)
+        for stream in streams:
+            stream.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+        for request, thread in list(self.server.threads):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(5.0)
+        os.remove(self.path)
+
+    def times(self, method, pattern):
+        """ Get the times of the requests which are matching a pattern """
+        with self.lock:
+            return [_time for _method, _path, _time in self.requests
+                    if _method == method and re.search(pattern, _path)]
+
+
+class _FakeDockerHandler(BaseHTTPRequestHandler):
+    """ The request handler of the fake Docker daemon """
+
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "unix"
+
+    def do_DELETE(self):  # pylint: disable=C0103
+        """ Remove a container """
+        path, _ = self._path()
+        match = re.match(r"^/containers/([^/]+)$", path)
+        if match:
+            self.server.daemon.kill(match.group(1))
+            self._send(204)
+            return
+        self._send(404, {"message": "Not found: %s" % path})
+
+    def do_GET(self):  # pylint: disable=C0103
+        """ Ping, version, info, events, images and containers """
+        path, _ = self._path()
+        daemon = self.server.daemon
+        match = re.match(r"^/(containers|images)/(.+)/(json|logs|get)$", path)
+        if path == "/_ping":
+            self._send(200, "OK")
+        elif path == "/info":
+            self._send(200, {"MemTotal": 1024 ** 4, "NCPU": 1024})
+        elif path == "/version":
+            self._send(200, {"ApiVersion": "1.35", "Version": "fake"})
+        elif path == "/events":
+            self._stream(self._events(daemon))
+        elif match and match.group(1) == "containers":
+            self._container(daemon, match.group(2), match.group(3))
+        elif match:
+            self._image(daemon, match.group(2), match.group(3))
+        else:
+            self._send(404, {"message": "Not found: %s" % path})
+
+    def do_POST(self):  # pylint: disable=C0103
+        """
+        Builds, image loads and pulls and containers (create, start, wait,
+        kill)
+        """
+        path, query = self._path()
+        body = self._body()
+        daemon = self.server.daemon
+        match = re.match(r"^/containers/([^/]+)/(start|wait|kill)$", path)
+        if path == "/build":
+            self._stream(self._build(daemon, query["t"]))
+        elif path == "/images/load":
+            self._stream(self._load(daemon, body))
+        elif path == "/images/create":
+            daemon.add_image(["%s:%s" % (query["fromImage"], query["tag"])])
+            self._stream(["%s\r\n" % dumps({"status": "Pulled (fake)"})])
+        elif path == "/containers/create":
+            self._send(201, {"Id": daemon.create(query["name"],
+                                                 loads(body))})
+        elif match and match.group(2) == "start":
+            daemon.start_container(match.group(1))
+            self._send(204)
+        elif match and match.group(2) == "kill":
+            daemon.kill(match.group(1))
+            self._send(204)
+        elif match:
+            self._wait(daemon, match.group(1))
+        else:
+            self._send(404, {"message": "Not found: %s" % path})
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """ Don't log the requests """
+
+    def _body(self):
+        if self.headers.getheader("Transfer-Encoding") == "chunked":
+            chunks = list([])
+            while True:
+                size = int(self.rfile.readline().split(";")[0], 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if size == 0:
+                    return b"".join(chunks)
+        length = int(self.headers.getheader("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    @staticmethod
+    def _build(daemon, tag):
+        image_id = daemon.add_image([tag])
+        yield "%s\r\n" % dumps({"stream": "Step 1/1 : FROM scratch\n"})
+        if any(_error in tag for _error in daemon.build_errors):
+            # After the other builds have started
+            daemon.stopping.wait(0.3)
+            yield "%s\r\n" % dumps({"error": "Build failed (fake)."})
+            return
+        if daemon.slow_builds is None or \
+                any(_slow in tag for _slow in daemon.slow_builds):
+            daemon.stopping.wait(daemon.build_time)
+        yield "%s\r\n" % dumps({"aux": {"ID": image_id}})
+        yield "%s\r\n" % dumps(
+            {"stream": "Successfully built %s\n" % image_id[7:19]})
+
+    def _container(self, daemon, container_id, action):
+        with daemon.lock:
+            container = daemon.containers.get(container_id)
+        if container is None:
+            self._send(404, {"message": "No such container"})
+        elif action == "json":
+            self._send(200, {"Config": {"Tty": False},
+                             "Id": container_id,
+                             "Name": "/%s" % container["name"],
+                             "State": {"Running": True}})
+        else:
+            self._stream(self._logs(daemon, container_id))
+
+    @staticmethod
+    def _events(daemon):
+        stream = Queue()
+        with daemon.lock:
+            daemon.events.append(stream)
+        while True:
+            event = stream.get()
+            if event is None:
+                return
+            yield "%s\n" % dumps(event)
+
+    def _image(self, daemon, name, action):
+        image = daemon.image(name)
+        if image is None:
+            self._send(404, {"message": "No such image: %s" % name})
+        elif action == "json":
+            self._send(200, {"Id": image[0], "RepoTags": image[1]})
+        else:
+            self._send(200, {"id": image[0], "tags": image[1]})
+
+    @staticmethod
+    def _load(daemon, body):
+        sleep(daemon.load_time)
+        image = loads(body)
+        daemon.add_image(image["tags"], image["id"])
+        yield "%s\r\n" % dumps(
+            {"stream": "Loaded image ID: %s\n" % image["id"]})
+
+    @staticmethod
+    def _logs(daemon, container_id):
+        for index in range(2):
+            line = "Log line %s\n" % index
+            yield struct.pack(">BxxxL", 1, len(line)) + line
+            if index == 0 and not daemon.run(container_id):
+                return
+        daemon.finish(container_id, 0)
+
+    def _path(self):
+        url = urlparse(self.path)
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        with self.server.daemon.lock:
+            self.server.daemon.requests.append((self.command, path, time()))
+        return path, dict(parse_qsl(url.query))
+
+    def _send(self, status, body=None):
+        data = dumps(body) if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, chunks):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+        self.wfile.write("0\r\n\r\n")
+
+    def _wait(self, daemon, container_id):
+        with daemon.lock:
+            name = daemon.containers[container_id]["name"]
+        if any(_error in name for _error in daemon.wait_errors):
+            self._send(500, {"message": "Wait failed (fake)."})
+            return
+        exit_code = 0 if daemon.run(container_id) else 137
+        daemon.finish(container_id, exit_code)
+        self._send(200, {"StatusCode": exit_code})
+
+
+class _FakeDockerClient(object):
+    """
+    A stub of `docker.DockerClient` for the container pool. The started
+    containers are recorded with the arguments of `containers.run`.
+    """
+
+    def __init__(self):
+        self.containers = self
+        self.images = self
+        self.started = list([])
+
+    def get(self, image_id):
+        """ Get an image """
+        del image_id
+        return _Stub(attrs={"Config": {"Cmd": ["/bin/true"]}})
+
+    def run(self, image, **kwargs):
+        """ Start a container """
+        del image
+        container = _Stub(
+            id="container_%s" % len(self.started),
+            kwargs=kwargs,
+            name=kwargs["name"],
+            stop=lambda timeout: container.__dict__.update(stopped=True),
+            stopped=False)
+        self.started.append(container)
+        return container
+
+
+class _Job(object):  # pylint: disable=R0902
+    """
+    A job of a worker pool which runs for `run_time` seconds (or until it's
+    cancelled). The running jobs are counted in `running` (a dictionary with
+    the current and the peak count).
+    """
+
+    kind = "Job"
+
+    def __init__(self, name, running, run_time=0.1, timeout=None):
+        self.cancelled = Event()
+        self.deadline = None
+        self.expired = False
+        self.name = name
+        self.priority = 0.0
+        self.run_time = run_time
+        self.running = running
+        self.skipped = False
+        self.timeout = timeout
+        self.watchdog = None
+
+    def cancel(self):
+        """ Cancel the job """
+        self.cancelled.set()
+
+    def expire(self):
+        """ Cancel the job because it exceeded the timeout """
+        self.expired = True
+        self.cancel()
+
+    def run(self):
+        """ Run until the run time is over or the job is cancelled """
+        if self.timeout:
+            self.deadline = self.watchdog.add(self)
+        with self.running["lock"]:
+            self.running["count"] += 1
+            self.running["peak"] = max(self.running["peak"],
+                                       self.running["count"])
+        self.cancelled.wait(self.run_time)
+        with self.running["lock"]:
+            self.running["count"] -= 1
+
+    def skip(self):
+        """ Skip the job """
+        self.skipped = True
+
+
+class _Stub(object):  # pylint: disable=R0903
+    """ An object with the given attributes """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _FakeDockerServer(ThreadingMixIn, UnixStreamServer):
+    """ Threaded HTTP server on a unix socket """
+
+    daemon = None
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, *args, **kwargs):
+        UnixStreamServer.__init__(self, *args, **kwargs)
+        self.threads = list([])
+
+    def handle_error(self, request, client_address):
+        """ Closed connections (e.g. of the streams) are expected """
+
+    def process_request(self, request, client_address):
+        """
+        Handle a request in a thread. The connection is closed and the
+        thread is joined by `stop`.
+        """
+        thread = Thread(target=self.process_request_thread,
+                        args=(request, client_address))
+        thread.daemon = True
+        self.threads.append((request, thread))
+        thread.start()
+
+
+# Tests
+
+
+class _RunnerTest(unittest.TestCase):
+    """
+    Run `docker_test_runner` with a synthetic configuration in a temporary
+    directory
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.environ = dict(os.environ)
+        self.work_dir = tempfile.mkdtemp(prefix="docker_test_runner_test_")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def configure(self, config):
+        """
+        Write a configuration (and the Dockerfiles of its images). Returns
+        the path of the configuration file.
+        """
+        image_path = os.path.join(self.work_dir, "docker")
+        if not os.path.isdir(image_path):
+            os.makedirs(image_path)
+        dockerfiles = config.pop("dockerfiles", dict({}))
+        for image in [_name for _image in config["docker_images"]
+                      for _name in (_image if isinstance(_image, dict)
+                                    else [_image])]:
+            with open(os.path.join(image_path, "Dockerfile_%s" % image),
+                      "w") as dockerfile:
+                dockerfile.write(dockerfiles.get(image, "FROM scratch\n"))
+        settings = {
+            "cache_dir": os.path.join(self.work_dir, "cache"),
+            "docker_image_build_args": dict({}),
+            "docker_image_path": image_path,
+            "project_name": "Test"}
+        settings.update(config)
+        config_file = os.path.join(self.work_dir, "docker_test_runner.yml")
+        with open(config_file, "w") as _config_file:
+            safe_dump(settings, _config_file)
+        return config_file
+
+    def config(self, config):
+        """ Write and load a configuration (with the default values) """
+        return docker_test_runner.Configuration(self.configure(config)).get()
+
+    def run_runner(self, config, args=None):
+        """ Run with a configuration. Returns the exit code and results. """
+        config_file = self.configure(config)
+        results_file = os.path.join(self.work_dir, "results.json")
+        parser = docker_test_runner._parser()  # pylint: disable=W0212
+        args = parser.parse_args(
+            ["--file", config_file, "--results", results_file,
+             "--disable-logging"] + (args or list([])))
+        os.chdir(self.work_dir)
+        exit_code = docker_test_runner._run(args)  # pylint: disable=W0212
+        with open(results_file, "r") as _results_file:
+            return exit_code, load(_results_file)
+
+    def socket(self, name="docker"):
+        """ Get the path of a unix socket in the work directory """
+        return os.path.join(self.work_dir, "%s.sock" % name)
+
+
+class PipelineTest(_RunnerTest):
+    """ The pipeline of the image builds and the container runs """
+
+    def test_pipeline(self):
+        """
+        The container runs of an image start as soon as the image is built
+        (while other images are still built). A failed build skips only the
+        container runs of its image.
+        """
+        with FakeDockerDaemon(self.socket(), build_time=1.0,
+                              slow_builds=["slow"],
+                              build_errors=["broken"]) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            exit_code, results = self.run_runner(
+                {"docker_container_environments": {
+                    "env_1": {"TEST_ENVIRONMENT": "1"},
+                    "env_2": {"TEST_ENVIRONMENT": "2"}},
+                 "docker_images": ["Image_1", "Image_broken", "Image_slow"]},
+                ["--threads", "4", "--prefetch-threads", "0"])
+        self.assertNotEqual(exit_code, 0)
+        images = results["docker_images"]
+        self.assertEqual(images["Image_broken"]["exit_code"], 1)
+        containers = dict((_image, list([])) for _image in images)
+        for container in results["docker_containers"].itervalues():
+            self.assertEqual(container["exit_code"], 0)
+            containers[container["image_name"]].append(container)
+        self.assertEqual(
+            dict((_image, len(_containers))
+                 for _image, _containers in containers.iteritems()),
+            {"Image_1": 2, "Image_broken": 0, "Image_slow": 2})
+        for container in containers["Image_1"]:
+            self.assertLess(container["ended"],
+                            images["Image_slow"]["ended"])
+        for container in containers["Image_slow"]:
+            self.assertGreaterEqual(container["started"],
+                                    images["Image_slow"]["ended"])
+
+
+class AsyncEngineTest(_RunnerTest):
+    """ The async engine against a fake Docker daemon """
+
+    def run_async(self, daemon, environments, run_threads=1):
+        """ Run two images with the environments on the async engine """
+        os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+        return self.run_runner(
+            {"docker_container_environments": dict(
+                (_env, {"TEST_ENVIRONMENT": _env}) for _env in environments),
+             "docker_images": ["Image_1", "Image_2"],
+             "engine": "async"},
+            ["--run-threads", str(run_threads), "--prefetch-threads", "0"])
+
+    def test_run(self):
+        """ All container runs succeed and are removed """
+        with FakeDockerDaemon(self.socket()) as daemon:
+            exit_code, results = self.run_async(
+                daemon, ["env_1", "env_2"], 2)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(len(results["docker_containers"]), 4)
+        for name, container in results["docker_containers"].iteritems():
+            self.assertEqual(container["exit_code"], 0)
+            self.assertEqual(os.path.basename(container["log_file"]),
+                             "%s.log" % name)
+        self.assertEqual(daemon.count("DELETE", "^/containers/"),
+                         4)
+        self.assertLessEqual(daemon.peak, 2)
+
+    def test_wait_error(self):
+        """
+        A failed `/wait` (while the logs are still streamed) finishes the
+        container run once and keeps the limit of parallel runs.
+        """
+        with FakeDockerDaemon(self.socket(), wait_errors=["_broken_"]) \
+                as daemon:
+            exit_code, results = self.run_async(
+                daemon, ["broken", "env_1", "env_2", "env_3"])
+        self.assertEqual(exit_code, 2)
+        for container in results["docker_containers"].itervalues():
+            failed = container["environment_name"] == "broken"
+            self.assertEqual(container["exit_code"], int(failed))
+            self.assertEqual(len(container["messages"]), 1)
+        self.assertEqual(daemon.count("DELETE", "^/containers/"),
+                         8)
+        self.assertEqual(daemon.peak, 1)
+
+    def test_connection_error(self):
+        """ A failed connect finishes the request without a status """
+        api = docker_test_runner.AsyncDockerAPI(self.socket("missing"))
+        self.assertRaises(docker_test_runner.docker.errors.DockerException,
+                          api.ping)
+        self.assertFalse(api.busy())
+        with FakeDockerDaemon(self.socket()) as daemon:
+            self.assertTrue(
+                docker_test_runner.AsyncDockerAPI(daemon.path).ping())
+
+
+class DockerHostsTest(_RunnerTest):
+    """ The thread engine with multiple (fake) Docker daemons """
+
+    def test_transfer(self):
+        """
+        A built image is transferred to the other daemon while its container
+        runs are already started on the daemon which has built it. Both
+        daemons are used for the container runs.
+        """
+        with FakeDockerDaemon(self.socket("docker_1"), load_time=0.3) \
+                as daemon_1, \
+                FakeDockerDaemon(self.socket("docker_2"), load_time=0.3) \
+                as daemon_2:
+            exit_code, results = self.run_runner(
+                {"docker_container_environments": dict(
+                    ("env_%s" % _index, {"TEST_ENVIRONMENT": _index})
+                    for _index in range(12)),
+                 "docker_hosts": ["unix://%s" % daemon_1.path,
+                                  "unix://%s" % daemon_2.path],
+                 "docker_images": ["Image_1"]},
+                ["--threads", "4", "--prefetch-threads", "0"])
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(len(results["docker_containers"]), 12)
+        daemons = sorted([daemon_1, daemon_2],
+                         key=lambda _daemon: -_daemon.count("POST", "^/build"))
+        self.assertEqual(daemons[0].count("POST", "^/build"), 1)
+        self.assertEqual(daemons[1].count("POST", "^/build"), 0)
+        loaded = daemons[1].times("POST", "^/images/load")
+        self.assertEqual(len(loaded), 1)
+        started = daemons[0].times("POST", "^/containers/create")
+        self.assertLess(min(started), loaded[0] + daemons[1].load_time)
+        self.assertGreater(
+            daemons[1].count("POST", "^/containers/create"), 0)
+
+
+class ContainerPoolTest(unittest.TestCase):
+    """ The reuse of started containers """
+
+    def setUp(self):
+        self.client = _FakeDockerClient()
+        self.pool = docker_test_runner.ContainerPool(
+            {"docker_container_reuse": 2})
+
+    def container(self, cpus=0.0):
+        """ Get the configuration of a container run """
+        return {"image": "image", "image_id": "sha256:1",
+                "image_name": "Image_1",
+                "resources": {"cpus": cpus, "memory": 0}, "volumes": dict({})}
+
+    def use(self, container, failed=False):
+        """ Acquire and release a container. Returns the container. """
+        docker_container, _ = self.pool.acquire(
+            self.client, "local", container)
+        self.pool.release("local", container, docker_container, failed)
+        return docker_container
+
+    def test_reuse(self):
+        """
+        A container is reused until it's used up or failed. The stopped
+        containers are forgotten.
+        """
+        container = self.container()
+        self.assertIs(self.use(container), self.use(container))
+        self.assertTrue(self.client.started[0].stopped)
+        self.use(container, True)
+        self.assertEqual(len(self.client.started), 2)
+        self.assertTrue(self.client.started[1].stopped)
+        self.use(container)
+        self.pool.close()
+        self.assertEqual(len(self.client.started), 3)
+        self.assertTrue(self.client.started[2].stopped)
+        self.assertEqual(self.pool.uses, dict({}))
+
+    def test_resources(self):
+        """ A container is only reused for runs with the same limits """
+        limited = self.container(0.5)
+        self.assertIsNot(self.use(self.container()), self.use(limited))
+        self.assertIs(self.use(limited), self.client.started[1])
+        self.assertEqual(self.client.started[1].kwargs["nano_cpus"],
+                         int(0.5 * 1e9))
+        self.assertNotIn("nano_cpus", self.client.started[0].kwargs)
+
+
+class HistoryTest(_RunnerTest):
+    """ The durations of the jobs and the predicted schedule """
+
+    def history(self, durations, **config):
+        """ Get the configuration and a saved history with durations """
+        settings = {"build_threads": 1,
+                    "docker_container_environments": {
+                        "env_1": {"TEST_ENVIRONMENT": "1"},
+                        "env_2": {"TEST_ENVIRONMENT": "2"}},
+                    "docker_images": ["Image_1"],
+                    "run_threads": 1,
+                    "threads": 2}
+        settings.update(config)
+        _config = self.config(settings)
+        history = docker_test_runner.History(_config)
+        for key, duration in sorted(durations.iteritems()):
+            history.record(key, duration)
+        history.save()
+        return _config, history
+
+    def test_record(self):
+        """
+        The history is a moving average of the durations and it's stored in
+        the cache directory. Unknown jobs are expected to take as long as
+        the average job of the same kind.
+        """
+        config, history = self.history({"container:Image_1:env_1": 2.0,
+                                        "container:Image_1:env_2": 4.0})
+        history.record("container:Image_1:env_1", 4.0)
+        history.save()
+        history = docker_test_runner.History(config)
+        self.assertEqual(history.index.get("container:Image_1:env_1"),
+                         {"duration": 3.0, "runs": 2})
+        self.assertEqual(history.expected("container:Image_2:env_1"), 3.5)
+        self.assertEqual(history.expected_max("container:Image_1:"), 4.0)
+        self.assertEqual(history.expected("image:Image_1"), 0.0)
+        self.assertFalse(history.known("image:Image_1"))
+
+    def test_order(self):
+        """
+        The container runs with the longest expected duration are started
+        first. The durations of the run are added to the history.
+        """
+        self.history({"container:Image_1:env_1": 0.1,
+                      "container:Image_1:env_2": 0.5,
+                      "container:Image_1:env_3": 0.3})
+        with FakeDockerDaemon(self.socket(), run_time=0.05) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            exit_code, results = self.run_runner(
+                {"docker_container_environments": dict(
+                    ("env_%s" % _index, {"TEST_ENVIRONMENT": _index})
+                    for _index in range(1, 4)),
+                 "docker_images": ["Image_1"]},
+                ["--run-threads", "1", "--prefetch-threads", "0"])
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(
+            [_container["environment_name"] for _container in sorted(
+                results["docker_containers"].itervalues(),
+                key=lambda _container: _container["started"])],
+            ["env_2", "env_3", "env_1"])
+        with open(os.path.join(self.work_dir, "cache", "history.json"),
+                  "r") as history_file:
+            history = load(history_file)
+        self.assertEqual(history["container:Image_1:env_2"]["runs"], 2)
+        self.assertEqual(history["image:Image_1"]["runs"], 1)
+
+    def test_plan(self):
+        """
+        The plan simulates the thread limits and the longest job first
+        order (the critical path of the images first)
+        """
+        config, history = self.history(
+            {"container:Image_1:env_1": 5.0, "container:Image_1:env_2": 1.0,
+             "container:Image_2:env_1": 1.0, "container:Image_2:env_2": 1.0,
+             "image:Image_1": 2.0, "image:Image_2": 1.0},
+            docker_images=["Image_2", "Image_1"])
+        schedule, makespan = docker_test_runner.Plan(
+            config, history).simulate()
+        self.assertEqual(schedule, [
+            ("image:Image_1", 0.0, 2.0),
+            ("container:Image_1:env_1", 2.0, 7.0),
+            ("image:Image_2", 2.0, 3.0),
+            ("container:Image_1:env_2", 7.0, 8.0),
+            ("container:Image_2:env_1", 8.0, 9.0),
+            ("container:Image_2:env_2", 9.0, 10.0)])
+        self.assertEqual(makespan, 10.0)
+        self.assertEqual(
+            docker_test_runner.Plan(config, history).simulate(True),
+            ([("image:Image_1", 0.0, 2.0), ("image:Image_2", 2.0, 3.0)],
+             3.0))
+
+    def test_plan_output(self):
+        """ `--plan` displays the schedule and the predicted makespan """
+        config, history = self.history({"image:Image_1": 60.0},
+                                       docker_container_environments=None)
+        records = list([])
+        handler = logging.Handler()
+        handler.emit = lambda _record: records.append(_record.getMessage())
+        logger = docker_test_runner.LOG
+        disabled, propagate = logger.disabled, logger.propagate
+        logger.disabled, logger.propagate = False, False
+        logger.addHandler(handler)
+        try:
+            self.assertEqual(
+                docker_test_runner._plan(  # pylint: disable=W0212
+                    config, history, True),
+                0)
+        finally:
+            logger.removeHandler(handler)
+            logger.disabled, logger.propagate = disabled, propagate
+        self.assertEqual(records[1:], [
+            "0h 00m 00.00s - 0h 01m 00.00s image:Image_1",
+            "Predicted makespan: 0h 01m 00.00s"])
+
+
+class ReportTest(_RunnerTest):
+    """ The JSON and JUnit XML reports of all jobs """
+
+    def test_reports(self):
+        """
+        Passed, failed and cancelled jobs are reported (cancelled jobs are
+        skipped test cases)
+        """
+        reports = [os.path.join(self.work_dir, _name)
+                   for _name in ["report.json", "report.xml"]]
+        with FakeDockerDaemon(self.socket(), run_time=0.05, build_time=60.0,
+                              build_errors=["broken"],
+                              slow_builds=["slow"]) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            exit_code, _ = self.run_runner(
+                {"docker_container_environments": {
+                    "env_1": {"TEST_ENVIRONMENT": "1"}},
+                 "docker_images": ["Image_1", "Image_broken", "Image_slow"]},
+                ["--fail-fast", "--threads", "4", "--prefetch-threads", "0",
+                 "--report-json", reports[0], "--report-junit", reports[1]])
+        self.assertNotEqual(exit_code, 0)
+        with open(reports[0], "r") as report_file:
+            report = load(report_file)
+        self.assertEqual(report["exit_code"], exit_code)
+        self.assertEqual(report["project_name"], "Test")
+        self.assertGreater(report["duration"], 0.0)
+        jobs = dict(((_job["kind"], _job["name"]), _job)
+                    for _job in report["jobs"])
+        self.assertEqual(
+            dict((_key, _job["status"]) for _key, _job in jobs.iteritems()
+                 if _key[0] == "image"),
+            {("image", "Image_1"): "passed",
+             ("image", "Image_broken"): "failed",
+             ("image", "Image_slow"): "cancelled"})
+        for job in jobs.itervalues():
+            self.assertEqual(
+                sorted(job),
+                ["cache", "docker_host", "duration", "ended", "environment",
+                 "exit_code", "image", "image_id", "kind", "log_file",
+                 "log_tail", "messages", "name", "queue_wait", "queued",
+                 "started", "status"])
+        containers = [_job for _job in jobs.itervalues()
+                      if _job["kind"] == "container"]
+        self.assertEqual(
+            [(_job["image"], _job["environment"], _job["status"])
+             for _job in containers],
+            [("Image_1", "env_1", "passed")])
+        testsuites = ElementTree.parse(reports[1]).getroot()
+        self.assertEqual(testsuites.get("name"), "Test")
+        testsuite = testsuites.find("testsuite[@name='images']")
+        self.assertEqual(
+            [testsuite.get(_key) for _key in ["tests", "failures",
+                                              "skipped"]],
+            ["3", "1", "1"])
+        self.assertEqual(
+            dict((_testcase.get("name"),
+                  [_child.tag for _child in _testcase])
+                 for _testcase in testsuite.findall("testcase")),
+            {"Image_1": ["properties"],
+             "Image_broken": ["properties", "failure"],
+             "Image_slow": ["properties", "skipped"]})
+        testsuite = testsuites.find("testsuite[@name='containers']")
+        self.assertEqual(testsuite.get("tests"), "1")
+
+    def test_junit_escaping(self):
+        """ The log tail of a failed job is escaped in the JUnit XML """
+        log_tail = ["<error> & \"quotes\"", u"\u00fcml\u00e4ut"]
+        report = os.path.join(self.work_dir, "report.xml")
+        docker_test_runner._report_junit(  # pylint: disable=W0212
+            report,
+            {"project_name": "Test & <Project>"},
+            docker_test_runner._report(  # pylint: disable=W0212
+                dict({}),
+                {"Image_1_env_1": {"environment_name": "env_1",
+                                   "exit_code": 1,
+                                   "image_name": "Image_1",
+                                   "log_tail": log_tail,
+                                   "messages": ["Run <failed>."]}}))
+        testsuites = ElementTree.parse(report).getroot()
+        self.assertEqual(testsuites.get("name"), "Test & <Project>")
+        failure = testsuites.find("testsuite/testcase/failure")
+        self.assertEqual(failure.get("message"), "Run <failed>.")
+        self.assertEqual(failure.text, "\n".join(log_tail))
+
+
+class TraceTest(_RunnerTest):
+    """ The trace of a run in the Chrome trace event format """
+
+    def trace(self, engine):
+        """ Run with a trace. Returns the trace. """
+        trace_file = os.path.join(self.work_dir, "trace_%s.json" % engine)
+        with FakeDockerDaemon(self.socket(), run_time=0.05) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            exit_code, _ = self.run_runner(
+                {"docker_container_environments": {
+                    "env_1": {"TEST_ENVIRONMENT": "1"},
+                    "env_2": {"TEST_ENVIRONMENT": "2"}},
+                 "docker_images": ["Image_1", "Image_2"],
+                 "engine": engine},
+                ["--threads", "2", "--prefetch-threads", "0",
+                 "--trace", trace_file])
+        self.assertEqual(exit_code, 0)
+        with open(trace_file, "r") as _trace_file:
+            return load(_trace_file)
+
+    def test_trace(self):
+        """
+        Every span has a named track and the spans of a track are nested
+        (a span ends before its enclosing span ends)
+        """
+        for engine in ["thread", "async"]:
+            trace = self.trace(engine)
+            self.assertEqual(trace["displayTimeUnit"], "ms")
+            events = trace["traceEvents"]
+            names = dict((_event["tid"], _event["args"]["name"])
+                         for _event in events if _event["ph"] == "M")
+            self.assertIn("MainThread", names.values())
+            spans = [_event for _event in events if _event["ph"] == "X"]
+            self.assertEqual(len(spans) + len(names), len(events))
+            tracks = dict({})
+            for span in spans:
+                self.assertIn(span["tid"], names)
+                self.assertGreaterEqual(span["ts"], 0)
+                self.assertGreaterEqual(span["dur"], 0)
+                tracks.setdefault(span["tid"], list([])).append(span)
+            for track in tracks.itervalues():
+                stack = list([])
+                for span in sorted(track, key=lambda _span: (
+                        _span["ts"], -_span["dur"])):
+                    end = span["ts"] + span["dur"]
+                    while stack and stack[-1] <= span["ts"]:
+                        stack.pop()
+                    # The times are truncated to microseconds
+                    if stack:
+                        self.assertLessEqual(end, stack[-1] + 2)
+                    stack.append(end)
+            # Without the random suffix of the container names
+            self.assertEqual(
+                sorted(re.sub(r"_[0-9]{6}$", "", _span["name"])
+                       for _span in spans
+                       if _span["cat"] in ("build", "container", "image",
+                                           "run") and
+                       _span["name"].startswith("Image_")),
+                ["Image_1", "Image_1_env_1", "Image_1_env_2", "Image_2",
+                 "Image_2_env_1", "Image_2_env_2"])
+            self.assertEqual(
+                [_span["args"] for _span in spans
+                 if _span["name"] == "Engine"],
+                [{"engine": engine}])
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """ The worker pools and their watchdogs """
+
+    def setUp(self):
+        self.disabled = docker_test_runner.LOG.disabled
+        docker_test_runner.LOG.disabled = True
+        self.running = {"count": 0, "lock": Lock(), "peak": 0}
+
+    def tearDown(self):
+        docker_test_runner.LOG.disabled = self.disabled
+
+    def job(self, name, **kwargs):
+        """ Create a job """
+        return _Job(name, self.running, **kwargs)
+
+    def test_size(self):
+        """ The pool runs at most `size` jobs in parallel """
+        pool = docker_test_runner.WorkerPool(2)
+        for index in range(6):
+            pool.submit(self.job("job_%s" % index))
+        self.assertEqual(len(pool.workers), 2)
+        pool.join()
+        self.assertEqual(self.running["peak"], 2)
+        self.assertEqual(pool.workers, list([]))
+
+    def test_cancel(self):
+        """
+        A cancel stops the running jobs and skips the queued jobs. The pool
+        can be used again after the join.
+        """
+        pool = docker_test_runner.WorkerPool(1)
+        jobs = [self.job("job_%s" % _index, run_time=30.0)
+                for _index in range(3)]
+        for job in jobs:
+            pool.submit(job)
+        while self.running["count"] == 0:
+            sleep(0.01)
+        pool.cancel()
+        pool.join()
+        self.assertTrue(jobs[0].cancelled.is_set())
+        self.assertEqual([_job.skipped for _job in jobs],
+                         [False, True, True])
+        self.assertFalse(pool.cancelled)
+        job = self.job("job_3")
+        pool.submit(job)
+        pool.join()
+        self.assertFalse(job.skipped)
+
+    def test_expire(self):
+        """
+        Jobs which are exceeding their timeout are expired. A failed expire
+        doesn't stop the watchdog.
+        """
+        pool = docker_test_runner.WorkerPool(2)
+        broken = self.job("broken", run_time=0.5, timeout=0.05)
+        broken.expire = lambda: 1 / 0
+        job = self.job("job", run_time=30.0, timeout=0.2)
+        start_time = time()
+        pool.submit(broken)
+        pool.submit(job)
+        pool.join()
+        self.assertTrue(job.expired)
+        self.assertLess(time() - start_time, 10.0)
+
+
+class AdmissionTest(unittest.TestCase):
+    """ The admission of container runs by their resource requests """
+
+    def setUp(self):
+        self.admission = docker_test_runner.Admission(
+            {"docker_hosts": list([]), "max_load": None},
+            [{"MemTotal": 1024, "NCPU": 2}])
+
+    def test_fit(self):
+        """
+        A run is admitted while its requests are free. A request is limited
+        to the capacity.
+        """
+        first = self.admission.admit({"cpus": 1.5, "memory": 512})
+        self.assertEqual(first, {"cpus": 1.5, "memory": 512})
+        self.assertIsNone(self.admission.admit({"cpus": 1.0, "memory": 0}))
+        self.assertEqual(self.admission.admit({"cpus": 0.5, "memory": 512}),
+                         {"cpus": 0.5, "memory": 512})
+        self.admission.release(first)
+        self.assertEqual(self.admission.free, {"cpus": 1.5, "memory": 512})
+        self.assertIsNone(self.admission.admit({"cpus": 8.0, "memory": 0}))
+        self.admission.release({"cpus": 0.5, "memory": 512})
+        self.assertEqual(self.admission.admit({"cpus": 8.0, "memory": 0}),
+                         {"cpus": 2.0, "memory": 0})
+        self.assertEqual(self.admission.running, 1)
+
+    def test_priority(self):
+        """ The waiting run with the highest priority is admitted first """
+        resources = self.admission.acquire({"cpus": 2.0, "memory": 0})
+        admitted = list([])
+
+        def _run(priority):
+            taken = self.admission.acquire({"cpus": 2.0, "memory": 0},
+                                           priority)
+            admitted.append(priority)
+            self.admission.release(taken)
+
+        threads = list([])
+        for priority in [0, 5, 1]:
+            thread = Thread(target=_run, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            while len(self.admission.waiters) < len(threads):
+                sleep(0.01)
+        self.admission.release(resources)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(admitted, [5, 1, 0])
+        self.assertEqual(self.admission.free, self.admission.capacity)
+
+    def test_saturated(self):
+        """ New runs are delayed while the host is saturated """
+        self.admission._saturated = lambda: True  # pylint: disable=W0212
+        resources = self.admission.admit({"cpus": 0.5, "memory": 0})
+        self.assertIsNotNone(resources)
+        self.assertIsNone(self.admission.admit({"cpus": 0.5, "memory": 0}))
+        self.assertGreater(self.admission.delayed_until, time())
+        self.assertEqual(self.admission.delay,
+                         2 * docker_test_runner.Admission.min_delay)
+        self.admission.release(resources)
+        self.assertIsNotNone(
+            self.admission.acquire({"cpus": 0.5, "memory": 0}))
+
+
+class WorkspaceTest(_RunnerTest):
+    """ The private copies of the writable volumes """
+
+    def test_copy(self):
+        """
+        The writable volumes (directories and files) are copied, the others
+        are used as they are. The copies are removed.
+        """
+        sources = dict((_name, os.path.join(self.work_dir, _name))
+                       for _name in ["rw", "rw_file", "ro", "missing"])
+        os.makedirs(os.path.join(sources["rw"], "directory"))
+        os.makedirs(sources["ro"])
+        for path in [os.path.join(sources["rw"], "directory", "file"),
+                     sources["rw_file"]]:
+            with open(path, "w") as _file:
+                _file.write("source")
+        volumes = {sources["missing"]: {"bind": "/missing", "mode": "rw"},
+                   sources["ro"]: {"bind": "/ro", "mode": "ro"},
+                   sources["rw"]: {"bind": "/rw"},
+                   sources["rw_file"]: {"bind": "/rw_file", "mode": "rw"}}
+        workspace = docker_test_runner.Workspace(
+            self.config({"docker_container_workspace": "copy",
+                         "docker_images": ["Image_1"]}))
+        copies = dict((_volume["bind"], _source) for _source, _volume in
+                      workspace.create("container", volumes).iteritems())
+        self.assertEqual(copies["/missing"], sources["missing"])
+        self.assertEqual(copies["/ro"], sources["ro"])
+        for bind in ["/rw", "/rw_file"]:
+            self.assertTrue(copies[bind].startswith(workspace.path))
+        with open(os.path.join(copies["/rw"], "directory", "file"),
+                  "r+") as _file:
+            self.assertEqual(_file.read(), "source")
+            _file.write(" changed")
+        with open(os.path.join(sources["rw"], "directory", "file"),
+                  "r") as _file:
+            self.assertEqual(_file.read(), "source")
+        workspace.remove("container")
+        self.assertFalse(os.path.exists(copies["/rw"]))
+        self.assertFalse(os.path.exists(copies["/rw_file"]))
+        self.assertEqual(volumes[sources["rw"]], {"bind": "/rw"})
+
+    def test_mode(self):
+        """ Only the known modes are valid """
+        self.assertRaises(
+            ValueError, docker_test_runner.Workspace,
+            self.config({"docker_container_workspace": "volume",
+                         "docker_images": ["Image_1"]}))
+
+
+class ContainerEventsTest(_RunnerTest):
+    """ The tracking of the container runs with the events stream """
+
+    def test_events(self):
+        """
+        Only the events of the tracked containers are kept until they are
+        waited for or the container is removed
+        """
+        with FakeDockerDaemon(self.socket()) as daemon:
+            events = docker_test_runner.ContainerEvents(_Stub(clients={
+                "local": docker_test_runner.docker.DockerClient(
+                    base_url="unix://%s" % daemon.path)}))
+            while not daemon.events:
+                sleep(0.01)
+            for name in ["waited", "cancelled"]:
+                events.add(name)
+            for index, name in enumerate(["other", "waited", "cancelled"]):
+                daemon.finish(daemon.create(name, dict({})), index)
+            self.assertEqual(
+                events.wait("local", _Stub(name="waited")), (1, False))
+            events.remove("waited")
+            with events.condition:
+                while "cancelled" not in events.exit_codes:
+                    events.condition.wait(1.0)
+            self.assertEqual(events.exit_codes.keys(), ["cancelled"])
+            events.remove("cancelled")
+            self.assertEqual(events.exit_codes, dict({}))
+            events.close()
+
+
+class BuildContextTest(_RunnerTest):
+    """ The shared build context """
+
+    @staticmethod
+    def build_context(config):
+        """ Get a build context (and the archives which are created) """
+        build_context = docker_test_runner.BuildContext(config)
+        created = list([])
+        create = build_context._create  # pylint: disable=W0212
+
+        def _create(files):
+            created.append(files)
+            return create(files)
+        build_context._create = _create  # pylint: disable=W0212
+        return build_context, created
+
+    def test_reuse(self):
+        """
+        The archive is created once and again if a file changed. Ignored
+        files are not part of it.
+        """
+        image_path = os.path.join(self.work_dir, "docker")
+        os.makedirs(image_path)
+        for name, content in [(".dockerignore", "*.log\n"),
+                              ("file", "1"), ("test.log", "log")]:
+            with open(os.path.join(image_path, name), "w") as _file:
+                _file.write(content)
+        config = self.config({"docker_images": ["Image_1"]})
+        build_context, created = self.build_context(config)
+        digest = build_context.digest()
+        self.assertEqual(build_context.digest(), digest)
+        self.assertEqual(created, [[".dockerignore", "Dockerfile_Image_1",
+                                    "file"]])
+        build_context, created = self.build_context(config)
+        self.assertEqual(build_context.digest(), digest)
+        self.assertEqual(created, list([]))
+        with open(os.path.join(image_path, "file"), "w") as _file:
+            _file.write("22")
+        build_context, created = self.build_context(config)
+        self.assertNotEqual(build_context.digest(), digest)
+        self.assertEqual(len(created), 1)
+        with build_context.open() as context, \
+                tarfile.open(fileobj=context) as archive:
+            self.assertEqual(archive.extractfile("file").read(), "22")
+
+
+class BuildCacheTest(_RunnerTest):
+    """ The content addressed image build cache """
+
+    def build_cache(self, build_args=None, dockerfile="FROM scratch\n"):
+        """ Get a build cache (of a configuration with one image) """
+        config = self.config({"dockerfiles": {"Image_1": dockerfile},
+                              "docker_image_build_args": build_args or {},
+                              "docker_images": ["Image_1"]})
+        return docker_test_runner.BuildCache(
+            config, docker_test_runner.BuildContext(config))
+
+    def dockerfile(self):
+        """ Get the path of the Dockerfile """
+        return os.path.join(self.work_dir, "docker", "Dockerfile_Image_1")
+
+    def test_digest(self):
+        """
+        The digest is stable and changes with the Dockerfile, the build
+        arguments, the build context and the parent images
+        """
+        digest = self.build_cache().digest(self.dockerfile())
+        self.assertEqual(self.build_cache().digest(self.dockerfile()), digest)
+        digests = set([
+            digest,
+            self.build_cache({"ARG": "1"}).digest(self.dockerfile()),
+            self.build_cache().digest(self.dockerfile(), ["sha256:1"]),
+            self.build_cache(dockerfile="FROM scratch\nENV TEST=1\n")
+            .digest(self.dockerfile())])
+        build_cache = self.build_cache()
+        with open(os.path.join(self.work_dir, "docker", "file"),
+                  "w") as context_file:
+            context_file.write("context")
+        digests.add(build_cache.digest(self.dockerfile()))
+        self.assertEqual(len(digests), 5)
+
+    def test_get(self):
+        """
+        A cached image is only used if it's still present with the same ID
+        """
+        build_cache = self.build_cache()
+        digest = build_cache.digest(self.dockerfile())
+        images = dict({})
+        tags = list([])
+
+        def _get(name):
+            if name not in images:
+                raise docker_test_runner.docker.errors.ImageNotFound(name)
+            return images[name]
+        client = _Stub(images=_Stub(get=_get))
+        image = _Stub(id="sha256:1",
+                      tag=lambda *_tags: tags.append(_tags))
+        self.assertIsNone(build_cache.get(client, "test_image_1", digest))
+        build_cache.set("test_image_1", digest, image)
+        self.assertEqual(tags, [("test_image_1", "dtr-%s" % digest[:16])])
+        self.assertIsNone(build_cache.get(client, "test_image_1", digest))
+        images["test_image_1:dtr-%s" % digest[:16]] = image
+        self.assertIs(
+            self.build_cache().get(client, "test_image_1", digest), image)
+        image.id = "sha256:2"
+        self.assertIsNone(build_cache.get(client, "test_image_1", digest))
+
+
+class ResultCacheTest(_RunnerTest):
+    """ The cache of passed container runs """
+
+    def test_result_cache(self):
+        """
+        Passed container runs are skipped until the content of a volume
+        changes
+        """
+        volume = os.path.join(self.work_dir, "volume")
+        os.makedirs(volume)
+        config = {
+            "docker_container_environments": {
+                "env_1": {"TEST_ENVIRONMENT": "1"},
+                "env_2": {"TEST_ENVIRONMENT": "2"}},
+            "docker_container_volumes": {
+                volume: {"bind": "/volume", "mode": "ro"}},
+            "docker_images": ["Image_1"]}
+        with FakeDockerDaemon(self.socket(), run_time=0.05) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            runs = list([])
+            for content in ["1", "1", "2"]:
+                with open(os.path.join(volume, "file"), "w") as _file:
+                    _file.write(content)
+                exit_code, results = self.run_runner(
+                    dict(config),
+                    ["--result-cache", "--prefetch-threads", "0"])
+                self.assertEqual(exit_code, 0)
+                runs.append(sorted(
+                    _container["cache"] for _container in
+                    results["docker_containers"].itervalues()))
+        self.assertEqual(runs, [["miss", "miss"], ["hit", "hit"],
+                                ["miss", "miss"]])
+        self.assertEqual(daemon.count("POST", "^/containers/create"), 4)
+
+
+class LayerCacheTest(unittest.TestCase):
+    """ The content addressed blobs of the layer cache """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="docker_test_runner_test_")
+        self.layer_cache = docker_test_runner.LayerCache(
+            {"docker_layer_cache": os.path.join(self.work_dir, "cache")})
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def archive(self, files):
+        """ Create a tar archive with files. Returns its path. """
+        path = os.path.join(self.work_dir, "image.tar")
+        with tarfile.open(path, "w") as archive:
+            for name, content in sorted(files.iteritems()):
+                source = os.path.join(self.work_dir, name)
+                with open(source, "wb") as source_file:
+                    source_file.write(content)
+                archive.add(source, name)
+        return path
+
+    def test_temporary_files(self):
+        """
+        The temporary archives are unique and the temporary blobs aren't
+        pruned
+        """
+        # pylint: disable=W0212
+        self.assertNotEqual(self.layer_cache._archive("image"),
+                            self.layer_cache._archive("image"))
+        blobs = os.path.join(self.work_dir, "cache", "blobs")
+        os.makedirs(blobs)
+        for name in ["unused.gz", "parallel.tmp"]:
+            open(os.path.join(blobs, name), "w").close()
+        self.layer_cache._prune()
+        self.assertEqual(os.listdir(blobs), ["parallel.tmp"])
+
+    def test_store(self):
+        """
+        Equal files are stored once (also by parallel stores) and the
+        archive is restored from the blobs
+        """
+        files = {"layer_1": b"a" * 1024, "layer_2": b"a" * 1024,
+                 "layer_3": b"b" * 1024}
+        archive = self.archive(files)
+        members = list([])
+        threads = [Thread(target=lambda: members.append(
+            self.layer_cache._store(archive)))  # pylint: disable=W0212
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(members), 4)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.work_dir, "cache", "blobs"))), 2)
+        restored = os.path.join(self.work_dir, "restored.tar")
+        self.layer_cache._write(members[0], restored)  # pylint: disable=W0212
+        with tarfile.open(restored, "r") as _restored:
+            self.assertEqual(
+                dict((_member.name, _restored.extractfile(_member).read())
+                     for _member in _restored),
+                files)
+
+
+class PrefetchTest(_RunnerTest):
+    """ The pulls of the base images before the image builds """
+
+    def test_prefetch(self):
+        """
+        A base image which is shared by multiple images is pulled once.
+        Present base images and the images of the project are not pulled.
+        """
+        with FakeDockerDaemon(self.socket()) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            daemon.add_image(["alpine:3.8"])
+            exit_code, _ = self.run_runner(
+                {"dockerfiles": {"Image_1": "FROM debian:stretch\n",
+                                 "Image_2": "FROM debian:stretch\n",
+                                 "Image_3": "FROM alpine:3.8\n",
+                                 "Image_4": "FROM test_image_1\n"},
+                 "docker_images": ["Image_1", "Image_2", "Image_3",
+                                   "Image_4"]},
+                ["--build-only", "--prefetch-threads", "2"])
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(daemon.count("POST", "^/images/create$"), 1)
+        self.assertIsNotNone(daemon.image("debian:stretch"))
+        pulled = daemon.times("POST", "^/images/create$")[0]
+        self.assertLess(pulled, min(daemon.times("POST", "^/build$")))
+
+
+class ThreadsTest(_RunnerTest):
+    """ The limits of the parallel image builds and container runs """
+
+    def test_run_threads(self):
+        """
+        Without `threads` the container runs are only limited by the run
+        threads
+        """
+        with FakeDockerDaemon(self.socket()) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            exit_code, _ = self.run_runner(
+                {"docker_container_environments": dict(
+                    ("env_%s" % _index, {"TEST_ENVIRONMENT": _index})
+                    for _index in range(6)),
+                 "docker_images": ["Image_1"]},
+                ["--run-threads", "3", "--prefetch-threads", "0"])
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(daemon.peak, 3)
+
+    def test_invalid(self):
+        """ Less than one thread is an error """
+        parser = docker_test_runner._parser()  # pylint: disable=W0212
+        for option in ["--threads", "--build-threads", "--run-threads"]:
+            self.assertIsNotNone(
+                docker_test_runner._threads_error(  # pylint: disable=W0212
+                    parser.parse_args([option, "0"])))
+        self.assertIsNone(
+            docker_test_runner._threads_error(  # pylint: disable=W0212
+                parser.parse_args(["--threads", "1"])))
+        for threads in [0, "many"]:
+            self.assertRaisesRegexp(
+                ValueError, "\"threads\" has to be at least 1",
+                self.run_runner,
+                {"docker_images": ["Image_1"], "threads": threads})
+
+
+class TimeoutTest(_RunnerTest):
+    """ The timeouts of the image builds and container runs """
+
+    def test_build_timeout(self):
+        """ A build without any output is aborted by the timeout """
+        start_time = time()
+        with FakeDockerDaemon(self.socket(), build_time=60.0) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            exit_code, results = self.run_runner(
+                {"docker_images": ["Image_1"]},
+                ["--build-timeout", "0.5", "--prefetch-threads", "0"])
+        self.assertNotEqual(exit_code, 0)
+        self.assertEqual(results["docker_images"]["Image_1"]["status"],
+                         "timed out")
+        self.assertLess(time() - start_time, 10.0)
+
+    def test_fail_fast_build(self):
+        """ A build without any output is aborted by a failure (fail fast) """
+        start_time = time()
+        with FakeDockerDaemon(self.socket(), build_time=60.0,
+                              build_errors=["broken"]) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            exit_code, results = self.run_runner(
+                {"docker_images": ["Image_1", "Image_broken"]},
+                ["--fail-fast", "--threads", "2", "--prefetch-threads", "0"])
+        self.assertNotEqual(exit_code, 0)
+        self.assertEqual(results["docker_images"]["Image_1"]["status"],
+                         "cancelled")
+        self.assertLess(time() - start_time, 10.0)
+
+    def test_invalid(self):
+        """ A timeout has to be greater than 0 """
+        parser = docker_test_runner._parser()  # pylint: disable=W0212
+        for option in ["--build-timeout", "--run-timeout"]:
+            self.assertIsNotNone(
+                docker_test_runner._timeout_error(  # pylint: disable=W0212
+                    parser.parse_args([option, "0"])))
+        self.assertIsNone(
+            docker_test_runner._timeout_error(  # pylint: disable=W0212
+                parser.parse_args(["--run-timeout", "0.5"])))
+        for timeout in [-1, "never"]:
+            self.assertRaisesRegexp(
+                ValueError, "\"run_timeout\" has to be greater than 0",
+                self.run_runner,
+                {"docker_images": ["Image_1"], "run_timeout": timeout})
+
+
+class ImageGraphTest(_RunnerTest):
+    """ The dependencies between the images """
+
+    def image_graph(self, images, dockerfiles):
+        """ Get the image graph of a configuration """
+        return docker_test_runner.ImageGraph(self.config(
+            {"docker_images": images, "dockerfiles": dockerfiles}))
+
+    def test_order(self):
+        """
+        Parents are found in the FROM lines (tags of other images) and in
+        the configuration. Parents are built first.
+        """
+        image_graph = self.image_graph(
+            [{"App": {"parent": "Base"}}, "Child", "Base"],
+            {"App": "FROM test_child:latest\n",
+             "Base": "FROM debian:stretch AS build\nFROM build\n",
+             "Child": "FROM test_base\n"})
+        self.assertEqual(image_graph.order(), ["Base", "Child", "App"])
+        self.assertEqual(image_graph.ancestors("App"), set(["Base", "Child"]))
+        self.assertEqual(image_graph.descendants("Base"),
+                         set(["App", "Child"]))
+        self.assertEqual(image_graph.closure(["Child"]), ["Child", "Base"])
+        self.assertEqual(image_graph.base_images(["App", "Base"]),
+                         ["debian:stretch"])
+        self.assertEqual(image_graph.ready("Base", set(["Base"])),
+                         ["Child"])
+
+    def test_errors(self):
+        """ Cyclic dependencies and unknown parents are errors """
+        self.assertRaises(
+            ValueError, self.image_graph, ["A", "B"],
+            {"A": "FROM test_b\n", "B": "FROM test_a\n"})
+        self.assertRaises(
+            KeyError, self.image_graph, [{"A": {"parent": "B"}}], dict({}))
+
+
+class MatrixTest(_RunnerTest):
+    """ The container runs (image x environment) of a configuration """
+
+    def matrix(self, **config):
+        """ Get the matrix of a configuration with three images """
+        settings = {
+            "docker_container_environments": {
+                "env_1": {"skip_images": ["Ubuntu_*"]},
+                "env_2": {"only_images": ["Debian_10"]},
+                "env_3": dict({})},
+            "docker_images": ["Debian_9", "Debian_10", "Ubuntu_18_04"]}
+        settings.update(config)
+        return docker_test_runner.Matrix(self.config(settings))
+
+    @staticmethod
+    def runs(matrix):
+        """ Get all container runs (image:environment) of a matrix """
+        return sorted(
+            "%s:%s" % (_image, _env)
+            for _image in matrix.config["docker_images"]
+            for _env, _ in matrix.runs(_image))
+
+    def test_skips(self):
+        """ `skip_images` and `only_images` of the environments """
+        matrix = self.matrix()
+        self.assertFalse(matrix.filtered())
+        self.assertEqual(self.runs(matrix), [
+            "Debian_10:env_1", "Debian_10:env_2", "Debian_10:env_3",
+            "Debian_9:env_1", "Debian_9:env_3", "Ubuntu_18_04:env_3"])
+        self.assertEqual(matrix.count(), 6)
+        self.assertEqual(matrix.count(["Debian_9"]), 2)
+
+    def test_filters(self):
+        """ Include, exclude and `--only` patterns """
+        matrix = self.matrix(docker_container_exclude=["*:env_3"],
+                             docker_container_include=["Debian_*"])
+        self.assertTrue(matrix.filtered())
+        self.assertEqual(self.runs(matrix), [
+            "Debian_10:env_1", "Debian_10:env_2", "Debian_9:env_1"])
+        self.assertEqual(matrix.images(), ["Debian_9", "Debian_10"])
+        self.assertEqual(matrix.images(True), ["Debian_9", "Debian_10"])
+        matrix = self.matrix(docker_container_exclude=["Debian_9"],
+                             docker_container_only=["*:env_2", "Debian_9"])
+        self.assertEqual(self.runs(matrix), ["Debian_10:env_2"])
+        self.assertEqual(matrix.images(), ["Debian_10"])
+        self.assertEqual(matrix.images(True),
+                         ["Debian_10", "Ubuntu_18_04"])
+
+
+class ShardTest(_RunnerTest):
+    """ Sharded runs (e.g. on multiple CI nodes) and their merge """
+
+    def merge(self, results_files):
+        """ Merge results files. Returns the exit code. """
+        parser = docker_test_runner._parser()  # pylint: disable=W0212
+        args = parser.parse_args(
+            ["--merge"] + results_files +
+            ["--shard-history", self.shard_history(), "--disable-logging"])
+        return docker_test_runner._merge(args)  # pylint: disable=W0212
+
+    def run_shards(self, total):
+        """
+        Run all shards. Every node has a different local history. Returns
+        the results files.
+        """
+        results_files = list([])
+        with FakeDockerDaemon(self.socket(), run_time=0.05) as daemon:
+            os.environ["DOCKER_HOST"] = "unix://%s" % daemon.path
+            for index in range(total):
+                cache_dir = os.path.join(self.work_dir, "cache_%s" % index)
+                os.makedirs(cache_dir)
+                with open(os.path.join(cache_dir, "history.json"),
+                          "w") as history_file:
+                    history_file.write(dumps(dict(
+                        ("container:Image_1:env_%s" % _index,
+                         {"duration": 100.0 if _index == index else 1.0,
+                          "runs": 1})
+                        for _index in range(6))))
+                _, results = self.run_runner(
+                    {"cache_dir": cache_dir,
+                     "docker_container_environments": dict(
+                         ("env_%s" % _index, {"TEST_ENVIRONMENT": _index})
+                         for _index in range(6)),
+                     "docker_images": ["Image_1", "Image_2"]},
+                    ["--shard-index", str(index),
+                     "--shard-total", str(total),
+                     "--shard-history", self.shard_history(),
+                     "--prefetch-threads", "0"])
+                results_files.append(
+                    os.path.join(self.work_dir, "results_%s.json" % index))
+                with open(results_files[-1], "w") as results_file:
+                    results_file.write(dumps(results))
+        return results_files
+
+    def shard_history(self):
+        """ Get the path of the shared history """
+        return os.path.join(self.work_dir, "shard_history.json")
+
+    def test_merge(self):
+        """
+        The shards are disjoint although the local histories of the nodes
+        are different. The merge fails if the results of a shard are missing
+        and writes the shared history.
+        """
+        results_files = self.run_shards(3)
+        containers = list([])
+        for results_file in results_files:
+            with open(results_file, "r") as _results_file:
+                containers += load(_results_file)["docker_containers"].keys()
+        self.assertEqual(len(containers), 12)
+        self.assertEqual(len(set(containers)), 12)
+        self.assertEqual(self.merge(results_files[1:]), 1)
+        self.assertFalse(os.path.exists(self.shard_history()))
+        self.assertEqual(self.merge(results_files + results_files[:1]), 1)
+        self.assertEqual(self.merge(results_files), 0)
+        with open(self.shard_history(), "r") as history_file:
+            history = load(history_file)
+        self.assertEqual(len(history), 14)
+
+
+class WatchTest(_RunnerTest):
+    """ The jobs which are affected by changes in the watch mode """
+
+    def settings(self, **config):
+        """ Get a configuration with three images and two environments """
+        settings = {
+            "docker_container_environments": {
+                "env_1": {"environment": {"VAR": "1"}},
+                "env_2": dict({})},
+            "docker_images": ["Base", {"App": {"parent": "Base"}}, "Other"]}
+        settings.update(config)
+        return settings
+
+    def setUp(self):
+        _RunnerTest.setUp(self)
+        self.config_file = self.configure(self.settings())
+        self.watch = docker_test_runner.Watch(
+            docker_test_runner._parser().parse_args(  # pylint: disable=W0212
+                ["--file", self.config_file]))
+        self.watch._load()  # pylint: disable=W0212
+
+    def dockerfile(self, image):
+        """ Get the path of the Dockerfile of an image """
+        return os.path.join(self.work_dir, "docker", "Dockerfile_%s" % image)
+
+    def test_dockerfiles(self):
+        """ A changed Dockerfile affects its image and the descendants """
+        self.assertEqual(self.watch.affected([self.dockerfile("Base")]),
+                         set(["App", "Base"]))
+        self.assertEqual(
+            self.watch.affected([self.dockerfile("Other"),
+                                 self.dockerfile("Unknown")]),
+            set(["Other"]))
+        self.assertIsNone(self.watch.affected(
+            [self.dockerfile("App"), os.path.join(self.work_dir, "src")]))
+
+    def test_configuration(self):
+        """
+        Changed environments and images of the configuration affect their
+        jobs, other changes affect all jobs
+        """
+        settings = self.settings()
+        settings["docker_container_environments"]["env_1"] = dict({})
+        settings["docker_images"][1] = {
+            "App": {"parent": "Base", "resources": {"cpus": 1}}}
+        self.configure(settings)
+        self.assertEqual(self.watch.affected([self.config_file]),
+                         set(["*:env_1", "App"]))
+        self.configure(self.settings(
+            docker_images=["Base", {"App": {"parent": "Base"}}, "Other",
+                           "New"]))
+        self.assertEqual(self.watch.affected([self.config_file]),
+                         set(["*:env_1", "App", "New"]))
+        self.configure(self.settings(project_name="Changed"))
+        self.assertIsNone(self.watch.affected([self.config_file]))
+
+
+class DaemonTest(_RunnerTest):
+    """ The runner daemon and its clients """
+
+    # pylint: disable=W0212
+
+    def setUp(self):
+        _RunnerTest.setUp(self)
+        self.keepalive = docker_test_runner._DaemonRequestHandler.keepalive
+        docker_test_runner._DaemonRequestHandler.keepalive = 0.1
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+        self.daemon = None
+        self.jobs = list([])
+        self.server = None
+
+    def tearDown(self):
+        docker_test_runner._DaemonRequestHandler.keepalive = self.keepalive
+        sys.stderr = self.stderr
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        _RunnerTest.tearDown(self)
+
+    def execute(self, count):
+        """ Execute jobs in a thread (like `Daemon.run`) """
+        def _execute():
+            for _ in range(count):
+                job = self.daemon._next()
+                self.jobs.append(job)
+                self.daemon._execute(job)
+        thread = Thread(target=_execute, name="Daemon")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def serve(self, docker_daemon, environments, images=None):
+        """
+        Serve the daemon API. Returns the arguments of the submits (of a
+        configuration with the images and the environments).
+        """
+        os.environ["DOCKER_HOST"] = "unix://%s" % docker_daemon.path
+        config_file = self.configure(
+            {"docker_container_environments": dict(
+                (_env, {"TEST_ENVIRONMENT": _env}) for _env in environments),
+             "docker_image_build_args": {"DTR_TEST_BUILD_ARG": "1"},
+             "docker_images": images or ["Image_1"]})
+        os.chdir(self.work_dir)
+        parser = docker_test_runner._parser()
+        self.daemon = docker_test_runner.Daemon(parser.parse_args(
+            ["--daemon", self.socket("daemon"), "--disable-logging"]))
+        self.server = docker_test_runner._DaemonServer(
+            self.socket("daemon"),
+            docker_test_runner._DaemonRequestHandler)
+        self.server.session = self.daemon
+        thread = Thread(target=self.server.serve_forever, name="API")
+        thread.daemon = True
+        thread.start()
+        return ["--file", config_file, "--disable-logging",
+                "--prefetch-threads", "0"]
+
+    def submit(self, argv, submitter, exit_codes):
+        """ Submit a run in a thread. The exit code is appended. """
+        client = docker_test_runner.DaemonClient(self.socket("daemon"))
+        thread = Thread(target=lambda: exit_codes.append(
+            client.submit(argv, submitter)))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def wait_queued(self, count):
+        """ Wait until jobs are queued """
+        while len(self.daemon.jobs()["queued"]) < count:
+            sleep(0.01)
+
+    def test_submit(self):
+        """
+        A submitted run is executed and its exit code is returned. The
+        environment of the daemon is restored after the run.
+        """
+        with FakeDockerDaemon(self.socket(), build_errors=["broken"]) \
+                as docker_daemon:
+            argv = self.serve(docker_daemon, ["env_1", "env_2"],
+                              ["Image_1", "Image_broken"])
+            executor = self.execute(2)
+            exit_codes = list([])
+            self.submit(argv, "user", exit_codes).join(30.0)
+            self.submit(argv + ["--only", "Image_1"], "user",
+                        exit_codes).join(30.0)
+            executor.join(30.0)
+        self.assertNotEqual(exit_codes[0], 0)
+        self.assertEqual(exit_codes[1], 0)
+        self.assertEqual([_job.exit_code for _job in self.jobs], exit_codes)
+        self.assertNotIn("DTR_TEST_BUILD_ARG", os.environ)
+        self.assertEqual(docker_daemon.count("POST", "^/containers/create"),
+                         4)
+
+    def test_turns(self):
+        """ The submitters take turns (round robin) """
+        with FakeDockerDaemon(self.socket(), run_time=0.05) as docker_daemon:
+            argv = self.serve(docker_daemon, ["env_1"])
+            exit_codes = list([])
+            submits = list([])
+            for index, submitter in enumerate(["alice", "alice", "alice",
+                                               "bob", "bob"]):
+                submits.append(self.submit(argv, submitter, exit_codes))
+                self.wait_queued(index + 1)
+            executor = self.execute(5)
+            for submit in submits:
+                submit.join(30.0)
+            executor.join(30.0)
+        self.assertEqual(exit_codes, [0] * 5)
+        self.assertEqual([_job.submitter for _job in self.jobs],
+                         ["alice", "bob", "alice", "bob", "alice"])
+
+    def test_cancel(self):
+        """ A run is cancelled if its client disconnects """
+        with FakeDockerDaemon(self.socket(), run_time=60.0) as docker_daemon:
+            argv = self.serve(docker_daemon, ["env_1"])
+            executor = self.execute(1)
+            connection = docker_test_runner._UnixHTTPConnection(
+                self.socket("daemon"))
+            connection.request(
+                "POST", "/jobs",
+                dumps({"argv": argv, "cwd": self.work_dir,
+                       "submitter": "user"}),
+                {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            while not docker_daemon.running:
+                sleep(0.01)
+            response.close()
+            connection.close()
+            executor.join(30.0)
+        self.assertFalse(executor.is_alive())
+        self.assertNotEqual(self.jobs[0].exit_code, 0)
+        self.assertEqual(self.daemon.jobs()["running"], None)
+
+    def test_client_imports(self):
+        """ The client doesn't import the Docker SDK and YAML """
+        script = ("import sys\n"
+                  "import docker_test_runner\n"
+                  "sys.argv[1:] = ['--connect', %r]\n"
+                  "try:\n"
+                  "    docker_test_runner.main()\n"
+                  "except SystemExit:\n"
+                  "    pass\n"
+                  "print(sorted(set(sys.modules) & set(['docker', 'requests', "
+                  "'urllib3', 'yaml'])))\n" % self.socket("daemon"))
+        process = subprocess.Popen(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(docker_test_runner.__file__)),
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        stdout, _ = process.communicate()
+        self.assertEqual(stdout.strip(), "[]")
+
+    def test_cancel_started(self):
+        """ A run which is cancelled before it has started isn't executed """
+        with FakeDockerDaemon(self.socket()) as docker_daemon:
+            argv = self.serve(docker_daemon, ["env_1"])
+            self.daemon.submit(self.daemon.job(
+                {"argv": argv, "cwd": self.work_dir, "submitter": "user"}))
+            job = self.daemon._next()
+            self.daemon.cancel_job(job)
+            self.daemon._execute(job)
+        self.assertNotEqual(job.exit_code, 0)
+        self.assertEqual(docker_daemon.count("POST", "^/containers/create"),
+                         0)
+
+
+if __name__ == "__main__":
+    unittest.main()